@@ -0,0 +1,225 @@
+import dataclasses
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import torch
+import transformers
+from transformers import HfArgumentParser
+
+from legogpt.models import GenerationEvent, LegoGPT, LegoGPTConfig, create_tiny_model, export_onnx
+from legogpt.models.llm import kv_cache_nbytes
+
+benchmark_captions = [
+    'A basic chair with four legs.',
+    'Table featuring a flat rectangular surface over four evenly spaced legs.',
+    'An elongated, rectangular vessel with layered construction, central recess, and uniform edges.',
+    'A tall, narrow tower with a square base and straight vertical walls.',
+    'A simple bed with a raised headboard and a flat rectangular frame.',
+]
+
+
+@dataclass
+class BenchmarkConfig:
+    output_path: str = field(
+        default='benchmark_results.json',
+        metadata={'help': 'The path of the JSON file to which to write the benchmark results.'},
+    )
+    tiny_model: bool = field(
+        default=True,
+        metadata={'help': 'Whether to benchmark a tiny randomly initialized model, which is built offline from the '
+                          'fine-tuning config files, instead of the model given by model_name_or_path. '
+                          'Ignored with backend=replay.'},
+    )
+    tiny_model_config_dir: str = field(
+        default='finetuning_config_files',
+        metadata={'help': 'The directory of the fine-tuning config files from which to build the tiny model, '
+                          'relative to the current directory. The default is the directory in the LegoGPT repository, '
+                          'so it must be given when running the benchmark from elsewhere.'},
+    )
+    tiny_model_hidden_size: int = field(
+        default=64,
+        metadata={'help': 'The hidden size of the tiny model.'},
+    )
+    tiny_model_num_hidden_layers: int = field(
+        default=2,
+        metadata={'help': 'The number of layers of the tiny model.'},
+    )
+    tiny_model_eos_logit_offset: float = field(
+        default=-20.0,
+        metadata={'help': 'The offset added to the logit of the EOS token of the tiny model. The default makes EOS '
+                          'so unlikely that every structure is generated up to max_bricks bricks, '
+                          'so that each benchmark run does a comparable amount of work.'},
+    )
+    n_captions: int = field(
+        default=len(benchmark_captions),
+        metadata={'help': 'The number of captions from the fixed benchmark caption set to generate.'},
+    )
+    n_warmup: int = field(
+        default=1,
+        metadata={'help': 'The number of untimed generations to run before the benchmark.'},
+    )
+    seed: int = field(
+        default=42,
+        metadata={'help': 'The random seed with which to generate each caption.'},
+    )
+    baseline_path: str | None = field(
+        default=None,
+        metadata={'help': 'The path of a JSON file of earlier benchmark results, e.g. of a full-precision model. '
+                          'If given, the benchmark fails if a quality metric is worse than the baseline '
+                          'by more than the tolerance.'},
+    )
+    tolerance: float = field(
+        default=0.05,
+        metadata={'help': 'The largest allowed drop of each quality metric below the baseline.'},
+    )
+
+
+quality_metrics = ('brick_validity_rate', 'stability_rate')
+
+
+class _BrickCounter:
+    """
+    A hook that counts the bricks that were generated, whether they were accepted or rejected. It only increments
+    a counter, so that it adds no measurable time to the generation being benchmarked.
+    """
+
+    def __init__(self):
+        self.n_bricks = 0
+
+    def __call__(self, event: GenerationEvent) -> None:
+        if event.name in ('brick_accepted', 'brick_rejected'):
+            self.n_bricks += 1
+
+
+def run_benchmark(legogpt: LegoGPT, cfg: BenchmarkConfig) -> dict:
+    """
+    Generates each caption of the benchmark caption set with the given LegoGPT model, and measures its throughput.
+    :return: The benchmark results, with the measurements for each caption and a summary.
+    """
+    captions = benchmark_captions[:cfg.n_captions]
+    legogpt.return_trace = True
+
+    for caption in captions[:cfg.n_warmup]:
+        transformers.set_seed(cfg.seed)
+        legogpt(caption)
+
+    results = []
+    for caption in captions:
+        brick_counter = _BrickCounter()
+        legogpt.add_hook(brick_counter)
+        transformers.set_seed(cfg.seed)
+        start_time = time.perf_counter()
+        output = legogpt(caption)
+        end_time = time.perf_counter()
+        legogpt.remove_hook(brick_counter)
+        # Measured outside the timed window, when the KV cache holds the whole generated structure
+        kv_cache_mb = kv_cache_nbytes(getattr(legogpt.llm, 'kv_cache', None)) / 2 ** 20
+
+        results.append({
+            'caption': caption,
+            'time': end_time - start_time,
+            'n_bricks': len(output['lego']),
+            'n_tokens': brick_counter.n_bricks * len(legogpt._brick_template),
+            'n_rejections': output['rejection_reasons'].total(),
+            'n_regenerations': output['n_regenerations'],
+            'is_stable': output['lego'].is_stable(),
+            'kv_cache_mb': kv_cache_mb,
+            'trace': output['trace'],
+        })
+
+    total_time = sum(result['time'] for result in results)
+    n_bricks = sum(result['n_bricks'] for result in results)
+    n_rejections = sum(result['n_rejections'] for result in results)
+    summary = {
+        'total_time': total_time,
+        'bricks_per_second': n_bricks / total_time,
+        'tokens_per_second': sum(result['n_tokens'] for result in results) / total_time,
+        'rejections_per_brick': n_rejections / max(n_bricks, 1),
+        'brick_validity_rate': n_bricks / max(n_bricks + n_rejections, 1),
+        'stability_rate': sum(result['is_stable'] for result in results) / len(results),
+        'stability_solve_share': sum(result['trace']['stability_solve'] for result in results) / total_time,
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_kv_cache_mb': max(result['kv_cache_mb'] for result in results),
+    }
+    return {'summary': summary, 'results': results}
+
+
+def compare_to_baseline(summary: dict, baseline_summary: dict, tolerance: float) -> list[str]:
+    """
+    Compares the quality metrics of a benchmark summary to those of a baseline, e.g. to check that
+    a quantized model generates about as well as the full-precision model.
+    :return: A description of each quality metric that is worse than the baseline by more than the tolerance.
+    """
+    return [f'{metric}: {summary[metric]:.4g} < baseline {baseline_summary[metric]:.4g} - {tolerance:.4g}'
+            for metric in quality_metrics if summary[metric] < baseline_summary[metric] - tolerance]
+
+
+def _peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of this process, in MiB.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10  # Bytes on macOS, KiB on Linux
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = HfArgumentParser((LegoGPTConfig, BenchmarkConfig))
+    cfg, benchmark_cfg = parser.parse_args_into_dataclasses()
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        if benchmark_cfg.tiny_model and cfg.backend != 'replay':
+            cfg.model_name_or_path = create_tiny_model(
+                model_dir,
+                benchmark_cfg.tiny_model_config_dir,
+                hidden_size=benchmark_cfg.tiny_model_hidden_size,
+                num_hidden_layers=benchmark_cfg.tiny_model_num_hidden_layers,
+                eos_logit_offset=benchmark_cfg.tiny_model_eos_logit_offset,
+            )
+            if cfg.backend == 'onnx':
+                cfg.model_name_or_path = str(export_onnx(cfg.model_name_or_path, Path(model_dir) / 'onnx').parent)
+        legogpt = LegoGPT(cfg)
+        benchmark_results = run_benchmark(legogpt, benchmark_cfg)
+
+    benchmark_results = {
+        'commit': _git_commit(),
+        'torch_version': torch.__version__,
+        'device': legogpt.device,
+        'config': dataclasses.asdict(cfg) | {'benchmark': dataclasses.asdict(benchmark_cfg)},
+    } | benchmark_results
+    with open(benchmark_cfg.output_path, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+
+    # Print results
+    print('--------------------')
+    for key, value in benchmark_results['summary'].items():
+        print(f'{key}: {value:.4g}')
+    print(f'Saved results to {Path(benchmark_cfg.output_path).absolute()}')
+    print('--------------------')
+
+    if benchmark_cfg.baseline_path:
+        with open(benchmark_cfg.baseline_path) as f:
+            baseline_summary = json.load(f)['summary']
+        regressions = compare_to_baseline(benchmark_results['summary'], baseline_summary, benchmark_cfg.tolerance)
+        if regressions:
+            print('Quality regressions against the baseline:')
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print('All quality metrics are within tolerance of the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -130,6 +130,7 @@ class LegoStructure:
         # Build structure from bricks
         self.bricks = []
         self.voxel_occupancy = np.zeros((world_dim, world_dim, world_dim), dtype=int)
+        self._stability_scores = None  # Cached until the structure is modified
         for brick in bricks:
             self.add_brick(brick)
 
@@ -151,11 +152,13 @@ class LegoStructure:
     def add_brick(self, brick: LegoBrick) -> None:
         self.bricks.append(brick)
         self.voxel_occupancy[brick.slice] += 1
+        self._stability_scores = None
 
     def undo_add_brick(self) -> None:
         brick = self.bricks[-1]
         self.voxel_occupancy[brick.slice] -= 1
         self.bricks.pop()
+        self._stability_scores = None
 
     def has_out_of_bounds_bricks(self) -> bool:
         return any(not self.brick_in_bounds(brick) for brick in self.bricks)
@@ -182,18 +185,54 @@ class LegoStructure:
             return False  # Supported from above
         return True
 
-    def is_stable(self) -> bool:
+    def valid_brick_positions(self, h: int, w: int) -> np.ndarray:
+        """
+        Returns a boolean array of shape (world_dim, world_dim, world_dim) whose entry (x,y,z) is True iff
+        a brick of dimensions hxw at position (x,y,z) would be in bounds, not collide, and not float.
+        """
+        result = np.zeros_like(self.voxel_occupancy, dtype=bool)
+        if not (0 < h <= self.world_dim and 0 < w <= self.world_dim):
+            return result
+
+        # Count the occupied voxels in the footprint of each in-bounds brick position, using a summed-area table
+        summed_area = np.pad((self.voxel_occupancy > 0).cumsum(0).cumsum(1), ((1, 0), (1, 0), (0, 0)))
+        footprint = summed_area[h:, w:] - summed_area[:-h, w:] - summed_area[h:, :-w] + summed_area[:-h, :-w]
+        footprint_occupied = footprint > 0
+
+        supported = np.zeros_like(footprint_occupied)
+        supported[..., 0] = True  # Supported by ground
+        supported[..., 1:] |= footprint_occupied[..., :-1]  # Supported from below
+        supported[..., :-1] |= footprint_occupied[..., 1:]  # Supported from above
+
+        result[:self.world_dim - h + 1, :self.world_dim - w + 1] = ~footprint_occupied & supported
+        return result
+
+    def is_stable(self, time_limit: float | None = None) -> bool:
+        """
+        :param time_limit: The maximum time in seconds to spend on stability analysis, or None for no limit.
+                           Raises a TimeoutError if the analysis does not finish in time.
+        """
         if self.has_floating_bricks() or self.has_collisions():
             return False
-        return self.stability_scores().max() < 1
-
-    def stability_scores(self) -> np.ndarray:
+        return self.stability_scores(time_limit).max() < 1
+
+    def stability_scores(self, time_limit: float | None = None) -> np.ndarray:
+        """
+        Returns the stability score of each voxel. The scores are computed once and cached until the structure is
+        modified, so the returned array should not be modified.
+        :param time_limit: The maximum time in seconds to spend on stability analysis, or None for no limit.
+                           Raises a TimeoutError if the analysis does not finish in time.
+        """
+        if self._stability_scores is not None:
+            return self._stability_scores
         if self.has_collisions():
             raise ValueError('Cannot compute stability scores - structure has colliding bricks.')
         if self.has_out_of_bounds_bricks():
             raise ValueError('Cannot compute stability scores - structure has out of bounds bricks.')
         scores, _, _, _, _ = stability_score(self.to_json(), lego_library,
-                                             StabilityConfig(world_dimension=(self.world_dim,) * 3))
+                                             StabilityConfig(world_dimension=(self.world_dim,) * 3,
+                                                             time_limit=time_limit))
+        self._stability_scores = scores
         return scores
 
     @classmethod
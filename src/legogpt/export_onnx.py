@@ -0,0 +1,34 @@
+from dataclasses import dataclass, field
+
+from transformers import HfArgumentParser
+
+from legogpt.models import export_onnx
+
+
+@dataclass
+class ExportOnnxConfig:
+    model_name_or_path: str = field(
+        default='AvaLovelace/LegoGPT',
+        metadata={'help': 'The model checkpoint to export, e.g. a fine-tuned LegoGPT checkpoint.'},
+    )
+    output_dir: str = field(
+        default='legogpt_onnx',
+        metadata={'help': 'The directory to which to export the model, its config and its tokenizer.'},
+    )
+    opset_version: int = field(
+        default=17,
+        metadata={'help': 'The ONNX opset version to export to.'},
+    )
+
+
+def main():
+    parser = HfArgumentParser(ExportOnnxConfig)
+    (cfg,) = parser.parse_args_into_dataclasses()
+
+    output_path = export_onnx(cfg.model_name_or_path, cfg.output_dir, cfg.opset_version)
+    print(f'Exported model to {output_path.absolute()}')
+    print(f'Run it with ONNX Runtime by passing --backend onnx --model_name_or_path {cfg.output_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,13 +6,17 @@ from transformers import HfArgumentParser
 
 from legogpt.models import LegoGPT, LegoGPTConfig
 from legogpt.render_lego import render_lego
+from legogpt.result_cache import ResultCache, ResultCacheConfig, normalize_caption
 
 
 def main():
-    parser = HfArgumentParser(LegoGPTConfig)
-    (cfg,) = parser.parse_args_into_dataclasses()
+    parser = HfArgumentParser((LegoGPTConfig, ResultCacheConfig))
+    cfg, cache_cfg = parser.parse_args_into_dataclasses()
 
     legogpt = LegoGPT(cfg)
+    cache = None
+    if cache_cfg.cache_path is not None:
+        cache = ResultCache(cache_cfg.cache_path, cfg, cache_cfg.cache_max_size_mb)
     prompt = input('Enter a prompt, or <Return> to exit: ')
 
     while True:
@@ -33,10 +37,20 @@ def main():
         seed = int(seed) if seed else 42
         transformers.set_seed(seed)
 
-        # Generate LEGO
+        # Generate LEGO, or load it from the cache
         print('Generating...')
         start_time = time.time()
-        output = legogpt(prompt)
+        if cache is not None:
+            prompt = normalize_caption(prompt)
+            output = cache.get(prompt, seed)
+            if output is None:
+                output = _generate_live(legogpt, prompt)
+                if output['degradation_level'] == 'none':  # Degraded outputs depend on timing, so are not cached
+                    cache.put(prompt, seed, output)
+            else:
+                print('Loaded from cache.')
+        else:
+            output = _generate_live(legogpt, prompt)
         end_time = time.time()
 
         # Save results
@@ -53,11 +67,35 @@ def main():
         print('Total # brick rejections:', output['rejection_reasons'].total())
         print('Brick rejection reasons:', dict(output['rejection_reasons']))
         print('Total # regenerations:', output['n_regenerations'])
+        print('Stability checkpoints:', dict(output['stability_checkpoints']))
+        if output.get('degradation_level', 'none') != 'none':
+            print('Ran low on time; degradation level:', output['degradation_level'])
+        if output['speculative_decoding']['draft_tokens'] > 0:
+            print('Draft token acceptance rate:', output['speculative_decoding']['accepted_draft_tokens']
+                  / output['speculative_decoding']['draft_tokens'])
+        if 'trace' in output:
+            print('Time per stage:', ', '.join(f'{stage}={duration:.2f}s' for stage, duration in output['trace'].items()))
         print(f'Saved results to {txt_filename}, {ldr_filename}, and {img_filename}')
         print('--------------------')
 
         prompt = input('Enter another prompt, or <Return> to exit: ')
 
 
+def _generate_live(legogpt: LegoGPT, prompt: str) -> dict:
+    """
+    Generates a LEGO structure, printing each brick as soon as it is added and each rollback as it happens.
+    """
+    output = None
+    for update in legogpt.stream(prompt):
+        if update.kind == 'add':
+            for brick in update.bricks:
+                print(f'  + {brick.to_txt()}', end='')
+        elif update.kind == 'retract':
+            print(f'  Rolled back {len(update.bricks)} bricks, to {update.n_bricks} bricks')
+        else:
+            output = update.output
+    return output
+
+
 if __name__ == '__main__':
     main()
@@ -1,3 +1,6 @@
-from .legogpt import (LegoGPT, LegoGPTConfig,
+from .legogpt import (LegoGPT, LegoGPTConfig, LegoGPTBatch, GenerationEvent, StructureUpdate,
                       create_instruction, create_instruction_zero_shot, create_instruction_few_shot)
-from .llm import LLM
+from .llm import LLM, LLMBackend, LLMState, LLMBatch, LLMBatchState
+from .onnx_llm import OnnxLLM, export_onnx
+from .replay_llm import RecordingLLM, ReplayLLM
+from .tiny_model import create_tiny_model
@@ -1,18 +1,32 @@
+import contextlib
 import copy
 import functools
 import json
+import queue
+import threading
+import time
 import warnings
 from collections import Counter
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable, Literal
+from typing import Callable, Iterator, Literal
 
 import numpy as np
 import torch
-from transformers.generation.logits_process import PrefixConstrainedLogitsProcessor, LogitsProcessorList
 
-from legogpt.data import max_brick_dimension, LegoStructure, LegoBrick
-from .llm import LLM
+from legogpt.data import max_brick_dimension, dimensions_to_brick_id, LegoStructure, LegoBrick
+from .llm import LLM, LLMBackend, LLMState, LLMBatch, LLMBatchState
+from .onnx_llm import OnnxLLM
+from .replay_llm import RecordingLLM, ReplayLLM
+
+_max_caption_tokens = 256  # The number of tokens reserved for the caption when sizing the static KV cache
+_max_decoded_bricks = 2 ** 16  # The number of bricks decoded from token ids that are kept to skip parsing them
+
+# The levels of degradation of a generation as its time budget runs low, from least to most degraded,
+# and the fraction of the time budget left below which each level is reached
+_degradation_levels = ('none', 'fewer_rejections', 'fewer_regenerations', 'stable_prefix')
+_degradation_thresholds = {'fewer_rejections': 0.5, 'fewer_regenerations': 0.25, 'stable_prefix': 0.1}
+_degraded_rejection_fraction = 0.1  # The fraction of max_brick_rejections allowed once rejections are reduced
 
 
 @dataclass
@@ -21,6 +35,33 @@ class LegoGPTConfig:
         default='AvaLovelace/LegoGPT',
         metadata={'help': 'Model checkpoint for weights initialization.'},
     )
+    backend: Literal['hf', 'onnx', 'replay'] = field(
+        default='hf',
+        kw_only=True,
+        metadata={'help': 'The runtime with which to run the LLM: "hf" for HuggingFace Transformers with PyTorch, '
+                          '"onnx" for ONNX Runtime on the CPU, in which case model_name_or_path and '
+                          'draft_model_name_or_path are directories to which models were exported with export_onnx, '
+                          'or "replay" to replay a session recorded with record_path without running a model, '
+                          'in which case model_name_or_path is the recording directory. '
+                          'The ONNX Runtime and replay backends require use_logit_masking=True and do not support '
+                          'batched generation, quantization, KV cache quantization or the static KV cache.'},
+    )
+    record_path: str | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'A directory to which to record the tokens generated by the LLM and the allowed tokens at '
+                          'each step, so that the session can be replayed with backend="replay". '
+                          'Requires use_logit_masking=True, brick_sample_batch_size=1 and best_of_n=1, '
+                          'and is not supported by batched generation.'},
+    )
+    quantization: Literal['none', 'bf16', 'int8', 'int4'] = field(
+        default='none',
+        kw_only=True,
+        metadata={'help': 'The format of the LLM weights: "none" for full precision, "bf16" for bfloat16, '
+                          '"int8" for dynamic int8 quantization of linear layers (CPU only), '
+                          'or "int4" for weight-only int4 quantization of linear layers (requires torchao). '
+                          'Reduces memory use and bandwidth, at some cost in output quality.'},
+    )
     world_dim: int = field(
         default=20,
         kw_only=True,
@@ -38,6 +79,13 @@ class LegoGPTConfig:
         metadata={'help': 'The maximum number of rejections per generated brick during rejection sampling. '
                           'Set to 0 if you want to disable rejection sampling.'},
     )
+    brick_sample_batch_size: int = field(
+        default=1,
+        kw_only=True,
+        metadata={'help': 'The number of candidate bricks to sample in parallel during rejection sampling. '
+                          'The candidates are decoded as one batch, and the first valid candidate is accepted. '
+                          'Set to 1 to sample candidates one at a time.'},
+    )
     use_logit_masking: bool = field(
         default=True,
         kw_only=True,
@@ -45,6 +93,37 @@ class LegoGPTConfig:
                           'to enforce compliance with the LEGO brick syntax. '
                           'If False, the LEGO brick will be checked for validity after generation.'},
     )
+    use_geometric_masking: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to also use logit masking to only allow bricks that are in the brick library '
+                          'and that can be placed in the current LEGO structure without being out of bounds, '
+                          'colliding with other bricks, or floating. Has no effect if use_logit_masking=False.'},
+    )
+    draft_model_name_or_path: str | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'A small model with the same tokenizer, used as a draft model for speculative decoding: '
+                          'it proposes the tokens of each brick, which are then verified by the main model '
+                          'in one forward pass. Only used with use_logit_masking=True and brick_sample_batch_size=1. '
+                          'Does not change the distribution of the generated bricks.'},
+    )
+    use_geometric_draft: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to use speculative decoding with drafts proposed from the geometry of the LEGO '
+                          'structure, without a draft model: likely next bricks are guessed by repeating recent bricks '
+                          'side by side or one layer up, and the main model verifies the rest of the brick '
+                          'in one forward pass. If a draft model is also given, it proposes the draft whenever '
+                          'no guessed brick matches the tokens generated so far. '
+                          'Only used with use_logit_masking=True and brick_sample_batch_size=1. '
+                          'Does not change the distribution of the generated bricks.'},
+    )
+    max_draft_tokens: int = field(
+        default=10,
+        kw_only=True,
+        metadata={'help': 'The maximum number of tokens proposed at once by the draft model during speculative decoding.'},
+    )
     max_regenerations: int = field(
         default=100,
         kw_only=True,
@@ -52,6 +131,46 @@ class LegoGPTConfig:
                           'if it is physically unstable. '
                           'Set to 0 if you want to disable physics-informed rollback.'},
     )
+    time_budget: float | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'The wall-clock time in seconds within which to generate each LEGO structure, '
+                          'or None for no limit. As the budget runs low, generation degrades step by step: '
+                          'with less than half of the budget left, fewer rejections are allowed per brick; '
+                          'with less than a quarter left, no more regenerations are started; and with less than '
+                          'a tenth left, generation stops and the longest stable prefix of the structure is returned. '
+                          'Stability analysis is also limited to the time left. The level reached is reported as '
+                          'degradation_level in the output. With best_of_n > 1, the budget is shared by all n '
+                          'structures; with batched generation, each structure has its own budget.'},
+    )
+    best_of_n: int = field(
+        default=1,
+        kw_only=True,
+        metadata={'help': 'The number of LEGO structures to generate in parallel for each caption, '
+                          'each with its own seed, in one batch. '
+                          'The first structure that is finished and stable is returned, and the others are cancelled. '
+                          'Trades extra compute for lower tail latency than sequential regeneration. '
+                          'Set to 1 to generate one structure at a time.'},
+    )
+    stability_check_interval: int = field(
+        default=0,
+        kw_only=True,
+        metadata={'help': 'Check the stability of the LEGO structure every this many bricks during generation, '
+                          'and roll back as soon as it is unstable instead of finishing the structure first. '
+                          'Each early rollback counts as a regeneration. Set to 0 to disable.'},
+    )
+    stability_check_on_layer: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Check the stability of the LEGO structure during generation whenever a brick is added '
+                          'above all previous bricks, i.e. whenever a new layer is started.'},
+    )
+    stability_check_growth: float = field(
+        default=0.0,
+        kw_only=True,
+        metadata={'help': 'Check the stability of the LEGO structure during generation whenever its number of bricks '
+                          'has grown by this fraction since the last check. Set to 0 to disable.'},
+    )
     temperature: float = field(
         default=0.6,
         kw_only=True,
@@ -85,6 +204,61 @@ class LegoGPTConfig:
         kw_only=True,
         metadata={'help': 'The format of the LEGO-generating instruction to give to the LLM.'},
     )
+    return_trace: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to return a trace of the time spent in each stage of generation '
+                          '(prefill, decode, validation, stability solve, and rollback) with each output.'},
+    )
+    use_prompt_prefix_cache: bool = field(
+        default=True,
+        kw_only=True,
+        metadata={'help': 'Whether to encode the part of the prompt that precedes the caption only once, '
+                          'and reuse its KV cache for every caption.'},
+    )
+    use_static_cache: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to decode with a static KV cache, preallocated with room for the prompt and '
+                          'max_bricks bricks, and a decode step compiled with torch.compile. '
+                          'Compilation happens once, when the model is loaded. Batches of several sequences and '
+                          'sequences that do not fit into the static KV cache fall back to the dynamic KV cache.'},
+    )
+    kv_cache_quantization: Literal['none', 'int8', 'fp8'] = field(
+        default='none',
+        kw_only=True,
+        metadata={'help': 'The format in which to store the keys and values of the dynamic KV cache, including that '
+                          'of batched generation: "none" for the precision of the model, or "int8" or "fp8" for 8 bits '
+                          'with one scale per head and token. Reduces the memory of the KV cache, at some cost in '
+                          'output quality. The static KV cache is not quantized. Only supported by the hf backend.'},
+    )
+
+
+@dataclass(frozen=True)
+class GenerationEvent:
+    """
+    An event during the generation of a LEGO structure, which is passed to the hooks of a LegoGPT model.
+    Each stage of generation is delimited by a pair of events named '<stage>_start' and '<stage>_end', where the stages
+    are 'prefill', 'decode', 'validation', 'stability_solve', and 'rollback'. The other events are 'brick_accepted',
+    'brick_rejected', 'regeneration', and 'degradation', which is emitted when generation steps down to a new
+    degradation level because its time budget is running low.
+    """
+    name: str
+    time: float  # A monotonic timestamp in seconds, from time.perf_counter()
+    data: dict = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class StructureUpdate:
+    """
+    An update to a LEGO structure as it is generated, yielded by LegoGPT.stream(). Updates of kind 'add' add bricks
+    to the end of the structure, and updates of kind 'retract' remove bricks from its end when generation rolls back.
+    The last update has kind 'finished', and carries the output of generation in the same format as LegoGPT.__call__.
+    """
+    kind: Literal['add', 'retract', 'finished']
+    bricks: tuple[LegoBrick, ...] = ()  # The bricks added or retracted
+    n_bricks: int = 0  # The number of bricks in the structure after the update
+    output: dict | None = None
 
 
 class LegoGPT:
@@ -92,14 +266,25 @@ class LegoGPT:
         self.world_dim = cfg.world_dim
         self.max_bricks = cfg.max_bricks
         self.max_brick_rejections = cfg.max_brick_rejections
+        self.brick_sample_batch_size = cfg.brick_sample_batch_size
         self.use_logit_masking = cfg.use_logit_masking
+        self.use_geometric_masking = cfg.use_geometric_masking
         self.max_regenerations = cfg.max_regenerations
+        self.best_of_n = cfg.best_of_n
+        self.time_budget = cfg.time_budget
+        self._deadline = _Deadline()  # The deadline of the current call
+        self._decoded_bricks: dict[str, LegoBrick] = {}  # Bricks decoded from token ids, by their txt format
+        self.stability_check_interval = cfg.stability_check_interval
+        self.stability_check_on_layer = cfg.stability_check_on_layer
+        self.stability_check_growth = cfg.stability_check_growth
         self.temperature = cfg.temperature
         self.temperature_increase = cfg.temperature_increase
         self.max_temperature = cfg.max_temperature
         self.top_k = cfg.top_k
         self.top_p = cfg.top_p
-        self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.return_trace = cfg.return_trace
+        self.hooks: list[Callable[[GenerationEvent], None]] = []
+        self.device = 'cuda' if torch.cuda.is_available() and cfg.backend == 'hf' else 'cpu'
 
         instruction_fns = {
             'legogpt': create_instruction,
@@ -108,69 +293,447 @@ class LegoGPT:
         }
         self.instruction_fn = instruction_fns[cfg.instruction_format]
 
-        self.llm = LLM(cfg.model_name_or_path, self.device)
+        if cfg.record_path is not None and (
+                not cfg.use_logit_masking or cfg.brick_sample_batch_size > 1 or cfg.best_of_n > 1):
+            raise ValueError('Recording requires use_logit_masking=True, brick_sample_batch_size=1 and best_of_n=1')
+
+        if cfg.backend != 'hf' and (not cfg.use_logit_masking or cfg.best_of_n > 1 or cfg.use_static_cache
+                                    or cfg.kv_cache_quantization != 'none'):
+            raise ValueError(f'The {cfg.backend} backend requires use_logit_masking=True and does not support '
+                             f'best_of_n > 1, the static KV cache or KV cache quantization')
+
+        llm_cls = {'hf': LLM, 'onnx': OnnxLLM, 'replay': ReplayLLM}[cfg.backend]
+        self.llm: LLMBackend = llm_cls(cfg.model_name_or_path, self.device, cfg.quantization)
+        self._check_backend_methods(cfg, self.llm)
+        if cfg.record_path is not None:
+            self.llm = RecordingLLM(self.llm, cfg.record_path)
+        if cfg.use_prompt_prefix_cache:
+            self.llm.cache_prompt_prefix(self._build_prompt_prefix())
+        if cfg.use_static_cache:
+            self.llm.enable_static_cache(self._max_sequence_length())
+        if cfg.kv_cache_quantization != 'none':
+            self.llm.enable_kv_cache_quantization(cfg.kv_cache_quantization)
+
+        self.draft_llm = None
+        self.use_geometric_draft = cfg.use_geometric_draft
+        self.max_draft_tokens = cfg.max_draft_tokens
+        self.speculative_stats = Counter()  # Draft tokens proposed and accepted during the current generation
+        if cfg.draft_model_name_or_path is not None:
+            self.draft_llm = llm_cls(cfg.draft_model_name_or_path, self.device, cfg.quantization)
+            if self.draft_llm.tokenizer.get_vocab() != self.llm.tokenizer.get_vocab():
+                raise ValueError('The draft model must have the same vocabulary as the main model')
+            if cfg.use_static_cache:
+                self.draft_llm.enable_static_cache(self._max_sequence_length())
+            if cfg.kv_cache_quantization != 'none':
+                self.draft_llm.enable_kv_cache_quantization(cfg.kv_cache_quantization)
+
+    @staticmethod
+    def _check_backend_methods(cfg: LegoGPTConfig, llm: LLMBackend) -> None:
+        """
+        Checks that the LLM backend implements the methods beyond the LLMBackend protocol that the config uses.
+        """
+        required_methods = [
+            (cfg.use_static_cache, 'use_static_cache', ['enable_static_cache']),
+            (cfg.kv_cache_quantization != 'none', 'kv_cache_quantization', ['enable_kv_cache_quantization']),
+            (cfg.brick_sample_batch_size > 1, 'brick_sample_batch_size > 1', ['expand_batch', 'select_batch_index']),
+            (cfg.draft_model_name_or_path is not None or cfg.use_geometric_draft, 'speculative decoding',
+             ['generate_speculative', 'batch_size']),
+        ]
+        for is_used, option, methods in required_methods:
+            if is_used and not all(hasattr(llm, method) for method in methods):
+                raise ValueError(f'The {cfg.backend} backend does not support {option}')
+
+    def __call__(self, caption: str, time_budget: float | None = None) -> dict:
+        """
+        Generates a LEGO structure based on the given caption.
+        :param caption: A caption for the LEGO structure to be generated.
+        :param time_budget: The time budget of this call in seconds, overriding cfg.time_budget.
+        """
+        return self._call(caption, _Deadline(self.time_budget if time_budget is None else time_budget))
+
+    def stream(self, caption: str, time_budget: float | None = None) -> Iterator[StructureUpdate]:
+        """
+        Generates a LEGO structure like __call__, but yields each brick as soon as it is accepted, and the bricks that
+        are retracted whenever generation rolls back, so that the structure can be shown as it is built.
+        With best_of_n > 1, the bricks are only streamed once generation is finished.
+        Generation runs in a background thread. If the iterator is closed before it is exhausted, generation is
+        cancelled as soon as it next checks its deadline, and the thread is joined.
+        :param caption: A caption for the LEGO structure to be generated.
+        :param time_budget: The time budget of this call in seconds, overriding cfg.time_budget.
+        :return: An iterator of updates to the structure, the last of which has kind 'finished'.
+        """
+        deadline = _Deadline(self.time_budget if time_budget is None else time_budget)
+        updates = queue.Queue()
+        bricks = []  # The bricks streamed so far
+
+        def stream_hook(event: GenerationEvent) -> None:
+            if event.name == 'brick_accepted':
+                bricks.append(self._parse_brick(event.data['brick']))
+                updates.put(StructureUpdate('add', (bricks[-1],), len(bricks)))
+            elif event.name == 'regeneration' and event.data['n_bricks'] < len(bricks):
+                updates.put(StructureUpdate('retract', tuple(bricks[event.data['n_bricks']:]), event.data['n_bricks']))
+                del bricks[event.data['n_bricks']:]
+
+        def generate() -> None:
+            self.add_hook(stream_hook)
+            try:
+                output = self._call(caption, deadline)
+            except BaseException as e:
+                updates.put(e)
+                return
+            finally:
+                self.remove_hook(stream_hook)
+
+            # Stream the difference between the bricks streamed so far and the output, e.g. if it is a stable prefix
+            n_common = next((i for i, (brick, output_brick) in enumerate(zip(bricks, output['lego'].bricks))
+                             if brick != output_brick), min(len(bricks), len(output['lego'])))
+            if n_common < len(bricks):
+                updates.put(StructureUpdate('retract', tuple(bricks[n_common:]), n_common))
+            if n_common < len(output['lego']):
+                updates.put(StructureUpdate('add', tuple(output['lego'].bricks[n_common:]), len(output['lego'])))
+            updates.put(StructureUpdate('finished', n_bricks=len(output['lego']), output=output))
+
+        thread = threading.Thread(target=generate, daemon=True)
+        thread.start()
+        try:
+            while True:
+                update = updates.get()
+                if isinstance(update, BaseException):
+                    raise update
+                yield update
+                if update.kind == 'finished':
+                    break
+        finally:
+            deadline.cancel()
+            thread.join()
+
+    def _call(self, caption: str, deadline: '_Deadline') -> dict:
+        trace = None
+        if self.return_trace:
+            trace = _GenerationTrace()
+            self.add_hook(trace)
+        self._deadline = deadline
+        try:
+            output = self._generate(caption)
+        finally:
+            self._deadline = _Deadline()
+            if trace is not None:
+                self.remove_hook(trace)
+        return output if trace is None else output | {'trace': trace.output()}
+
+    def add_hook(self, hook: Callable[[GenerationEvent], None]) -> None:
+        """
+        Adds a function that is called with each GenerationEvent during generation.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[GenerationEvent], None]) -> None:
+        self.hooks.remove(hook)
+
+    def _emit(self, name: str, **data) -> None:
+        """
+        Calls the hooks with a GenerationEvent of the given name and data, timestamped now.
+        """
+        if self.hooks:
+            event = GenerationEvent(name, time.perf_counter(), data)
+            for hook in self.hooks:
+                hook(event)
+
+    @contextlib.contextmanager
+    def _stage(self, stage: str, **data):
+        """
+        Emits the events that delimit a stage of generation around the body of the with statement,
+        also if the body raises an exception.
+        """
+        self._emit(f'{stage}_start', **data)
+        try:
+            yield
+        finally:
+            self._emit(f'{stage}_end', **data)
+
+    def _is_stable(self, lego: LegoStructure) -> bool:
+        """
+        Returns whether the LEGO structure is stable. Stability analysis is limited to the time left before
+        the deadline, and a structure whose analysis runs out of time is considered unstable.
+        """
+        with self._stage('stability_solve', n_bricks=len(lego)):
+            return _is_stable_before(lego, self._deadline)
+
+    def _remove_unstable_bricks(self, lego: LegoStructure, stable_lego: LegoStructure) -> LegoStructure:
+        """
+        Removes all bricks after the first unstable brick of the LEGO structure. If stability analysis runs out of time,
+        returns stable_lego instead, a prefix of the structure that is known to be stable.
+        """
+        with self._stage('stability_solve', n_bricks=len(lego)):
+            try:
+                return _remove_all_bricks_after_first_unstable_brick(lego, self._deadline)
+            except TimeoutError:
+                return stable_lego
+
+    def _is_degraded(self, level: str) -> bool:
+        """
+        Steps down the degradation ladder according to the time left before the deadline,
+        and returns whether generation has reached the given degradation level.
+        """
+        if self._deadline.update_level():
+            self._emit('degradation', level=self._deadline.level)
+        return _degradation_levels.index(self._deadline.level) >= _degradation_levels.index(level)
+
+    def _max_brick_rejections(self) -> int:
+        if self._is_degraded('fewer_rejections'):
+            return int(self.max_brick_rejections * _degraded_rejection_fraction)
+        return self.max_brick_rejections
+
+    def _generate(self, caption: str) -> dict:
+        if self.best_of_n > 1:
+            return self._generate_best_of_n(caption, self.best_of_n, deadline=self._deadline)[0]
 
-    def __call__(self, caption: str) -> dict:
         lego = None
         starting_lego = LegoStructure([])
+        stable_lego = starting_lego  # The longest prefix of the structure that is known to be stable
+        llm_states = []
         rejection_reasons = Counter()
+        stability_checkpoints = Counter()
         regeneration_num = None
+        self.speculative_stats = Counter()
 
-        # Generate LEGO structure. If it is unstable, remove all bricks after the first unstable brick and regenerate.
+        # Generate LEGO structure. If it is unstable, remove all bricks after the first unstable brick and regenerate,
+        # rolling back the KV cache to the end of the last remaining brick instead of re-encoding the prompt.
         for regeneration_num in range(self.max_regenerations + 1):
-            lego, rejection_reasons_lego = self._generate_structure(caption, starting_lego=starting_lego)
+            lego, rejection_reasons_lego = self._generate_structure(
+                caption, starting_lego, llm_states,
+                stability_checkpoints=stability_checkpoints if regeneration_num < self.max_regenerations else None,
+            )
             rejection_reasons.update(rejection_reasons_lego)
-            if lego.is_stable():
+            if self._is_stable(lego):
+                break
+            if self._is_degraded('fewer_regenerations'):  # No time left to regenerate, so return a stable prefix
+                lego = self._remove_unstable_bricks(lego, stable_lego)
                 break
             if regeneration_num == self.max_regenerations:
                 if self.max_regenerations > 0:
                     warnings.warn(f'Failed to generate a stable structure after {regeneration_num + 1} attempts.\n')
                 break
-            starting_lego = _remove_all_bricks_after_first_unstable_brick(lego)
+            starting_lego = stable_lego = self._remove_unstable_bricks(lego, stable_lego)
+            stability_checkpoints['discarded_bricks'] += len(lego) - len(starting_lego)
+            del llm_states[len(starting_lego) + 1:]
+            self._emit('regeneration', n_regenerations=regeneration_num + 1, n_bricks=len(starting_lego))
 
         return {
             'lego': lego,
             'rejection_reasons': rejection_reasons,
             'n_regenerations': regeneration_num,
+            'stability_checkpoints': stability_checkpoints,
+            'speculative_decoding': self.speculative_stats,
+            'degradation_level': self._deadline.level,
         }
 
     def _generate_structure(
             self,
             caption: str,
             starting_lego: LegoStructure = LegoStructure([]),
+            llm_states: list[LLMState] | None = None,
+            stability_checkpoints: Counter | None = None,
     ) -> (LegoStructure, Counter):
         """
         Generates a LEGO structure based on the given caption, starting with a partial LEGO structure.
         :param caption: A caption for the LEGO structure to be generated.
         :param starting_lego: A partial LEGO structure to which the generated bricks will be added.
+        :param llm_states: The LLM states saved by a previous call, one after the prompt and one after each brick.
+                           If not empty, its last state must be the one after the last brick of starting_lego;
+                           the LLM is rolled back to it instead of encoding the prompt again.
+                           The states after the generated bricks are appended to it.
+        :param stability_checkpoints: If given, the stability of the structure is checked during generation according
+                                      to the stability checkpoint policy, and generation stops as soon as the structure
+                                      is unstable. The number of checks and of early stops are counted in it.
         :return: A tuple containing the generated LEGO structure and a brick rejection reasons.
         """
         starting_lego = copy.deepcopy(starting_lego)
+        if llm_states is None:
+            llm_states = []
+        if llm_states:
+            with self._stage('rollback', n_bricks=len(starting_lego)):
+                self.llm.rollback_to_saved_state(llm_states[-1])
+        else:
+            with self._stage('prefill'):
+                self.llm.prefill(self._build_prompt(caption, starting_lego))
+                llm_states.append(self.llm.save_state())
+
+        # Generate bricks with rejection sampling
+        rejection_reasons = Counter()
+        n_bricks_checked = len(starting_lego)
+        for _ in range(self.max_bricks):
+            if self._is_degraded('stable_prefix'):  # Out of time, so stop adding bricks
+                break
+            brick, rejection_reasons_brick = self.generate_brick_with_rejection_sampling(lego=starting_lego)
+            if not brick:  # EOS token was generated
+                break
+            rejection_reasons.update(rejection_reasons_brick)
+            starting_lego.add_brick(self._parse_brick(brick))
+            llm_states.append(self.llm.save_state())
+            self._emit('brick_accepted', brick=brick, n_bricks=len(starting_lego))
+
+            # Stop early if the structure is unstable at a stability checkpoint
+            if stability_checkpoints is not None and self._is_stability_checkpoint(starting_lego, n_bricks_checked):
+                n_bricks_checked = len(starting_lego)
+                stability_checkpoints['checks'] += 1
+                if not self._is_stable(starting_lego):
+                    stability_checkpoints['early_rollbacks'] += 1
+                    break
+
+        return starting_lego, rejection_reasons
+
+    def _is_stability_checkpoint(self, lego: LegoStructure, n_bricks_checked: int) -> bool:
+        """
+        Returns whether to check the stability of the LEGO structure during generation, right after a brick was added.
+        :param lego: The LEGO structure, including the brick that was just added.
+        :param n_bricks_checked: The number of bricks in the structure when its stability was last checked,
+                                 or when generation started.
+        """
+        n_bricks = len(lego)
+        if self.stability_check_interval > 0 and n_bricks - n_bricks_checked >= self.stability_check_interval:
+            return True
+        if self.stability_check_growth > 0 and n_bricks >= max(n_bricks_checked, 1) * (1 + self.stability_check_growth):
+            return True
+        if self.stability_check_on_layer and n_bricks > 1:
+            return lego.bricks[-1].z > max(brick.z for brick in lego.bricks[:-1])
+        return False
 
-        # Construct prompt
-        starting_lego_txt = starting_lego.to_txt()
+    def _build_prompt(self, caption: str, starting_lego: LegoStructure = LegoStructure([])) -> torch.Tensor:
+        """
+        Builds the token ids of the prompt for generating a LEGO structure, starting with a partial LEGO structure.
+        The token ids of the partial structure are appended to the prompt of the caption without tokenizing it,
+        if the brick token tables can be used.
+        """
+        if len(starting_lego) == 0:
+            return torch.tensor(self._build_caption_prompt(caption))[None]
+        if not self._use_brick_token_tables:
+            return self._tokenize_prompt(caption, starting_lego.to_txt())
+        prompt_ids = np.concatenate([self._build_caption_prompt(caption), self._bricks_token_ids(starting_lego.bricks)])
+        return torch.from_numpy(prompt_ids)[None]
+
+    @functools.lru_cache(maxsize=256)
+    def _build_caption_prompt(self, caption: str) -> np.ndarray:
+        """
+        Builds the token ids of the prompt for generating a LEGO structure from scratch.
+        The returned array is cached, so it must not be modified.
+        """
+        prompt_ids = self._tokenize_prompt(caption)[0].numpy()
+        prompt_ids.flags.writeable = False
+        return prompt_ids
+
+    def _tokenize_prompt(self, caption: str, starting_lego_txt: str = '') -> torch.Tensor:
+        """
+        Tokenizes the prompt for generating a LEGO structure with the chat template,
+        starting with a partial LEGO structure in txt format.
+        """
         messages = [
             {'role': 'system', 'content': 'You are a helpful assistant.'},
             {'role': 'user', 'content': self.instruction_fn(caption)},
         ]
         if starting_lego_txt:  # Continue generation from a partial structure
             messages.append({'role': 'assistant', 'content': starting_lego_txt})
-            prompt = self.llm.tokenizer.apply_chat_template(messages, continue_final_message=True, return_tensors='pt')
+            return self.llm.tokenizer.apply_chat_template(messages, continue_final_message=True, return_tensors='pt')
         else:
-            prompt = self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors='pt')
+            return self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors='pt')
 
-        # Generate bricks with rejection sampling
-        rejection_reasons = Counter()
-        for brick_num in range(self.max_bricks):
-            brick, rejection_reasons_brick = self.generate_brick_with_rejection_sampling(
-                prompt if brick_num == 0 else None, lego=starting_lego
-            )
-            if not brick:  # EOS token was generated
-                break
-            rejection_reasons.update(rejection_reasons_brick)
-            starting_lego.add_brick(LegoBrick.from_txt(brick))
+    @functools.cached_property
+    def _use_brick_token_tables(self) -> bool:
+        """
+        Whether bricks can be converted to and from token IDs with the token tables instead of the tokenizer:
+        every number and separator in a brick must be a single token, and the chat template must tokenize the prompt
+        with a partial LEGO structure as the prompt of the caption followed by the token IDs of the bricks.
+        """
+        bricks = [LegoBrick(h=2, w=4, x=0, y=0, z=0), LegoBrick(h=1, w=2, x=self.world_dim - 1, y=1, z=1)]
+        prompt_ids = self._tokenize_prompt('A', ''.join(brick.to_txt() for brick in bricks))[0].tolist()
+        try:
+            return prompt_ids == self._build_caption_prompt('A').tolist() + self._bricks_token_ids(bricks).tolist()
+        except ValueError:  # Numbers or separators are not single tokens
+            return False
 
-        return starting_lego, rejection_reasons
+    def _max_sequence_length(self) -> int:
+        """
+        Returns the number of tokens in the prompt of an empty LEGO structure with a caption of up to
+        _max_caption_tokens tokens, followed by max_bricks bricks.
+        """
+        return self._build_prompt('').shape[1] + _max_caption_tokens + self.max_bricks * len(self._brick_template)
+
+    def _build_prompt_prefix(self) -> torch.Tensor:
+        """
+        Builds the token ids of the longest prefix shared by the prompts of all captions,
+        i.e. the part of the prompt that precedes the caption.
+        """
+        prompt_1, prompt_2 = (self._build_prompt(caption)[0] for caption in ('A', 'B'))
+        length = min(len(prompt_1), len(prompt_2))
+        prefix_length = int(torch.cumprod(prompt_1[:length] == prompt_2[:length], dim=0).sum())
+        return prompt_1[None, :prefix_length]
+
+    def generate_batch(
+            self,
+            captions: list[str],
+            seeds: list[int | None] | None = None,
+            time_budget: float | None = None,
+    ) -> list[dict]:
+        """
+        Generates a LEGO structure for each caption, advancing all structures together in one batch.
+        See LegoGPTBatch for how batched generation differs from calling this object on each caption.
+        :param captions: The captions of the LEGO structures to be generated.
+        :param seeds: The random seed with which to generate each structure. If None, or for each seed that is None,
+                      seeds are drawn from torch's global random number generator.
+        :param time_budget: The time budget of each structure in seconds, overriding cfg.time_budget.
+        :return: The output for each caption, in the same format as __call__.
+        """
+        batch = LegoGPTBatch(self)
+        ids = batch.add(captions, seeds, time_budget)
+
+        outputs = {}
+        while len(batch) > 0:
+            outputs.update(batch.step())
+        return [outputs[id_] for id_ in ids]
+
+    def generate_best_of_n(
+            self,
+            caption: str,
+            n: int,
+            seeds: list[int | None] | None = None,
+            n_stable: int = 1,
+            time_budget: float | None = None,
+    ) -> list[dict]:
+        """
+        Generates n LEGO structures for the same caption, advancing all structures together in one batch, each with
+        its own seed. As soon as n_stable of the structures are finished and stable, the others are cancelled.
+        See LegoGPTBatch for how batched generation differs from calling this object on the caption.
+        :param caption: The caption of the LEGO structures to be generated.
+        :param n: The number of LEGO structures to generate in parallel.
+        :param seeds: The random seed with which to generate each structure. If None, or for each seed that is None,
+                      seeds are drawn from torch's global random number generator.
+        :param n_stable: The number of stable structures to wait for before cancelling the others.
+        :param time_budget: The time budget shared by all n structures in seconds, overriding cfg.time_budget.
+        :return: The outputs of the finished structures, in the same format as __call__: first the stable structures,
+                 in the order in which they finished, then the unstable ones. The first output is the best structure;
+                 the others can be used as variants.
+        """
+        deadline = _Deadline(self.time_budget if time_budget is None else time_budget)
+        return self._generate_best_of_n(caption, n, seeds, n_stable, deadline)
+
+    def _generate_best_of_n(
+            self,
+            caption: str,
+            n: int,
+            seeds: list[int | None] | None = None,
+            n_stable: int = 1,
+            deadline: '_Deadline | None' = None,
+    ) -> list[dict]:
+        batch = LegoGPTBatch(self)
+        batch._add([caption] * n, seeds, [deadline or _Deadline()] * n)
+
+        stable_outputs = []
+        unstable_outputs = []
+        while len(batch) > 0 and len(stable_outputs) < n_stable:
+            for output in batch.step().values():
+                is_stable = _is_stable_before(output['lego'], deadline)
+                (stable_outputs if is_stable else unstable_outputs).append(output)
+        return stable_outputs + unstable_outputs
 
     def generate_brick_with_rejection_sampling(
             self,
@@ -180,23 +743,30 @@ class LegoGPT:
         """
         Generates a LEGO brick to add to the LEGO structure, using rejection sampling to ensure the brick is valid.
         """
+        if self.brick_sample_batch_size > 1:
+            return self._generate_brick_with_batched_rejection_sampling(prompt, lego)
+
         rejection_reasons = Counter()
         rejected_bricks = set()
+        banned_bricks = _RejectedBrickTrie(self._build_brick_token_mask_fn(lego)) if self.use_logit_masking else None
 
         brick = ''
         temperature = self.temperature
-        for generation_num in range(self.max_brick_rejections + 1):
+        max_brick_rejections = self._max_brick_rejections()
+        for generation_num in range(max_brick_rejections + 1):
             self.llm.save_state()
-            brick = self.generate_brick(prompt, temperature=temperature)
+            with self._stage('decode'):
+                brick = self.generate_brick(prompt, temperature=temperature, lego=lego, banned_bricks=banned_bricks)
             if not brick:  # EOS token was generated
                 break
 
             # Check if the generated brick is valid
-            add_brick_result = self._try_adding_brick(brick, lego, rejected_bricks)
+            with self._stage('validation'):
+                add_brick_result = self._try_adding_brick(brick, lego, rejected_bricks)
             if add_brick_result == 'success':
                 break
-            if generation_num == self.max_brick_rejections:
-                if self.max_brick_rejections > 0:
+            if generation_num == max_brick_rejections:
+                if max_brick_rejections > 0:
                     warnings.warn(f'Failed to generate a valid brick after {generation_num + 1} attempts.\n'
                                   f'Last generated brick: {brick}\n'
                                   f'Reasons for rejection: {rejection_reasons}\n'
@@ -204,17 +774,81 @@ class LegoGPT:
                 break
 
             # Reset if brick is invalid
-            self.llm.rollback_to_saved_state()
+            self._emit('brick_rejected', brick=brick, reason=add_brick_result)
+            with self._stage('rollback', n_bricks=len(lego)):
+                self.llm.rollback_to_saved_state()
             rejection_reasons.update([add_brick_result])
             rejected_bricks.add(brick)
+            self._ban_brick(banned_bricks, brick)
+            if self._is_degraded('stable_prefix'):  # Out of time, so end the structure
+                return '', rejection_reasons
 
             if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
                 temperature = min(self.max_temperature, temperature + self.temperature_increase)
 
         return brick, rejection_reasons
 
-    @staticmethod
-    def _try_adding_brick(brick_str: str, lego: LegoStructure, rejected_bricks: set[str]) -> str:
+    def _generate_brick_with_batched_rejection_sampling(
+            self,
+            prompt: str | None = None,
+            lego: LegoStructure = LegoStructure([]),
+    ) -> (str, Counter):
+        """
+        Generates a LEGO brick to add to the LEGO structure, using rejection sampling to ensure the brick is valid.
+        Candidate bricks are sampled in batches of size brick_sample_batch_size from the same KV cache state,
+        and the first valid candidate in each batch is accepted.
+        """
+        rejection_reasons = Counter()
+        rejected_bricks = set()
+        banned_bricks = _RejectedBrickTrie(self._build_brick_token_mask_fn(lego)) if self.use_logit_masking else None
+
+        # Encode the prompt once, so that all candidates can share its KV cache state
+        if prompt is not None:
+            with self._stage('prefill'):
+                self.llm.prefill(prompt)
+
+        temperature = self.temperature
+        max_brick_rejections = self._max_brick_rejections()
+        generation_num = 0
+        while True:
+            batch_size = min(self.brick_sample_batch_size, max_brick_rejections + 1 - generation_num)
+            self.llm.save_state()
+            with self._stage('decode'):
+                self.llm.expand_batch(batch_size)
+                bricks = self.generate_bricks(temperature=temperature, lego=lego, banned_bricks=banned_bricks)
+
+            for batch_idx, brick in enumerate(bricks):
+                # Check if the generated brick is valid. An empty brick means the EOS token was generated.
+                with self._stage('validation'):
+                    add_brick_result = self._try_adding_brick(brick, lego, rejected_bricks) if brick else 'success'
+                if add_brick_result == 'success':
+                    self.llm.select_batch_index(batch_idx)
+                    return brick, rejection_reasons
+                if generation_num == max_brick_rejections:
+                    if max_brick_rejections > 0:
+                        warnings.warn(f'Failed to generate a valid brick after {generation_num + 1} attempts.\n'
+                                      f'Last generated brick: {brick}\n'
+                                      f'Reasons for rejection: {rejection_reasons}\n'
+                                      f'Lego structure: {lego.to_txt()}\n')
+                    self.llm.select_batch_index(batch_idx)
+                    return brick, rejection_reasons
+
+                self._emit('brick_rejected', brick=brick, reason=add_brick_result)
+                rejection_reasons.update([add_brick_result])
+                rejected_bricks.add(brick)
+                self._ban_brick(banned_bricks, brick)
+                generation_num += 1
+
+                if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
+                    temperature = min(self.max_temperature, temperature + self.temperature_increase)
+
+            # Reset if all bricks in the batch are invalid
+            with self._stage('rollback', n_bricks=len(lego)):
+                self.llm.rollback_to_saved_state()
+            if self._is_degraded('stable_prefix'):  # Out of time, so end the structure
+                return '', rejection_reasons
+
+    def _try_adding_brick(self, brick_str: str, lego: LegoStructure, rejected_bricks: set[str]) -> str:
         """
         Tries to add the brick, represented by a string, to the given LEGO structure.
         Returns the result: 'success' if the add was successful, and the failure reason otherwise.
@@ -223,7 +857,7 @@ class LegoGPT:
             return 'already_rejected'
 
         try:
-            brick = LegoBrick.from_txt(brick_str)
+            brick = self._parse_brick(brick_str)
         except ValueError:  # Brick is badly formatted
             return 'ill_formatted'
         try:
@@ -237,11 +871,29 @@ class LegoGPT:
             return 'collision'
         return 'success'
 
-    def generate_brick(self, prompt: str | None = None, temperature: float | None = None) -> str:
+    def generate_brick(
+            self,
+            prompt: str | None = None,
+            temperature: float | None = None,
+            lego: LegoStructure | None = None,
+            banned_bricks: '_RejectedBrickTrie | None' = None,
+    ) -> str:
+        return self.generate_bricks(prompt, temperature, lego, banned_bricks)[0]
+
+    def generate_bricks(
+            self,
+            prompt: str | None = None,
+            temperature: float | None = None,
+            lego: LegoStructure | None = None,
+            banned_bricks: '_RejectedBrickTrie | None' = None,
+    ) -> list[str]:
+        """
+        Generates one LEGO brick for each sequence in the LLM's current batch.
+        """
         if temperature is None:
             temperature = self.temperature
         if self.use_logit_masking:
-            return self._generate_brick_with_logit_masking(prompt, temperature)
+            return self._generate_brick_with_logit_masking(prompt, temperature, lego, banned_bricks)
         else:
             return self._generate_brick_no_logit_masking(prompt, temperature)
 
@@ -249,11 +901,12 @@ class LegoGPT:
             self,
             prompt: str | None = None,
             temperature: float | None = None,
-    ) -> str:
+    ) -> list[str]:
         """
         Generates a LEGO brick in txt format without logit masking.
         :param prompt: The prompt to be given to the LLM preceding brick generation.
-        :return: A LEGO brick in txt format, or the empty string if generation is finished.
+        :return: For each sequence in the batch, a LEGO brick in txt format,
+                 or the empty string if generation is finished.
         """
         if temperature is None:
             temperature = self.temperature
@@ -266,72 +919,764 @@ class LegoGPT:
             top_k=self.top_k,
             top_p=self.top_p,
         )
-        return self.llm.tokenizer.decode(result_ids, skip_special_tokens=True)
+        return self._decode_bricks(torch.atleast_2d(result_ids))
 
     def _generate_brick_with_logit_masking(
             self,
             prompt: str | None = None,
             temperature: float | None = None,
-    ) -> str:
+            lego: LegoStructure | None = None,
+            banned_bricks: '_RejectedBrickTrie | None' = None,
+    ) -> list[str]:
         """
         Generates a LEGO brick in txt format, using logit masking to enforce compliance with the LEGO brick syntax.
         WARNING: Assumes each number in the brick dimensions and positions is represented by 1 token.
         :param prompt: The prompt to be given to the LLM preceding brick generation.
-        :return: A LEGO brick in txt format, or the empty string if generation is finished.
+        :param lego: The LEGO structure to which the brick will be added. If given and use_geometric_masking=True,
+                     logit masking also only allows bricks that can be validly placed in the structure.
+        :param banned_bricks: The bricks already rejected at this position, which logit masking does not allow.
+                              Its token mask function replaces the one built for lego.
+        :return: For each sequence in the batch, a LEGO brick in txt format,
+                 or the empty string if generation is finished.
         """
         if temperature is None:
             temperature = self.temperature
 
+        allowed_token_mask_fn = banned_bricks if banned_bricks is not None else self._build_brick_token_mask_fn(lego)
+
+        use_speculative_decoding = self.draft_llm is not None or (self.use_geometric_draft and lego is not None)
+        if use_speculative_decoding and (prompt is not None or self.llm.batch_size == 1):
+            result_ids = self.llm.generate_speculative(
+                self._build_propose_fn(allowed_token_mask_fn, temperature, lego),
+                allowed_token_mask_fn,
+                max_new_tokens=len(self._brick_template),
+                prompt=prompt,
+                temperature=temperature,
+                stats=self.speculative_stats,
+            )
+        else:
+            result_ids = self.llm.generate_constrained(
+                allowed_token_mask_fn,
+                max_new_tokens=len(self._brick_template),
+                prompt=prompt,
+                temperature=temperature,
+            )
+        return self._decode_bricks(result_ids)
+
+    def _build_propose_fn(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            temperature: float,
+            lego: LegoStructure | None = None,
+    ) -> Callable[[torch.Tensor, torch.Tensor, int], tuple[torch.Tensor, torch.Tensor | None]]:
+        """
+        Builds a function that proposes draft tokens for speculative decoding: the rest of a guessed brick
+        if use_geometric_draft=True and one matches the tokens generated so far, and otherwise tokens sampled
+        from the draft model, if any.
+        """
+        geometric_propose_fn = self._build_geometric_propose_fn(lego) if self.use_geometric_draft else None
+        draft_model_propose_fn = (self._build_draft_model_propose_fn(allowed_token_mask_fn, temperature)
+                                  if self.draft_llm is not None else None)
+
+        def propose_fn(input_ids: torch.Tensor, generated_ids: torch.Tensor, max_draft_tokens: int):
+            if geometric_propose_fn is not None:
+                draft_ids, draft_probs = geometric_propose_fn(input_ids, generated_ids, max_draft_tokens)
+                if draft_ids.shape[1] > 0 or draft_model_propose_fn is None:
+                    return draft_ids, draft_probs
+            return draft_model_propose_fn(input_ids, generated_ids, max_draft_tokens)
+
+        return propose_fn
+
+    def _build_draft_model_propose_fn(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            temperature: float,
+    ) -> Callable[[torch.Tensor, torch.Tensor, int], tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Builds a function that proposes draft tokens for speculative decoding by sampling from the draft model,
+        subject to the same logit masking as the main model.
+        """
+        def propose_fn(input_ids: torch.Tensor, generated_ids: torch.Tensor, max_draft_tokens: int):
+            return self.draft_llm.propose_draft(
+                input_ids, generated_ids, min(max_draft_tokens, self.max_draft_tokens),
+                allowed_token_mask_fn, temperature,
+            )
+
+        return propose_fn
+
+    def _build_geometric_propose_fn(
+            self,
+            lego: LegoStructure,
+    ) -> Callable[[torch.Tensor, torch.Tensor, int], tuple[torch.Tensor, None]]:
+        """
+        Builds a function that proposes draft tokens for speculative decoding without a draft model, by guessing
+        the next brick from the recent bricks of the LEGO structure. The draft is the rest of the first guessed brick
+        that begins with the tokens generated so far, or empty if there is none. The draft is deterministic,
+        so no draft probabilities are returned.
+        """
+        @functools.cache
+        def guessed_brick_ids() -> torch.Tensor:
+            bricks = _guess_next_bricks(lego)
+            if not bricks:
+                return torch.zeros((0, len(self._brick_template)), dtype=torch.long, device=self.device)
+            return torch.from_numpy(self._bricks_token_ids(bricks).reshape(len(bricks), -1)).to(self.device)
+
+        def propose_fn(input_ids: torch.Tensor, generated_ids: torch.Tensor, max_draft_tokens: int):
+            n_generated = generated_ids.shape[1]
+            for brick_ids in guessed_brick_ids():
+                if torch.equal(brick_ids[:n_generated], generated_ids[0]):
+                    return brick_ids[None, n_generated:n_generated + max_draft_tokens], None
+            return generated_ids[:, :0], None
+
+        return propose_fn
+
+    def _brick_token_ids(self, brick: LegoBrick) -> list[int]:
+        """
+        Returns the token IDs of a brick in txt format, as generated with logit masking.
+        """
+        return self._bricks_token_ids([brick]).tolist()
+
+    def _bricks_token_ids(self, bricks: list[LegoBrick]) -> np.ndarray:
+        """
+        Returns the token IDs of a sequence of bricks in txt format, as generated with logit masking,
+        looked up in the token tables without tokenizing them.
+        :return: The token IDs, of shape (len(bricks) * len(self._brick_template),).
+        """
+        fields = np.array([(brick.h, brick.w, brick.x, brick.y, brick.z) for brick in bricks], dtype=np.int64)
+        number_token_ids = self._number_token_id_table
+        if fields.size > 0 and fields.max() >= len(number_token_ids):
+            raise ValueError('A number in the bricks is larger than the largest number in a brick')
+        token_ids = np.empty((len(bricks), len(self._brick_template)), dtype=np.int64)
+        token_ids[:, 0::2] = number_token_ids[fields.reshape(len(bricks), -1)]
+        token_ids[:, 1::2] = self._separator_token_ids
+        return token_ids.reshape(-1)
+
+    def _token_ids_to_bricks(self, result_ids: np.ndarray) -> list[LegoBrick | None]:
+        """
+        Converts a batch of token IDs of bricks in txt format, as generated with logit masking, to bricks,
+        by looking them up in the token tables without decoding them.
+        :param result_ids: The token IDs, of shape (batch_size, n_tokens).
+        :return: For each sequence in the batch, the brick, or None if its token IDs are not a brick as generated
+                 with logit masking, e.g. because it ends with the EOS token.
+        """
+        if result_ids.shape[1] != len(self._brick_template):
+            return [None] * len(result_ids)
+        token_values = self._token_value_table[np.minimum(result_ids[:, 0::2], len(self._token_value_table) - 1)]
+        is_brick = ((token_values >= 0).all(axis=1)
+                    & (result_ids[:, 0::2] < len(self._token_value_table)).all(axis=1)
+                    & (result_ids[:, 1::2] == self._separator_token_ids).all(axis=1))
+        return [LegoBrick(h=h, w=w, x=x, y=y, z=z) if is_brick_ else None
+                for is_brick_, (h, w, x, y, z) in zip(is_brick.tolist(), token_values.tolist())]
+
+    def _parse_brick(self, brick: str) -> LegoBrick:
+        """
+        Converts a brick in txt format to a brick, without parsing it if it was decoded from token IDs.
+        """
+        return self._decoded_bricks.get(brick) or LegoBrick.from_txt(brick)
+
+    def _ban_brick(self, banned_bricks: '_RejectedBrickTrie | None', brick: str) -> None:
+        """
+        Adds a rejected brick to the bricks that logit masking does not allow, if it is well formatted.
+        """
+        if banned_bricks is None:
+            return
+        try:
+            banned_bricks.ban(self._brick_token_ids(self._parse_brick(brick)))
+        except ValueError:  # Brick is badly formatted
+            pass
+
+    def _decode_bricks(self, result_ids: torch.Tensor) -> list[str]:
+        """
+        Decodes a batch of generated token ids into LEGO bricks in txt format.
+        Tokens after the first EOS token in each sequence are ignored.
+        """
+        if len(self._decoded_bricks) > _max_decoded_bricks:
+            self._decoded_bricks.clear()
+
+        result_ids = result_ids.cpu().numpy()
+        if self._use_brick_token_tables:
+            decoded_bricks = self._token_ids_to_bricks(result_ids)
+        else:
+            decoded_bricks = [None] * len(result_ids)
+
+        bricks = []
+        for brick_ids, brick in zip(result_ids, decoded_bricks):
+            if brick is not None:  # Skip the tokenizer for bricks generated with logit masking
+                bricks.append(brick.to_txt())
+                self._decoded_bricks[bricks[-1]] = brick
+                continue
+            eos_idxs = np.flatnonzero(brick_ids == self.llm.tokenizer.eos_token_id)
+            if len(eos_idxs) > 0:
+                brick_ids = brick_ids[:eos_idxs[0]]
+            bricks.append(self.llm.tokenizer.decode(brick_ids, skip_special_tokens=True))
+        return bricks
+
+    @functools.cached_property
+    def _brick_template(self) -> list[tuple[str, ...]]:
+        """
+        The allowed strings for each token of a brick, which has the format "hxw (x,y,z)\n".
+        """
         allowed_dims = tuple(str(i) for i in range(1, max_brick_dimension + 1))
         allowed_posns = tuple(str(i) for i in range(self.world_dim))
-
-        # Generate tokens one by one to fit the format "hxw (x,y,z)\n"
-        result_ids = []
-        for allowed_strs in [
+        return [
             allowed_dims + (self.llm.tokenizer.eos_token,), ('x',), allowed_dims,
             (' (',), allowed_posns, (',',), allowed_posns, (',',), allowed_posns, (')\n',),
-        ]:
-            next_token_id = self.llm(
-                prompt,
-                return_as_ids=True,
-                max_new_tokens=1,
-                temperature=temperature,
-                top_k=None,
-                top_p=None,
-                logits_processor=self._build_allow_tokens_logits_processor(allowed_strs)
-            )[0]
-            result_ids.append(next_token_id)
+        ]
 
-            if next_token_id == self.llm.tokenizer.eos_token_id:  # Generation is finished
-                break
-            if prompt is not None:
-                prompt = None  # Only use prompt on first iteration; continue generation thereafter
+    @functools.cache
+    def _build_allowed_token_mask_fn(self) -> Callable[[int, torch.Tensor], torch.Tensor]:
+        """
+        Builds a function that returns a mask of allowed token IDs for each token of a brick,
+        to be used by LLM.generate_constrained. The masks for all token positions are precomputed.
+        """
+        masks = [self._build_allowed_token_mask(allowed_strs) for allowed_strs in self._brick_template]
 
-        return self.llm.tokenizer.decode(result_ids, skip_special_tokens=True)
+        def allowed_token_mask_fn(idx: int, _: torch.Tensor) -> torch.Tensor:
+            return masks[idx]
 
-    @functools.cache
-    def _build_allow_tokens_logits_processor(self, allowed_strs: tuple[str]) -> LogitsProcessorList:
+        return allowed_token_mask_fn
+
+    def _build_brick_token_mask_fn(
+            self,
+            lego: LegoStructure | None = None,
+    ) -> Callable[[int, torch.Tensor], torch.Tensor]:
         """
-        Builds a logits processor that constrains the next token to be one of the allowed strings.
+        Builds a function that returns a mask of allowed token IDs for each token of a brick to be added to the LEGO
+        structure: a geometric mask if the structure is given and use_geometric_masking=True, and a syntax mask otherwise.
         """
-        return LogitsProcessorList(
-            [PrefixConstrainedLogitsProcessor(self._build_allowed_token_ids_fn(allowed_strs), num_beams=1)]
-        )
+        if self.use_geometric_masking and lego is not None:
+            return self._build_geometric_token_mask_fn(lego)
+        return self._build_allowed_token_mask_fn()
+
+    def _build_geometric_token_mask_fn(self, lego: LegoStructure) -> Callable[[int, torch.Tensor], torch.Tensor]:
+        """
+        Builds a function that returns a mask of allowed token IDs for each token of a brick, like
+        _build_allowed_token_mask_fn, but which also only allows bricks that are in the brick library and
+        that can be placed in the given LEGO structure without being out of bounds, colliding, or floating.
+        The dimensions and coordinates generated so far determine which values are allowed for the next one.
+        """
+        syntax_mask_fn = self._build_allowed_token_mask_fn()
+        dims = range(1, max_brick_dimension + 1)
+
+        @functools.cache
+        def valid_brick_positions(h: int, w: int) -> np.ndarray:
+            try:
+                dimensions_to_brick_id(h, w)
+            except ValueError:  # Brick is not in library
+                return np.zeros_like(lego.voxel_occupancy, dtype=bool)
+            return lego.valid_brick_positions(h, w)[:self.world_dim, :self.world_dim, :self.world_dim]
+
+        @functools.cache
+        def allowed_values(idx: int, prev_values: tuple[int, ...]) -> tuple[int, ...] | None:
+            """
+            Returns the allowed values of the number at index idx of the brick, given the previous numbers.
+            """
+            match idx, prev_values:
+                case 0, ():  # h
+                    return tuple(h for h in dims if any(valid_brick_positions(h, w).any() for w in dims))
+                case 2, (h,):  # w
+                    return tuple(w for w in dims if valid_brick_positions(h, w).any())
+                case 4, (h, w):  # x
+                    return tuple(np.flatnonzero(valid_brick_positions(h, w).any(axis=(1, 2))))
+                case 6, (h, w, x):  # y
+                    return tuple(np.flatnonzero(valid_brick_positions(h, w)[x].any(axis=1)))
+                case 8, (h, w, x, y):  # z
+                    return tuple(np.flatnonzero(valid_brick_positions(h, w)[x, y]))
+                case _:  # Token is not a number, or the brick has ended
+                    return None
+
+        @functools.cache
+        def allowed_values_mask(values: tuple[int, ...]) -> torch.Tensor:
+            mask = ~self._number_token_mask
+            mask[self._number_token_ids[list(values)]] = True
+            return mask
+
+        def geometric_token_mask_fn(idx: int, generated_ids: torch.Tensor) -> torch.Tensor:
+            syntax_mask = syntax_mask_fn(idx, generated_ids)
+            if idx % 2 == 1:  # Token is a separator
+                return syntax_mask
+
+            masks = []
+            for row_ids in generated_ids.tolist():
+                prev_values = tuple(self._token_values.get(token_id) for token_id in row_ids[::2])
+                values = None if None in prev_values else allowed_values(idx, prev_values)  # None if brick ended
+                masks.append(syntax_mask if values is None else syntax_mask & allowed_values_mask(values))
+            return torch.stack(masks)
+
+        return geometric_token_mask_fn
+
+    @functools.cached_property
+    def _number_token_ids(self) -> torch.Tensor:
+        """
+        The token ID of each number that can appear in a brick, indexed by the number.
+        """
+        max_number = max(self.world_dim - 1, max_brick_dimension)
+        return torch.tensor(self._get_token_ids(tuple(str(i) for i in range(max_number + 1))), device=self.device)
+
+    @functools.cached_property
+    def _number_token_id_table(self) -> np.ndarray:
+        """
+        The token ID of each number that can appear in a brick, indexed by the number.
+        """
+        return self._number_token_ids.cpu().numpy()
+
+    @functools.cached_property
+    def _token_value_table(self) -> np.ndarray:
+        """
+        The number of each token ID that is a number that can appear in a brick, indexed by the token ID,
+        and -1 for every other token ID.
+        """
+        token_values = np.full(max(self.llm.vocab_size, self._number_token_id_table.max() + 1), -1, dtype=np.int64)
+        token_values[self._number_token_id_table] = np.arange(len(self._number_token_id_table))
+        return token_values
+
+    @functools.cached_property
+    def _separator_token_ids(self) -> np.ndarray:
+        """
+        The token IDs of the separators between the numbers of a brick, in order.
+        """
+        return np.array(self._get_token_ids(('x', ' (', ',', ',', ')\n')), dtype=np.int64)
+
+    @functools.cached_property
+    def _number_token_mask(self) -> torch.Tensor:
+        mask = torch.zeros(self.llm.vocab_size, dtype=torch.bool, device=self.device)
+        mask[self._number_token_ids] = True
+        return mask
+
+    @functools.cached_property
+    def _token_values(self) -> dict[int, int]:
+        """
+        Maps the token ID of each number that can appear in a brick to the number.
+        """
+        return {token_id: i for i, token_id in enumerate(self._number_token_ids.tolist())}
 
     @functools.cache
-    def _build_allowed_token_ids_fn(self, allowed_strs: tuple[str]) -> Callable[[int, torch.Tensor], list[int]]:
+    def _build_allowed_token_mask(self, allowed_strs: tuple[str, ...]) -> torch.Tensor:
+        """
+        Builds a boolean mask over the vocabulary that allows only tokens in the allowed strings.
         """
-        Builds a function that returns a set of allowed token IDs, to be used by PrefixConstrainedLogitsProcessor.
+        mask = torch.zeros(self.llm.vocab_size, dtype=torch.bool, device=self.device)
+        mask[self._get_token_ids(allowed_strs)] = True
+        return mask
+
+    def _get_token_ids(self, strs: tuple[str, ...]) -> list[int]:
+        """
+        Returns the token ID of each string.
         """
-        allowed_tokens = [self.llm.tokenizer.tokenize(s) for s in allowed_strs]
-        if not all(len(tokens) == 1 for tokens in allowed_tokens):
+        tokens = [self.llm.tokenizer.tokenize(s) for s in strs]
+        if not all(len(tokens_) == 1 for tokens_ in tokens):
             raise ValueError('Each allowed string must tokenize to exactly 1 token')
-        allowed_ids = self.llm.tokenizer.convert_tokens_to_ids(tokens[0] for tokens in allowed_tokens)
+        return self.llm.tokenizer.convert_tokens_to_ids([tokens_[0] for tokens_ in tokens])
+
 
-        def allowed_token_ids_fn(_: int, __: torch.Tensor) -> list[int]:
-            return allowed_ids
+class _GenerationTrace:
+    """
+    A hook that sums the time spent in each stage of generation, from the events of a LegoGPT model.
+    """
+    stages = ('prefill', 'decode', 'validation', 'stability_solve', 'rollback')
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.durations = dict.fromkeys(self.stages, 0.0)
+        self._stage_start_times = {}
 
-        return allowed_token_ids_fn
+    def __call__(self, event: GenerationEvent) -> None:
+        stage, _, boundary = event.name.rpartition('_')
+        if boundary == 'start':
+            self._stage_start_times[stage] = event.time
+        elif boundary == 'end' and stage in self._stage_start_times:
+            self.durations[stage] += event.time - self._stage_start_times.pop(stage)
+
+    def output(self) -> dict[str, float]:
+        """
+        Returns the time in seconds spent in each stage, in all other work, and in total.
+        """
+        total = time.perf_counter() - self.start_time
+        return self.durations | {'other': total - sum(self.durations.values()), 'total': total}
+
+
+class _RejectedBrickTrie:
+    """
+    A prefix trie of the token IDs of the bricks rejected at one position of a LEGO structure. It is a token mask
+    function for logit masking, which refines another one so that no rejected brick can be generated again: after
+    each prefix, the tokens that complete a rejected brick are not allowed. A prefix is pruned, i.e. its last token is
+    not allowed either, as soon as all of the continuations allowed after it are banned.
+    """
+
+    def __init__(self, allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor]):
+        """
+        :param allowed_token_mask_fn: The token mask function to refine, which also determines
+                                      the allowed continuations of each prefix.
+        """
+        self.allowed_token_mask_fn = allowed_token_mask_fn
+        self.root = {}  # Maps each token ID to the subtrie of its continuations, or to None if the token is banned
+
+    def __call__(self, idx: int, generated_ids: torch.Tensor) -> torch.Tensor:
+        mask = self.allowed_token_mask_fn(idx, generated_ids)
+        if not self.root:
+            return mask
+        banned_ids = [self._banned_token_ids(row_ids) for row_ids in generated_ids.tolist()]
+        if not any(banned_ids):
+            return mask
+
+        mask = torch.atleast_2d(mask).expand(generated_ids.shape[0], -1).clone()
+        for row_idx, row_banned_ids in enumerate(banned_ids):
+            mask[row_idx, row_banned_ids] = False
+        return mask
+
+    def ban(self, brick_ids: list[int]) -> None:
+        """
+        Bans a brick, given its token IDs, and prunes the prefixes of it whose allowed continuations are all banned.
+        """
+        nodes = [self.root]
+        for token_id in brick_ids[:-1]:
+            node = nodes[-1].setdefault(token_id, {})
+            if node is None:  # A prefix of the brick is already banned
+                return
+            nodes.append(node)
+        nodes[-1][brick_ids[-1]] = None
+
+        for depth in range(len(brick_ids) - 1, 0, -1):
+            allowed_mask = self.allowed_token_mask_fn(depth, torch.tensor([brick_ids[:depth]]))
+            allowed_ids = torch.nonzero(allowed_mask.view(-1))[:, 0].tolist()
+            if any(nodes[depth].get(token_id, {}) is not None for token_id in allowed_ids):
+                break
+            nodes[depth - 1][brick_ids[depth - 1]] = None
+
+    def _banned_token_ids(self, prefix_ids: list[int]) -> list[int]:
+        """
+        Returns the IDs of the tokens that are banned after the given prefix.
+        """
+        node = self.root
+        for token_id in prefix_ids:
+            node = node.get(token_id, {})
+            if not node:
+                return []
+        return [token_id for token_id, child in node.items() if child is None]
+
+
+@dataclass
+class _BatchedStructure:
+    """
+    The generation state of one LEGO structure in a LegoGPTBatch.
+    """
+    id: int
+    caption: str
+    lego: LegoStructure
+    llm_states: list[LLMBatchState]  # The LLM state after each brick; llm_states[0] is the state after the prompt
+    temperature: float
+    deadline: '_Deadline'
+    rejection_reasons: Counter = field(default_factory=Counter)
+    n_regenerations: int = 0
+    n_new_bricks: int = 0  # The number of bricks added since the structure was last regenerated
+    rejected_bricks: set[str] = field(default_factory=set)  # Bricks rejected at the current position
+    banned_bricks: _RejectedBrickTrie | None = None  # The trie of rejected bricks, if using logit masking
+    n_brick_rejections: int = 0  # The number of rejections at the current position
+    n_bricks_checked: int = 0  # The number of bricks when stability was last checked, or when generation started
+    n_stable_bricks: int = 0  # The length of the longest prefix of the structure that is known to be stable
+    stability_checkpoints: Counter = field(default_factory=Counter)
+
+    def output(self) -> dict:
+        return {
+            'lego': self.lego,
+            'rejection_reasons': self.rejection_reasons,
+            'n_regenerations': self.n_regenerations,
+            'stability_checkpoints': self.stability_checkpoints,
+            'speculative_decoding': Counter(),
+            'degradation_level': self.deadline.level,
+        }
+
+
+class _Deadline:
+    """
+    The deadline of a generation with a time budget, and the degradation level that the generation has reached
+    as the deadline approaches. The level only ever steps down the ladder of _degradation_levels, never back up.
+    """
+
+    def __init__(self, time_budget: float | None = None):
+        """
+        :param time_budget: The time budget in seconds, starting now, or None for no deadline.
+        """
+        self.time_budget = time_budget
+        self.end_time = None if time_budget is None else time.perf_counter() + time_budget
+        self.level = 'none'
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """
+        Makes the deadline pass now, so that generation stops as soon as it next checks the deadline.
+        """
+        self.cancelled = True
+
+    def time_left(self) -> float | None:
+        """
+        Returns the time left before the deadline in seconds, or None if there is no deadline.
+        """
+        if self.cancelled:
+            return 0.0
+        if self.end_time is None:
+            return None
+        return max(self.end_time - time.perf_counter(), 0.0)
+
+    def update_level(self) -> bool:
+        """
+        Steps down to the most degraded level whose threshold is above the fraction of the time budget left.
+        :return: Whether the level changed.
+        """
+        if self.end_time is None and not self.cancelled:
+            return False
+        fraction_left = 0.0 if self.cancelled or self.time_budget <= 0 else self.time_left() / self.time_budget
+        level = next((level for level in reversed(_degradation_levels[1:])
+                      if fraction_left < _degradation_thresholds[level]), 'none')
+        if _degradation_levels.index(level) <= _degradation_levels.index(self.level):
+            return False
+        self.level = level
+        return True
+
+
+class LegoGPTBatch:
+    """
+    A batch of LEGO structures that are generated together by a LegoGPT model, one brick per structure per step.
+    Each structure is generated as by LegoGPT.__call__, with its own rejection sampling and physics-informed rollback,
+    with the following differences:
+    - Each structure samples tokens from its own seeded random number generator.
+    - Rollbacks truncate the structure's KV cache instead of re-encoding the prompt.
+    - If no valid brick is found after max_brick_rejections rejections, the structure is ended.
+    - Candidate bricks are sampled one at a time; brick_sample_batch_size is ignored.
+    - Each structure has its own time budget and degradation level, and degradation events are not emitted.
+    Structures can be added to the batch before any step, and leave the batch as soon as they are finished.
+    """
+
+    def __init__(self, legogpt: LegoGPT):
+        if isinstance(legogpt.llm, RecordingLLM):
+            raise ValueError('Batched generation cannot be recorded')
+        if not isinstance(legogpt.llm, LLM) or isinstance(legogpt.llm, OnnxLLM):
+            raise ValueError('Batched generation is only supported by the hf backend')
+        self.legogpt = legogpt
+        self.llm_batch = LLMBatch(legogpt.llm)
+        self.structures: list[_BatchedStructure] = []
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self.structures)
+
+    def add(
+            self,
+            captions: list[str],
+            seeds: list[int | None] | None = None,
+            time_budget: float | None = None,
+    ) -> list[int]:
+        """
+        Adds LEGO structures to be generated to the batch.
+        :param captions: The captions of the LEGO structures to be generated.
+        :param seeds: The random seed with which to generate each structure. If None, or for each seed that is None,
+                      seeds are drawn from torch's global random number generator.
+        :param time_budget: The time budget of each structure in seconds, starting now, overriding cfg.time_budget.
+        :return: An id for each structure, which identifies its output when it is returned by step().
+        """
+        time_budget = self.legogpt.time_budget if time_budget is None else time_budget
+        return self._add(captions, seeds, [_Deadline(time_budget) for _ in captions])
+
+    def _add(self, captions: list[str], seeds: list[int | None] | None, deadlines: list[_Deadline]) -> list[int]:
+        if seeds is None:
+            seeds = [None] * len(captions)
+        if len(seeds) != len(captions):
+            raise ValueError('The number of seeds must match the number of captions')
+        seeds = [int(torch.randint(2 ** 62, ())) if seed is None else seed for seed in seeds]
+
+        n_structures = len(self.llm_batch)
+        self.llm_batch.add_sequences([self.legogpt._build_prompt(caption) for caption in captions], seeds)
+        for i, caption in enumerate(captions):
+            self.structures.append(_BatchedStructure(
+                id=self._next_id,
+                caption=caption,
+                lego=LegoStructure([]),
+                llm_states=[self.llm_batch.save_state(n_structures + i)],
+                temperature=self.legogpt.temperature,
+                deadline=deadlines[i],
+            ))
+            self._next_id += 1
+        return [structure.id for structure in self.structures[n_structures:]]
+
+    def remove(self, ids: list[int]) -> None:
+        """
+        Removes the LEGO structures with the given ids from the batch, abandoning their generation.
+        """
+        removed_idxs = [idx for idx, structure in enumerate(self.structures) if structure.id in set(ids)]
+        self.structures = [structure for idx, structure in enumerate(self.structures) if idx not in removed_idxs]
+        self.llm_batch.remove_sequences(removed_idxs)
+
+    def step(self) -> dict[int, dict]:
+        """
+        Generates one brick for each LEGO structure in the batch.
+        :return: The outputs of the LEGO structures that were finished during this step, keyed by id,
+                 in the same format as LegoGPT.__call__.
+        """
+        if not self.structures:
+            return {}
+
+        # End the structures that are out of time before generating their next brick
+        finished = self._remove_finished([idx for idx, structure in enumerate(self.structures)
+                                          if self._is_degraded(structure, 'stable_prefix')
+                                          and self._finish_structure(idx, structure)])
+        if self.structures:
+            finished += self._generate_bricks()
+        self.llm_batch.compact()
+        return {structure.id: structure.output() for structure in finished}
+
+    def _generate_bricks(self) -> list[_BatchedStructure]:
+        """
+        Generates one brick for each LEGO structure in the batch.
+        :return: The LEGO structures that were finished, which are removed from the batch.
+        """
+        legogpt = self.legogpt
+        result_ids = self.llm_batch.generate(
+            max_new_tokens=len(legogpt._brick_template),
+            temperature=torch.tensor([structure.temperature for structure in self.structures], device=legogpt.device),
+            allowed_token_mask_fn=self._build_allowed_token_mask_fn() if legogpt.use_logit_masking else None,
+            top_k=None if legogpt.use_logit_masking else legogpt.top_k,
+            top_p=None if legogpt.use_logit_masking else legogpt.top_p,
+        )
+        bricks = legogpt._decode_bricks(result_ids)
+
+        return self._remove_finished([idx for idx, (structure, brick) in enumerate(zip(self.structures, bricks))
+                                      if not self._add_brick(idx, structure, brick)
+                                      and self._finish_structure(idx, structure)])
+
+    def _remove_finished(self, finished_idxs: list[int]) -> list[_BatchedStructure]:
+        """
+        Removes the finished LEGO structures at the given indices from the batch, and returns them.
+        """
+        finished = [self.structures[idx] for idx in finished_idxs]
+        self.structures = [structure for idx, structure in enumerate(self.structures) if idx not in finished_idxs]
+        self.llm_batch.remove_sequences(finished_idxs)
+        return finished
+
+    def _add_brick(self, idx: int, structure: _BatchedStructure, brick: str) -> bool:
+        """
+        Tries to add a generated brick to the LEGO structure at index idx, rolling it back if it is invalid.
+        :return: Whether generation of the LEGO structure should continue.
+        """
+        legogpt = self.legogpt
+        if not brick:  # EOS token was generated
+            return False
+
+        add_brick_result = legogpt._try_adding_brick(brick, structure.lego, structure.rejected_bricks)
+        if add_brick_result == 'success':
+            structure.lego.add_brick(legogpt._parse_brick(brick))
+            structure.llm_states.append(self.llm_batch.save_state(idx))
+            structure.n_new_bricks += 1
+            self._reset_rejection_sampling(structure)
+
+            # Stop early if the structure is unstable at a stability checkpoint
+            if (structure.n_regenerations < legogpt.max_regenerations
+                    and legogpt._is_stability_checkpoint(structure.lego, structure.n_bricks_checked)):
+                structure.n_bricks_checked = len(structure.lego)
+                structure.stability_checkpoints['checks'] += 1
+                if not _is_stable_before(structure.lego, structure.deadline):
+                    structure.stability_checkpoints['early_rollbacks'] += 1
+                    return False
+            return structure.n_new_bricks < legogpt.max_bricks
+
+        # Reset if brick is invalid
+        self.llm_batch.rollback_to_saved_state(idx, structure.llm_states[-1])
+        max_brick_rejections = self._max_brick_rejections(structure)
+        if structure.n_brick_rejections >= max_brick_rejections:
+            if max_brick_rejections > 0:
+                warnings.warn(f'Failed to generate a valid brick after {structure.n_brick_rejections + 1} attempts.\n'
+                              f'Last generated brick: {brick}\n'
+                              f'Reasons for rejection: {structure.rejection_reasons}\n'
+                              f'Lego structure: {structure.lego.to_txt()}\n')
+            self._reset_rejection_sampling(structure)
+            return False
+
+        structure.rejection_reasons.update([add_brick_result])
+        structure.rejected_bricks.add(brick)
+        if legogpt.use_logit_masking:
+            if structure.banned_bricks is None:
+                structure.banned_bricks = _RejectedBrickTrie(legogpt._build_brick_token_mask_fn(structure.lego))
+            legogpt._ban_brick(structure.banned_bricks, brick)
+        structure.n_brick_rejections += 1
+        if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
+            structure.temperature = min(legogpt.max_temperature, structure.temperature + legogpt.temperature_increase)
+        return True
+
+    def _finish_structure(self, idx: int, structure: _BatchedStructure) -> bool:
+        """
+        Checks whether the LEGO structure at index idx is stable. If it is unstable, removes all bricks after
+        the first unstable brick and rolls back the LLM state to continue generating from the remaining bricks.
+        :return: Whether the LEGO structure is finished.
+        """
+        legogpt = self.legogpt
+        if _is_stable_before(structure.lego, structure.deadline):
+            return True
+        if self._is_degraded(structure, 'fewer_regenerations'):  # No time left to regenerate, so end with a stable prefix
+            structure.lego = self._remove_unstable_bricks(structure)
+            return True
+        if structure.n_regenerations == legogpt.max_regenerations:
+            if legogpt.max_regenerations > 0:
+                warnings.warn(f'Failed to generate a stable structure after {structure.n_regenerations + 1} attempts.\n')
+            return True
+
+        structure.n_regenerations += 1
+        n_bricks = len(structure.lego)
+        structure.lego = self._remove_unstable_bricks(structure)
+        structure.n_stable_bricks = len(structure.lego)
+        structure.stability_checkpoints['discarded_bricks'] += n_bricks - len(structure.lego)
+        del structure.llm_states[len(structure.lego) + 1:]
+        self.llm_batch.rollback_to_saved_state(idx, structure.llm_states[-1])
+        structure.n_new_bricks = 0
+        structure.n_bricks_checked = len(structure.lego)
+        self._reset_rejection_sampling(structure)
+        return False
+
+    @staticmethod
+    def _remove_unstable_bricks(structure: _BatchedStructure) -> LegoStructure:
+        """
+        Removes all bricks after the first unstable brick of the LEGO structure. If stability analysis runs out of time,
+        returns the longest prefix of the structure that is known to be stable instead.
+        """
+        try:
+            return _remove_all_bricks_after_first_unstable_brick(structure.lego, structure.deadline)
+        except TimeoutError:
+            return LegoStructure(structure.lego.bricks[:structure.n_stable_bricks])
+
+    @staticmethod
+    def _is_degraded(structure: _BatchedStructure, level: str) -> bool:
+        """
+        Steps down the degradation ladder of the LEGO structure according to the time left before its deadline,
+        and returns whether its generation has reached the given degradation level.
+        """
+        structure.deadline.update_level()
+        return _degradation_levels.index(structure.deadline.level) >= _degradation_levels.index(level)
+
+    def _max_brick_rejections(self, structure: _BatchedStructure) -> int:
+        if self._is_degraded(structure, 'fewer_rejections'):
+            return int(self.legogpt.max_brick_rejections * _degraded_rejection_fraction)
+        return self.legogpt.max_brick_rejections
+
+    def _reset_rejection_sampling(self, structure: _BatchedStructure) -> None:
+        structure.rejected_bricks = set()
+        structure.banned_bricks = None
+        structure.n_brick_rejections = 0
+        structure.temperature = self.legogpt.temperature
+
+    def _build_allowed_token_mask_fn(self) -> Callable[[int, torch.Tensor], torch.Tensor]:
+        """
+        Builds a function that returns a mask of allowed token IDs for the brick of each LEGO structure in the batch.
+        """
+        legogpt = self.legogpt
+        if not legogpt.use_geometric_masking and all(structure.banned_bricks is None for structure in self.structures):
+            return legogpt._build_allowed_token_mask_fn()
+
+        mask_fns = [legogpt._build_brick_token_mask_fn(structure.lego) if structure.banned_bricks is None
+                    else structure.banned_bricks for structure in self.structures]
+
+        def allowed_token_mask_fn(idx: int, generated_ids: torch.Tensor) -> torch.Tensor:
+            return torch.cat([torch.atleast_2d(mask_fn(idx, row_ids[None]))
+                              for mask_fn, row_ids in zip(mask_fns, generated_ids)])
+
+        return allowed_token_mask_fn
 
 
 def create_instruction(caption: str) -> str:
@@ -375,14 +1720,48 @@ def _create_example_instruction(x: dict) -> str:
     return f'### Input:\n{x["caption"]}\n\n### Output:\n{x["lego"]}'
 
 
-def _remove_all_bricks_after_first_unstable_brick(lego: LegoStructure) -> LegoStructure:
+def _guess_next_bricks(lego: LegoStructure, n_recent_bricks: int = 3) -> list[LegoBrick]:
+    """
+    Guesses likely next bricks of the LEGO structure, most likely first, from its most recent bricks:
+    each is repeated next to itself along a row, or one layer up. Only guesses that are in bounds,
+    do not collide with other bricks, and are not floating are returned.
+    """
+    guesses = []
+    for brick in reversed(lego.bricks[-n_recent_bricks:]):
+        shifts = [(brick.h, 0, 0), (0, brick.w, 0), (-brick.h, 0, 0), (0, -brick.w, 0), (0, 0, 1)]
+        for dx, dy, dz in shifts:
+            guess = LegoBrick(h=brick.h, w=brick.w, x=brick.x + dx, y=brick.y + dy, z=brick.z + dz)
+            if (guess not in guesses and lego.brick_in_bounds(guess)
+                    and not lego.brick_collides(guess) and not lego.brick_floats(guess)):
+                guesses.append(guess)
+    return guesses
+
+
+def _is_stable_before(lego: LegoStructure, deadline: '_Deadline | None' = None) -> bool:
+    """
+    Returns whether the LEGO structure is stable. If a deadline is given, stability analysis is limited to the time left
+    before it, and a structure whose analysis runs out of time is considered unstable.
+    """
+    try:
+        return lego.is_stable(None if deadline is None else deadline.time_left())
+    except TimeoutError:
+        return False
+
+
+def _remove_all_bricks_after_first_unstable_brick(
+        lego: LegoStructure,
+        deadline: '_Deadline | None' = None,
+) -> LegoStructure:
     """
     Removes all bricks starting from the first unstable brick. Repeats this process until the lego is stable.
+    :param deadline: If given, stability analysis is limited to the time left before it, and a TimeoutError is raised
+                     if it runs out of time.
     """
     while True:
-        if lego.is_stable():
+        time_limit = None if deadline is None else deadline.time_left()
+        if lego.is_stable(time_limit):
             return lego
-        scores = lego.stability_scores()
+        scores = lego.stability_scores(time_limit)
         first_unstable_brick_idx = next((i for i, brick in enumerate(lego.bricks)
                                          if np.any(scores[brick.slice] >= 1)), -1)
         lego = LegoStructure(lego.bricks[:first_unstable_brick_idx])
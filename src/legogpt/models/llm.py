@@ -1,8 +1,68 @@
-import copy
+import abc
+import warnings
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable, Literal, Protocol
 
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer
-from transformers.cache_utils import DynamicCache
+import torch.nn.functional as F
+from transformers import AutoModelForCausalLM, AutoTokenizer, PretrainedConfig, PreTrainedTokenizerBase
+from transformers.cache_utils import Cache, DynamicCache, StaticCache
+
+
+@dataclass(frozen=True)
+class LLMState:
+    """
+    A checkpoint of the generation state of an LLM. Only the sequence lengths are recorded, not the cache contents,
+    so saving and restoring a state takes constant time and memory regardless of the sequence length.
+    """
+    kv_cache: Cache | None
+    kv_cache_length: int
+    input_ids: torch.Tensor | None
+    batch_size: int
+
+
+class LLMBackend(Protocol):
+    """
+    The interface through which LegoGPT generates bricks with a language model: prefill a prompt, generate tokens
+    one at a time with a mask of allowed tokens, and save and roll back to checkpoints of the generation state.
+    LLM implements it with a HuggingFace model in PyTorch, and OnnxLLM with a model exported to ONNX Runtime.
+    The other features of LegoGPT are only available with backends that also implement the corresponding methods
+    of LLM: enable_static_cache, enable_kv_cache_quantization, expand_batch and select_batch_index for
+    brick_sample_batch_size > 1, and generate_speculative and batch_size for speculative decoding.
+    LegoGPT checks for them when it is created. Batched generation requires an LLM.
+    """
+    device: str
+    tokenizer: PreTrainedTokenizerBase
+
+    @property
+    def vocab_size(self) -> int:
+        ...
+
+    def prefill(self, prompt: str | torch.Tensor) -> None:
+        ...
+
+    def generate_constrained(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+    ) -> torch.Tensor:
+        ...
+
+    def cache_prompt_prefix(self, prefix: str | torch.Tensor) -> None:
+        """
+        Called once with the part of the prompt shared by all captions, which may be cached to speed up prefilling.
+        Backends that do not cache prompt prefixes can do nothing.
+        """
+        ...
+
+    def save_state(self):
+        ...
+
+    def rollback_to_saved_state(self, state=None) -> None:
+        ...
 
 
 class LLM:
@@ -10,15 +70,40 @@ class LLM:
     A small wrapper class for a language model.
     """
 
-    def __init__(self, model_name: str, device: str = 'cuda' if torch.cuda.is_available() else 'cpu'):
+    def __init__(
+            self,
+            model_name: str,
+            device: str = 'cuda' if torch.cuda.is_available() else 'cpu',
+            quantization: Literal['none', 'bf16', 'int8', 'int4'] = 'none',
+    ):
+        """
+        :param model_name: The name or path of the model.
+        :param device: The device on which to run the model.
+        :param quantization: The format of the model weights: 'none' for full precision, 'bf16' for bfloat16,
+                             'int8' for dynamic int8 quantization of all linear layers (CPU only), or 'int4' for
+                             weight-only int4 quantization of all linear layers (requires torchao).
+        """
         self.device = device
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(model_name).to(device)
+        self.model = self._load_model(model_name, quantization)
 
         self.kv_cache = None
-        self.kv_cache_saved = None
         self.input_ids_cache = None
-        self.input_ids_cache_saved = None
+        self.saved_state = None
+
+        self.prompt_prefix_ids = None
+        self.prompt_prefix_kv_cache = None
+
+        self.static_kv_cache = None
+        self.decode_step = None
+        self.kv_cache_cls = DynamicCache  # The class of the dynamic KV caches, which may be quantized
+
+    def _load_model(self, model_name: str, quantization: Literal['none', 'bf16', 'int8', 'int4']):
+        return _load_pretrained_model(model_name, self.device, quantization)
+
+    @property
+    def vocab_size(self) -> int:
+        return self.model.config.vocab_size
 
     def __call__(
             self,
@@ -34,17 +119,10 @@ class LLM:
         # If prompt is None, continue generation from previously generated tokens
         if prompt is None:
             prompt = self.input_ids_cache
-        else:
-            self.reset_cache()
-
-        # If prompt is a string, encode it into token ids
-        if isinstance(prompt, str):
-            encoded_input = self.tokenizer(prompt, return_tensors='pt')
-            input_ids = encoded_input['input_ids'].to(self.device)
-            attention_mask = encoded_input['attention_mask'].to(self.device)
-        else:
-            input_ids = prompt.to(self.device)
-            attention_mask = torch.ones_like(input_ids)
+        input_ids, attention_mask = self._encode_prompt(prompt)
+        if prompt is not self.input_ids_cache:
+            self.reset_cache(input_ids)
+        self._use_dynamic_cache()
 
         # Run generation
         output_dict = self.model.generate(
@@ -52,27 +130,904 @@ class LLM:
             attention_mask=attention_mask,
             pad_token_id=self.tokenizer.pad_token_id,
             do_sample=True,
-            num_return_sequences=1,
+            num_return_sequences=1,  # To generate multiple sequences, call expand_batch() beforehand
             past_key_values=self.kv_cache,
             return_dict_in_generate=True,
             **kwargs,
         )
         self.input_ids_cache = output_dict['sequences']
 
-        # Return result as token ids or as a string
+        # Return result as token ids or as a string. If the batch has multiple sequences, return a batch of results.
         input_length = input_ids.shape[1]
-        result_ids = output_dict['sequences'][0][input_length:]
-        result = result_ids if return_as_ids else self.tokenizer.decode(result_ids)
+        result_ids = output_dict['sequences'][:, input_length:]
+        if result_ids.shape[0] == 1:
+            result_ids = result_ids[0]
+            result = result_ids if return_as_ids else self.tokenizer.decode(result_ids)
+        else:
+            result = result_ids if return_as_ids else self.tokenizer.batch_decode(result_ids)
 
         return (result, output_dict) if return_dict else result
 
-    def reset_cache(self) -> None:
-        self.kv_cache = DynamicCache()
+    def generate_constrained(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+    ) -> torch.Tensor:
+        """
+        Samples tokens one at a time by calling the model's forward pass directly,
+        restricting each token to a set of allowed tokens. Stops early once every sequence has generated EOS.
+        This avoids the per-call overhead of generate(), which dominates latency when generating few tokens per call.
+        :param allowed_token_mask_fn: A function that takes the index of the token to be generated and
+                                      the token ids generated so far, of shape (batch_size, index), and returns
+                                      a boolean mask of allowed tokens, of shape (vocab_size,) or (batch_size, vocab_size).
+        :param max_new_tokens: The maximum number of tokens to generate.
+        :param prompt: The prompt to generate from. If None, continue generation from previously generated tokens.
+        :param temperature: The sampling temperature.
+        :return: The generated token ids, of shape (batch_size, n_new_tokens).
+        """
+        if prompt is None:
+            input_ids = self.input_ids_cache
+        else:
+            input_ids, _ = self._encode_prompt(prompt)
+            self.reset_cache(input_ids)
+
+        result_ids = input_ids[:, :0]
+        finished = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=self.device)
+        for idx in range(max_new_tokens):
+            # Run the model on all tokens not yet in the KV cache
+            logits = self._forward(input_ids[:, self.kv_cache.get_seq_length():])[:, -1, :]
+
+            allowed_mask = allowed_token_mask_fn(idx, result_ids)
+            next_token_ids = _sample_next_tokens(logits, allowed_mask, temperature)
+
+            input_ids = torch.cat([input_ids, next_token_ids], dim=1)
+            result_ids = torch.cat([result_ids, next_token_ids], dim=1)
+            finished |= next_token_ids[:, 0] == self.tokenizer.eos_token_id
+            if torch.all(finished):
+                break
+
+        self.input_ids_cache = input_ids
+        return result_ids
+
+    def generate_speculative(
+            self,
+            propose_fn: Callable[[torch.Tensor, torch.Tensor, int], tuple[torch.Tensor, torch.Tensor | None]],
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+            stats: Counter | None = None,
+    ) -> torch.Tensor:
+        """
+        Samples tokens like generate_constrained(), but with speculative decoding: a draft of several tokens is
+        proposed, and then verified by running the model on the whole draft in one forward pass. Each draft token
+        is accepted with probability min(1, p/q), where p and q are the probabilities of the token under this model
+        and under the draft proposal; at the first rejected token, a replacement is sampled from the residual
+        distribution max(0, p - q). This guarantees the generated tokens follow the same distribution as with
+        generate_constrained(). Only supports a batch size of 1.
+        :param propose_fn: A function that takes the token ids of the whole sequence so far, of shape (1, length),
+                           the token ids generated so far, of shape (1, index), and the maximum number of tokens to
+                           propose, and returns the proposed token ids, of shape (1, n_draft_tokens), and the
+                           draft probability distribution of each proposed token, of shape (n_draft_tokens, vocab_size).
+                           The distributions may be None if the proposal is deterministic.
+        :param allowed_token_mask_fn: See generate_constrained().
+        :param max_new_tokens: The maximum number of tokens to generate.
+        :param prompt: The prompt to generate from. If None, continue generation from previously generated tokens.
+        :param temperature: The sampling temperature.
+        :param stats: If given, the number of proposed and accepted draft tokens are added to it
+                      as 'draft_tokens' and 'accepted_draft_tokens'.
+        :return: The generated token ids, of shape (1, n_new_tokens).
+        """
+        if prompt is None:
+            input_ids = self.input_ids_cache
+        else:
+            input_ids, _ = self._encode_prompt(prompt)
+            self.reset_cache(input_ids)
+        if input_ids.shape[0] != 1:
+            raise ValueError('Speculative decoding only supports a batch size of 1')
+
+        result_ids = input_ids[:, :0]
+        while result_ids.shape[1] < max_new_tokens:
+            n_generated = result_ids.shape[1]
+            draft_ids, draft_probs = propose_fn(input_ids, result_ids, max_new_tokens - n_generated)
+            n_draft = draft_ids.shape[1]
+
+            # If the draft is accepted in full, one more token is sampled, unless the draft already ends generation
+            n_positions = n_draft
+            if n_generated + n_draft < max_new_tokens and not torch.any(draft_ids == self.tokenizer.eos_token_id):
+                n_positions += 1
+
+            # Run the model on all tokens not yet in the KV cache, followed by the draft
+            logits = self._forward(
+                torch.cat([input_ids[:, self.kv_cache.get_seq_length():], draft_ids], dim=1),
+                logits_to_keep=n_draft + 1,
+            )[0]
+
+            # Accept the longest prefix of the draft that passes rejection sampling, followed by one sampled token.
+            # The allowed tokens at each position are only computed up to the first rejected draft token.
+            n_accepted = 0
+            next_probs = None
+            for i in range(n_positions):
+                allowed_mask = allowed_token_mask_fn(n_generated + i, torch.cat([result_ids, draft_ids[:, :i]], dim=1))
+                probs = _next_token_probs(logits[i:i + 1], allowed_mask, temperature)[0]
+                if i == n_draft:
+                    next_probs = probs
+                    break
+
+                token_id = draft_ids[0, i]
+                draft_prob = 1.0 if draft_probs is None else draft_probs[i, token_id]
+                if torch.rand(()) * draft_prob < probs[token_id]:
+                    n_accepted += 1
+                    continue
+
+                # Sample a replacement for the rejected token from the residual distribution
+                if draft_probs is None:
+                    next_probs = probs.clone()
+                    next_probs[token_id] = 0
+                else:
+                    next_probs = (probs - draft_probs[i]).clamp(min=0)
+                if next_probs.sum() <= 0:
+                    next_probs = probs
+                break
+
+            new_ids = draft_ids[:, :n_accepted]
+            if next_probs is not None:
+                new_ids = torch.cat([new_ids, torch.multinomial(next_probs, num_samples=1)[None]], dim=1)
+
+            if stats is not None:
+                stats['draft_tokens'] += n_draft
+                stats['accepted_draft_tokens'] += n_accepted
+
+            # Stop at the first EOS token
+            eos_idxs = torch.nonzero(new_ids[0] == self.tokenizer.eos_token_id)
+            if len(eos_idxs) > 0:
+                new_ids = new_ids[:, :eos_idxs[0, 0] + 1]
+            new_ids = new_ids[:, :max_new_tokens - n_generated]
+
+            # The KV cache holds the whole draft; keep only the accepted tokens, except the last one
+            input_ids = torch.cat([input_ids, new_ids], dim=1)
+            result_ids = torch.cat([result_ids, new_ids], dim=1)
+            self.kv_cache.crop(input_ids.shape[1] - 1)
+            if len(eos_idxs) > 0:
+                break
+
+        self.input_ids_cache = input_ids
+        return result_ids
+
+    def propose_draft(
+            self,
+            input_ids: torch.Tensor,
+            generated_ids: torch.Tensor,
+            max_draft_tokens: int,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            temperature: float = 1.0,
+    ) -> (torch.Tensor, torch.Tensor):
+        """
+        Uses this LLM as a draft model for speculative decoding with another LLM. Samples up to max_draft_tokens
+        tokens one at a time, stopping after EOS. This LLM's KV cache is kept in sync with the given sequence,
+        reusing the longest prefix it shares with the previous sequence, so rollbacks of the other LLM are followed.
+        :param input_ids: The token ids of the whole sequence so far, of shape (1, length).
+        :param generated_ids: The token ids generated so far by the current call, of shape (1, index).
+        :param max_draft_tokens: The maximum number of tokens to propose.
+        :param allowed_token_mask_fn: See generate_constrained().
+        :param temperature: The sampling temperature.
+        :return: The proposed token ids, of shape (1, n_draft_tokens), and the probability distribution from which
+                 each was sampled, of shape (n_draft_tokens, vocab_size).
+        """
+        self._sync_cache(input_ids)
+
+        draft_ids = input_ids[:, :0]
+        draft_probs = []
+        for i in range(max_draft_tokens):
+            logits = self._forward(self.input_ids_cache[:, self.kv_cache.get_seq_length():])[:, -1, :]
+            allowed_mask = allowed_token_mask_fn(generated_ids.shape[1] + i, torch.cat([generated_ids, draft_ids], dim=1))
+            probs = _next_token_probs(logits, allowed_mask, temperature)
+            next_token_ids = torch.multinomial(probs, num_samples=1)
+
+            draft_ids = torch.cat([draft_ids, next_token_ids], dim=1)
+            draft_probs.append(probs[0])
+            self.input_ids_cache = torch.cat([self.input_ids_cache, next_token_ids], dim=1)
+            if next_token_ids[0, 0] == self.tokenizer.eos_token_id:
+                break
+
+        return draft_ids, torch.stack(draft_probs) if draft_probs else logits.new_zeros((0, logits.shape[-1]))
+
+    def _sync_cache(self, input_ids: torch.Tensor) -> None:
+        """
+        Makes the KV cache hold all but the last of the given token ids, of shape (1, length), keeping the longest prefix
+        that they share with the token ids currently in the KV cache.
+        """
+        if self.kv_cache is None or self.input_ids_cache is None:
+            self.reset_cache(input_ids)
+        else:
+            length = min(self.kv_cache.get_seq_length(), self.input_ids_cache.shape[1], input_ids.shape[1] - 1)
+            is_common = self.input_ids_cache[0, :length] == input_ids[0, :length]
+            self.kv_cache.crop(int(torch.cumprod(is_common, dim=0).sum()))
+
+        prefill_ids = input_ids[:, self.kv_cache.get_seq_length():-1]
+        if prefill_ids.shape[1] > 0:
+            self._forward(prefill_ids)
+        self.input_ids_cache = input_ids
+
+    def prefill(self, prompt: str | torch.Tensor) -> None:
+        """
+        Encodes a prompt into the KV cache without generating any tokens.
+        Subsequent calls with prompt=None will continue generation from the prompt.
+        """
+        input_ids, _ = self._encode_prompt(prompt)
+        self.reset_cache(input_ids)
+
+        # Leave the last token out of the KV cache, since generate() needs at least one token to process
+        prefill_ids = input_ids[:, self.kv_cache.get_seq_length():-1]
+        if prefill_ids.shape[1] > 0:
+            self._forward(prefill_ids)
+        self.input_ids_cache = input_ids
+
+    def enable_static_cache(self, max_cache_len: int) -> bool:
+        """
+        Switches single sequences to a static KV cache, preallocated once with the given length and reused for every
+        prompt, and compiles the model's forward pass on one token with it. Since the shapes of this decode step
+        never change, it is compiled only once, during a warmup run here. Batches of several sequences and sequences
+        longer than the static KV cache fall back to a dynamic KV cache, and forward passes on several tokens at once
+        (prefill and speculative decoding) fall back to the uncompiled model.
+        :param max_cache_len: The maximum number of tokens in the static KV cache.
+        :return: Whether the decode step was compiled. If not, the dynamic KV cache is kept, with a warning.
+        """
+        static_kv_cache = _StaticKVCache(self.model.config, max_cache_len, self.device, self.model.dtype)
+        decode_step = torch.compile(_decode_step, dynamic=False)
+        token_ids = torch.full((1, 1), self.tokenizer.eos_token_id, device=self.device)
+        try:
+            # The first call compiles the decode step, and the second checks that it is not recompiled
+            for _ in range(2):
+                with torch.no_grad():
+                    decode_step(self.model, token_ids, torch.zeros(1, dtype=torch.long, device=self.device),
+                                static_kv_cache)
+        except Exception as e:
+            warnings.warn(f'Failed to compile the decode step; using the dynamic KV cache instead. Error: {e}')
+            return False
+
+        self.static_kv_cache = static_kv_cache
+        self.decode_step = decode_step
+        return True
+
+    def enable_kv_cache_quantization(self, dtype: Literal['int8', 'fp8']) -> None:
+        """
+        Stores the keys and values of new dynamic KV caches, including those of batched sessions, in int8 or fp8
+        with one scale per head and token, and dequantizes them on the fly when they are used for attention.
+        This reduces the memory of the KV cache by about 4x for a full-precision model, or 2x for a bf16 model.
+        Sequences in the static KV cache are not quantized.
+        """
+        self.kv_cache_cls = {'int8': _Int8KVCache, 'fp8': _Fp8KVCache}[dtype]
+
+    def _new_kv_cache(self, legacy_cache: tuple[tuple[torch.Tensor, torch.Tensor], ...] | None = None) -> DynamicCache:
+        """
+        Returns a new dynamic KV cache, empty or holding a copy of the keys and values in the given legacy KV cache.
+        The copy is shared with the legacy KV cache, not copied, unless the KV cache is quantized.
+        """
+        if legacy_cache is None:
+            return self.kv_cache_cls()
+        return self.kv_cache_cls.from_legacy_cache(legacy_cache)
+
+    def _forward(self, input_ids: torch.Tensor, logits_to_keep: int = 1) -> torch.Tensor:
+        """
+        Runs the model on token ids that follow the tokens in the KV cache, adding them to the KV cache.
+        Single tokens of a sequence in the static KV cache are run with the compiled decode step.
+        :param input_ids: The token ids, of shape (batch_size, n_tokens).
+        :param logits_to_keep: The number of last tokens for which to return the logits.
+        :return: The logits of the last logits_to_keep tokens, of shape (batch_size, logits_to_keep, vocab_size).
+        """
+        n_tokens = input_ids.shape[1]
+        if isinstance(self.kv_cache, _StaticKVCache) and self.kv_cache.length + n_tokens > self.kv_cache.max_cache_len:
+            warnings.warn('The sequence is longer than the static KV cache; using a dynamic KV cache instead.')
+            self._use_dynamic_cache()
+
+        with torch.no_grad():
+            if not isinstance(self.kv_cache, _StaticKVCache):
+                logits = self.model(input_ids, past_key_values=self.kv_cache, logits_to_keep=logits_to_keep).logits
+            else:
+                cache_position = torch.arange(self.kv_cache.length, self.kv_cache.length + n_tokens, device=self.device)
+                if n_tokens == 1 and logits_to_keep == 1:
+                    # Copy the token, since a slice of a longer sequence has strides that would trigger recompilation
+                    logits = self.decode_step(self.model, input_ids.clone(memory_format=torch.contiguous_format),
+                                              cache_position, self.kv_cache)
+                else:
+                    logits = self.model(input_ids, past_key_values=self.kv_cache, cache_position=cache_position,
+                                        logits_to_keep=logits_to_keep).logits
+                self.kv_cache.length += n_tokens
+        return logits.float()
+
+    def _use_dynamic_cache(self) -> None:
+        """
+        Moves the current sequence from the static KV cache, if it is in it, to a dynamic KV cache.
+        """
+        if isinstance(self.kv_cache, _StaticKVCache):
+            self.kv_cache = self.kv_cache.to_dynamic()
+
+    def cache_prompt_prefix(self, prefix: str | torch.Tensor) -> None:
+        """
+        Encodes a prefix shared by many prompts into a KV cache, which is kept and reused by every later prompt
+        that begins with the prefix, so that only the remainder of those prompts needs to be encoded.
+        """
+        input_ids, _ = self._encode_prompt(prefix)
+        kv_cache, self.kv_cache = self.kv_cache, DynamicCache()
+        self._forward(input_ids)
+        self.prompt_prefix_ids = input_ids
+        self.prompt_prefix_kv_cache = self.kv_cache.to_legacy_cache()
+        self.kv_cache = kv_cache
+
+    def prompt_prefix_length(self, input_ids: torch.Tensor) -> int:
+        """
+        Returns the length of the cached prompt prefix if the given prompt, of shape (1, length), begins with it
+        and has at least one more token, and 0 otherwise.
+        """
+        if self.prompt_prefix_ids is None:
+            return 0
+        length = self.prompt_prefix_ids.shape[1]
+        if input_ids.shape[1] <= length or not torch.equal(input_ids[:, :length], self.prompt_prefix_ids):
+            return 0
+        return length
+
+    def _encode_prompt(self, prompt: str | torch.Tensor) -> (torch.Tensor, torch.Tensor):
+        """
+        Returns the token ids and attention mask of a prompt.
+        """
+        # If prompt is a string, encode it into token ids
+        if isinstance(prompt, str):
+            encoded_input = self.tokenizer(prompt, return_tensors='pt')
+            input_ids = encoded_input['input_ids'].to(self.device)
+            attention_mask = encoded_input['attention_mask'].to(self.device)
+        else:
+            input_ids = prompt.to(self.device)
+            attention_mask = torch.ones_like(input_ids)
+        return input_ids, attention_mask
+
+    @property
+    def batch_size(self) -> int:
+        return 1 if self.input_ids_cache is None else self.input_ids_cache.shape[0]
+
+    def expand_batch(self, batch_size: int) -> None:
+        """
+        Copies the current sequence batch_size times, so that multiple continuations can be generated in parallel.
+        """
+        self._use_dynamic_cache()
+        self.kv_cache.batch_repeat_interleave(batch_size)
+        self.input_ids_cache = self.input_ids_cache.repeat_interleave(batch_size, dim=0)
+
+    def select_batch_index(self, index: int) -> None:
+        """
+        Keeps only the sequence at the given index of the batch, discarding all others.
+        """
+        self._use_dynamic_cache()
+        self.kv_cache.batch_select_indices(torch.tensor([index], device=self.device))
+        self.input_ids_cache = self.input_ids_cache[index:index + 1]
+
+    def reset_cache(self, input_ids: torch.Tensor | None = None) -> None:
+        """
+        Resets the KV cache. If the prompt that will be encoded next is given and begins with the cached prompt prefix,
+        the KV cache starts with the prefix's KV cache. The prefix's KV cache is shared, not copied, unless the prompt
+        is encoded into the static KV cache, which is reused if it is enabled and the prompt is a single sequence that
+        fits into it. States saved in the static KV cache can no longer be restored after it is reset.
+        """
+        if (self.static_kv_cache is not None and input_ids is not None and input_ids.shape[0] == 1
+                and input_ids.shape[1] <= self.static_kv_cache.max_cache_len):
+            self.kv_cache = self.static_kv_cache
+            self.kv_cache.crop(0)
+            if self.prompt_prefix_length(input_ids) > 0:
+                self.kv_cache.load(self.prompt_prefix_kv_cache)
+        elif input_ids is not None and self.prompt_prefix_length(input_ids) > 0:
+            self.kv_cache = self._new_kv_cache(self.prompt_prefix_kv_cache)
+        else:
+            self.kv_cache = self._new_kv_cache()
+
+    def save_state(self) -> LLMState:
+        """
+        Saves the current generation state, so that it can be restored with rollback_to_saved_state().
+        """
+        self.saved_state = LLMState(
+            kv_cache=self.kv_cache,
+            kv_cache_length=self.kv_cache.get_seq_length() if self.kv_cache is not None else 0,
+            input_ids=self.input_ids_cache,
+            batch_size=self.batch_size,
+        )
+        return self.saved_state
+
+    def rollback_to_saved_state(self, state: LLMState | None = None) -> None:
+        """
+        Rolls back to the given state, or to the most recently saved state if none is given,
+        by truncating the KV cache to the saved length. Tokens generated after the state was saved are discarded,
+        so a state can no longer be restored once the LLM has been rolled back to an earlier state.
+        """
+        if state is None:
+            state = self.saved_state
+
+        # If the batch was expanded after saving, every copy of a sequence shares the saved prefix; keep the first
+        if self.kv_cache is state.kv_cache and self.batch_size != state.batch_size:
+            n_copies = self.batch_size // state.batch_size
+            self.kv_cache.batch_select_indices(torch.arange(0, self.batch_size, n_copies, device=self.device))
+
+        self.kv_cache = state.kv_cache
+        self.input_ids_cache = state.input_ids
+        if self.kv_cache is not None:
+            self.kv_cache.crop(state.kv_cache_length)
+
+
+@dataclass(frozen=True)
+class LLMBatchState:
+    """
+    A checkpoint of the generation state of one sequence in an LLMBatch.
+    """
+    n_tokens: int  # Number of tokens of the sequence in the KV cache
+    next_token_id: int  # The last token of the sequence, which is not yet in the KV cache
+
+
+class LLMBatch:
+    """
+    Holds the generation state of a batch of sequences of different lengths, which share one padded KV cache
+    and are generated in lockstep. Sequences can be added to or removed from the batch between calls to generate(),
+    and each sequence can be rolled back independently of the others.
+
+    Rolling back a sequence masks out its discarded tokens in the attention mask instead of removing them from the
+    KV cache, so the cache accumulates dead slots; these are periodically removed by compacting the cache.
+    """
+
+    def __init__(self, llm: LLM, compaction_threshold: float = 0.5):
+        """
+        :param llm: The LLM whose model and tokenizer to use. Its own generation state is left untouched.
+        :param compaction_threshold: The fraction of dead slots in the KV cache above which the cache is compacted.
+        """
+        if not isinstance(getattr(llm, 'model', None), torch.nn.Module):
+            raise ValueError('Batched generation requires a PyTorch model')
+        self.llm = llm
+        self.model = llm.model
+        self.tokenizer = llm.tokenizer
+        self.device = llm.device
+        self.compaction_threshold = compaction_threshold
+
+        self.kv_cache = None
+        self.attention_mask = None  # 0 for padding and dead slots
+        self.next_token_ids = None  # The last token of each sequence, which is not yet in the KV cache
+        self.generators = None  # The random number generator of each sequence
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Removes all sequences from the batch.
+        """
+        self.kv_cache = None
+        self.attention_mask = torch.zeros((0, 0), dtype=torch.long, device=self.device)
+        self.next_token_ids = torch.zeros(0, dtype=torch.long, device=self.device)
+        self.generators = []
+
+    def __len__(self):
+        return len(self.generators)
+
+    def add_sequences(self, prompts: list[torch.Tensor], seeds: list[int]) -> None:
+        """
+        Prefills the KV cache with the given prompts, and adds them to the end of the batch.
+        :param prompts: The token ids of each prompt, each of shape (1, prompt_length).
+        :param seeds: The random seed with which to sample tokens for each sequence.
+        """
+        if not prompts:
+            return
+
+        prompt_ids = [prompt.view(-1).to(self.device) for prompt in prompts]
+
+        # If all prompts begin with the LLM's cached prompt prefix, start from the prefix's KV cache
+        prefix_length = min(self.llm.prompt_prefix_length(ids[None]) for ids in prompt_ids)
+        if prefix_length > 0:
+            kv_cache = self.llm._new_kv_cache(tuple(
+                (keys.expand(len(prompts), -1, -1, -1), values.expand(len(prompts), -1, -1, -1))
+                for keys, values in self.llm.prompt_prefix_kv_cache
+            ))
+        else:
+            kv_cache = self.llm._new_kv_cache()
+
+        # Left-pad the rest of the prompts after the prefix, leaving the last token of each prompt out of the KV cache
+        suffix_ids = [ids[prefix_length:-1] for ids in prompt_ids]
+        length = max(len(ids) for ids in suffix_ids)
+        pad_token_id = self.tokenizer.pad_token_id or 0
+        input_ids = torch.stack([F.pad(ids, (length - len(ids), 0), value=pad_token_id) for ids in suffix_ids])
+        suffix_attention_mask = torch.stack([F.pad(torch.ones_like(ids), (length - len(ids), 0)) for ids in suffix_ids])
+        position_ids = prefix_length + (suffix_attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+        attention_mask = F.pad(suffix_attention_mask, (prefix_length, 0), value=1)
+
+        if length > 0:
+            with torch.no_grad():
+                self.model(input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                           past_key_values=kv_cache, logits_to_keep=1)
+
+        # Merge into the batch, left-padding whichever KV cache is shorter
+        if self.kv_cache is None:
+            self.kv_cache = kv_cache
+            self.attention_mask = attention_mask
+        else:
+            self.kv_cache = _concat_kv_caches(self.kv_cache, kv_cache)
+            old_length, new_length = self.attention_mask.shape[1], attention_mask.shape[1]
+            self.attention_mask = torch.cat([F.pad(self.attention_mask, (max(new_length - old_length, 0), 0)),
+                                             F.pad(attention_mask, (max(old_length - new_length, 0), 0))])
+        self.next_token_ids = torch.cat([self.next_token_ids, torch.stack([ids[-1] for ids in prompt_ids])])
+        self.generators += [torch.Generator(self.device).manual_seed(seed) for seed in seeds]
+
+    def remove_sequences(self, indices: list[int]) -> None:
+        """
+        Removes the sequences at the given indices from the batch.
+        """
+        if not indices:
+            return
+        keep = [i for i in range(len(self)) if i not in set(indices)]
+        if not keep:
+            self.reset()
+            return
+
+        keep_tensor = torch.tensor(keep, device=self.device)
+        self.kv_cache.batch_select_indices(keep_tensor)
+        self.attention_mask = self.attention_mask[keep_tensor]
+        self.next_token_ids = self.next_token_ids[keep_tensor]
+        self.generators = [self.generators[i] for i in keep]
+        self.compact()
+
+    def generate(
+            self,
+            max_new_tokens: int,
+            temperature: torch.Tensor,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor] | None = None,
+            top_k: int | None = None,
+            top_p: float | None = None,
+    ) -> torch.Tensor:
+        """
+        Samples tokens for every sequence in the batch by calling the model's forward pass directly,
+        optionally restricting each token to a set of allowed tokens. Stops early once every sequence has generated EOS.
+        :param max_new_tokens: The maximum number of tokens to generate.
+        :param temperature: The sampling temperature of each sequence, of shape (batch_size,).
+        :param allowed_token_mask_fn: See LLM.generate_constrained.
+        :param top_k: The number of highest-probability tokens to sample from.
+        :param top_p: The cumulative probability threshold for nucleus sampling.
+        :return: The generated token ids, of shape (batch_size, n_new_tokens).
+        """
+        result_ids = self.next_token_ids[:, None][:, :0]
+        finished = torch.zeros(len(self), dtype=torch.bool, device=self.device)
+        for idx in range(max_new_tokens):
+            # Run the model on the last token of each sequence, which is not yet in the KV cache
+            position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+            self.attention_mask = F.pad(self.attention_mask, (0, 1), value=1)
+            with torch.no_grad():
+                logits = self.model(
+                    self.next_token_ids[:, None],
+                    attention_mask=self.attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=self.kv_cache,
+                    logits_to_keep=1,
+                ).logits[:, -1, :].float()
+
+            allowed_mask = allowed_token_mask_fn(idx, result_ids) if allowed_token_mask_fn is not None else None
+            self.next_token_ids = _sample_next_tokens(logits, allowed_mask, temperature[:, None],
+                                                      self.generators, top_k, top_p)[:, 0]
+
+            result_ids = torch.cat([result_ids, self.next_token_ids[:, None]], dim=1)
+            finished |= self.next_token_ids == self.tokenizer.eos_token_id
+            if torch.all(finished):
+                break
+
+        return result_ids
+
+    def save_state(self, idx: int) -> LLMBatchState:
+        """
+        Returns the current generation state of the sequence at index idx,
+        which can be restored with rollback_to_saved_state().
+        """
+        return LLMBatchState(n_tokens=int(self.attention_mask[idx].sum()),
+                             next_token_id=int(self.next_token_ids[idx]))
+
+    def rollback_to_saved_state(self, idx: int, state: LLMBatchState) -> None:
+        """
+        Rolls back the sequence at index idx to the given state, by masking out all of its tokens after the state.
+        """
+        self.attention_mask[idx] *= self.attention_mask[idx].cumsum(dim=0) <= state.n_tokens
+        self.next_token_ids[idx] = state.next_token_id
+
+    def compact(self) -> None:
+        """
+        Removes padding and dead slots from the KV cache, if they make up more than compaction_threshold of it.
+        """
+        if self.attention_mask.numel() == 0:
+            return
+        n_tokens = self.attention_mask.sum(dim=1)
+        if 1 - n_tokens.sum() / self.attention_mask.numel() <= self.compaction_threshold:
+            return
+
+        # For each sequence, gather the indices of its live slots, keeping them in order and left-padding to equal length
+        length = int(n_tokens.max())
+        gather_idxs = torch.argsort(self.attention_mask, dim=1, stable=True)[:, self.attention_mask.shape[1] - length:]
+        self.attention_mask = self.attention_mask.gather(1, gather_idxs)
+
+        def gather(x: torch.Tensor) -> torch.Tensor:
+            return x.gather(2, gather_idxs[:, None, :, None].expand(-1, x.shape[1], -1, x.shape[3]))
+
+        for tensors in _kv_cache_tensors(self.kv_cache):
+            tensors[:] = [gather(x) for x in tensors]
+
+
+class _StaticKVCache(StaticCache):
+    """
+    A static KV cache for one sequence, which keeps track of the number of tokens in it, so that it can be cropped
+    in constant time. Slots past the current length keep stale keys and values, which the attention mask hides.
+    """
+
+    def __init__(self, config: PretrainedConfig, max_cache_len: int, device: str, dtype: torch.dtype):
+        super().__init__(config, max_batch_size=1, max_cache_len=max_cache_len, device=device, dtype=dtype)
+        self.length = 0
+
+    def get_seq_length(self, layer_idx: int | None = 0) -> int:
+        # The model only needs the length to build the attention mask of a dynamic KV cache. Returning a constant
+        # while compiling keeps the compiled decode step from being specialized to, and recompiled for, each length.
+        if torch.compiler.is_compiling():
+            return 0
+        return self.length
+
+    def crop(self, max_length: int) -> None:
+        self.length = min(self.length, max_length)
+
+    def load(self, legacy_cache: tuple[tuple[torch.Tensor, torch.Tensor], ...]) -> None:
+        """
+        Replaces the contents of the KV cache with a copy of the keys and values in the given legacy KV cache.
+        """
+        for key_cache, value_cache, (keys, values) in zip(self.key_cache, self.value_cache, legacy_cache):
+            key_cache[:, :, :keys.shape[2]] = keys
+            value_cache[:, :, :values.shape[2]] = values
+        self.length = legacy_cache[0][0].shape[2]
+
+    def to_dynamic(self) -> DynamicCache:
+        """
+        Returns a dynamic KV cache holding the tokens in this KV cache, without copying them.
+        """
+        return DynamicCache.from_legacy_cache(tuple(
+            (key_cache[:, :, :self.length], value_cache[:, :, :self.length])
+            for key_cache, value_cache in zip(self.key_cache, self.value_cache)
+        ))
+
+
+class _QuantizedKVCache(DynamicCache, abc.ABC):
+    """
+    A dynamic KV cache that stores keys and values in 8 bits, with one scale per head and token, so that new tokens are
+    quantized once when they are added, and cropping, batch selection and padding work on the stored tensors directly.
+    The whole cache is dequantized to the dtype of the model for each attention computation.
+    """
+    storage_dtype: torch.dtype  # The dtype in which the quantized keys and values are stored
+    max_value: float  # The largest quantized value, to which the largest absolute value of each head and token is scaled
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key_scales: list[torch.Tensor] = []
+        self.value_scales: list[torch.Tensor] = []
+        self.dtype = None  # The dtype of the keys and values before quantization
+
+    def update(
+            self,
+            key_states: torch.Tensor,
+            value_states: torch.Tensor,
+            layer_idx: int,
+            cache_kwargs: dict | None = None,
+    ) -> (torch.Tensor, torch.Tensor):
+        self.dtype = key_states.dtype
+        quantized_keys, key_scales = self._quantize(key_states)
+        quantized_values, value_scales = self._quantize(value_states)
+        super().update(quantized_keys, quantized_values, layer_idx, cache_kwargs)
+        if len(self.key_scales) <= layer_idx:
+            self.key_scales.append(key_scales)
+            self.value_scales.append(value_scales)
+        else:
+            self.key_scales[layer_idx] = torch.cat([self.key_scales[layer_idx], key_scales], dim=-2)
+            self.value_scales[layer_idx] = torch.cat([self.value_scales[layer_idx], value_scales], dim=-2)
+        return (self._dequantize(self.key_cache[layer_idx], self.key_scales[layer_idx]),
+                self._dequantize(self.value_cache[layer_idx], self.value_scales[layer_idx]))
+
+    def crop(self, max_length: int) -> None:
+        super().crop(max_length)
+        self.key_scales = [scales[..., :self.get_seq_length(), :] for scales in self.key_scales]
+        self.value_scales = [scales[..., :self.get_seq_length(), :] for scales in self.value_scales]
+
+    def batch_repeat_interleave(self, repeats: int) -> None:
+        super().batch_repeat_interleave(repeats)
+        self.key_scales = [scales.repeat_interleave(repeats, dim=0) for scales in self.key_scales]
+        self.value_scales = [scales.repeat_interleave(repeats, dim=0) for scales in self.value_scales]
+
+    def batch_select_indices(self, indices: torch.Tensor) -> None:
+        super().batch_select_indices(indices)
+        self.key_scales = [scales[indices, ...] for scales in self.key_scales]
+        self.value_scales = [scales[indices, ...] for scales in self.value_scales]
+
+    def to_legacy_cache(self) -> tuple[tuple[torch.Tensor, torch.Tensor], ...]:
+        """
+        Returns the dequantized keys and values, in the legacy format.
+        """
+        return tuple((self._dequantize(keys, key_scales), self._dequantize(values, value_scales))
+                     for keys, values, key_scales, value_scales
+                     in zip(self.key_cache, self.value_cache, self.key_scales, self.value_scales))
+
+    def _quantize(self, x: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+        """
+        Quantizes keys or values of shape (batch_size, n_heads, length, head_dim).
+        :return: The quantized tensor, and the scale of each head and token, of shape (batch_size, n_heads, length, 1).
+        """
+        scales = x.abs().amax(dim=-1, keepdim=True).clamp(min=torch.finfo(x.dtype).tiny) / self.max_value
+        return self._to_storage(x / scales), scales
+
+    def _dequantize(self, x: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+        return self._from_storage(x).to(self.dtype) * scales
+
+    @abc.abstractmethod
+    def _to_storage(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Converts scaled keys or values, within [-max_value, max_value], to the storage dtype.
+        """
+
+    @abc.abstractmethod
+    def _from_storage(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Converts stored keys or values to a floating-point dtype, before scaling them back.
+        """
+
+
+class _Int8KVCache(_QuantizedKVCache):
+    storage_dtype = torch.int8
+    max_value = 127.0
+
+    def _to_storage(self, x: torch.Tensor) -> torch.Tensor:
+        return x.round().clamp(-self.max_value, self.max_value).to(torch.int8)
+
+    def _from_storage(self, x: torch.Tensor) -> torch.Tensor:
+        return x
+
+
+class _Fp8KVCache(_QuantizedKVCache):
+    """
+    Stores keys and values in fp8 (e4m3), viewed as uint8, since padding and indexing do not support fp8 on all devices.
+    """
+    storage_dtype = torch.uint8
+    max_value = torch.finfo(torch.float8_e4m3fn).max
+
+    def _to_storage(self, x: torch.Tensor) -> torch.Tensor:
+        return x.to(torch.float8_e4m3fn).view(torch.uint8)
+
+    def _from_storage(self, x: torch.Tensor) -> torch.Tensor:
+        return x.view(torch.float8_e4m3fn)
 
-    def save_state(self) -> None:
-        self.kv_cache_saved = copy.deepcopy(self.kv_cache)
-        self.input_ids_cache_saved = self.input_ids_cache
 
-    def rollback_to_saved_state(self) -> None:
-        self.kv_cache = self.kv_cache_saved
-        self.input_ids_cache = self.input_ids_cache_saved
+def _kv_cache_tensors(kv_cache: DynamicCache) -> list[list[torch.Tensor]]:
+    """
+    Returns the lists of per-layer tensors stored in a dynamic KV cache, each of shape (batch_size, n_heads, length, ...),
+    including the scales of a quantized KV cache, so that they can be updated together along the batch or sequence
+    dimension.
+    """
+    tensors = [kv_cache.key_cache, kv_cache.value_cache]
+    if isinstance(kv_cache, _QuantizedKVCache):
+        tensors += [kv_cache.key_scales, kv_cache.value_scales]
+    return tensors
+
+
+def kv_cache_nbytes(kv_cache: Cache | None) -> int:
+    """
+    Returns the number of bytes of memory used by the keys and values of a KV cache, including any quantization scales.
+    """
+    if kv_cache is None:
+        return 0
+    if isinstance(kv_cache, StaticCache):
+        tensors = [kv_cache.key_cache, kv_cache.value_cache]
+    else:
+        tensors = _kv_cache_tensors(kv_cache)
+    return sum(x.numel() * x.element_size() for layer_tensors in tensors for x in layer_tensors)
+
+
+def _decode_step(
+        model: torch.nn.Module,
+        input_ids: torch.Tensor,
+        cache_position: torch.Tensor,
+        kv_cache: _StaticKVCache,
+) -> torch.Tensor:
+    """
+    Runs the model on one token in a static KV cache, returning its logits. Compiled by LLM.enable_static_cache().
+    """
+    return model(input_ids, past_key_values=kv_cache, cache_position=cache_position, logits_to_keep=1).logits
+
+
+def _load_pretrained_model(
+        model_name: str,
+        device: str,
+        quantization: Literal['none', 'bf16', 'int8', 'int4'] = 'none',
+) -> torch.nn.Module:
+    """
+    Loads a causal language model with the given weight format. See LLM.__init__().
+    """
+    match quantization:
+        case 'none':
+            return AutoModelForCausalLM.from_pretrained(model_name).to(device)
+        case 'bf16':
+            return AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16).to(device)
+        case 'int8':
+            if device != 'cpu':
+                raise ValueError('int8 quantization is only supported on CPU')
+            model = AutoModelForCausalLM.from_pretrained(model_name)
+            return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        case 'int4':
+            try:
+                from torchao.dtypes import Int4CPULayout, TensorCoreTiledLayout
+                from torchao.quantization import Int4WeightOnlyConfig, quantize_
+            except ImportError as e:
+                raise ImportError('int4 quantization requires torchao. '
+                                  'Install it with `uv sync --extra quantization`.') from e
+            group_size = 32
+            model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16).to(device)
+            layout = Int4CPULayout() if device == 'cpu' else TensorCoreTiledLayout(inner_k_tiles=8)
+
+            # The packed int4 kernels only support layers whose dimensions are multiples of these sizes
+            def filter_fn(module: torch.nn.Module, _fqn: str) -> bool:
+                return (isinstance(module, torch.nn.Linear)
+                        and module.out_features % 16 == 0 and module.in_features % max(group_size, 16) == 0)
+
+            quantize_(model, Int4WeightOnlyConfig(group_size=group_size, layout=layout), filter_fn=filter_fn)
+            return model
+        case _:
+            raise ValueError(f'Unknown quantization: {quantization}')
+
+
+def _concat_kv_caches(kv_cache_1: DynamicCache, kv_cache_2: DynamicCache) -> DynamicCache:
+    """
+    Concatenates two KV caches of the same class along the batch dimension, left-padding whichever is shorter.
+    The result is stored in the first KV cache, which is returned.
+    """
+    length_1, length_2 = kv_cache_1.get_seq_length(), kv_cache_2.get_seq_length()
+
+    def pad(x: torch.Tensor, length: int) -> torch.Tensor:
+        return F.pad(x, (0, 0, max(length_1, length_2) - length, 0))
+
+    for tensors_1, tensors_2 in zip(_kv_cache_tensors(kv_cache_1), _kv_cache_tensors(kv_cache_2)):
+        tensors_1[:] = [torch.cat([pad(x_1, length_1), pad(x_2, length_2)]) for x_1, x_2 in zip(tensors_1, tensors_2)]
+    return kv_cache_1
+
+
+def _sample_next_tokens(
+        logits: torch.Tensor,
+        allowed_mask: torch.Tensor | None,
+        temperature: float | torch.Tensor,
+        generators: list[torch.Generator] | None = None,
+        top_k: int | None = None,
+        top_p: float | None = None,
+) -> torch.Tensor:
+    """
+    Samples the next token of each sequence from the given logits, of shape (batch_size, vocab_size).
+    :param allowed_mask: A boolean mask of allowed tokens, of shape (vocab_size,) or (batch_size, vocab_size).
+    :param temperature: The sampling temperature, as a float or a tensor of shape (batch_size, 1).
+    :param generators: A random number generator for each sequence. If None, the global generator is used.
+    :return: The sampled token ids, of shape (batch_size, 1).
+    """
+    probs = _next_token_probs(logits, allowed_mask, temperature, top_k, top_p)
+    if generators is None:
+        return torch.multinomial(probs, num_samples=1)
+    return torch.stack([torch.multinomial(p, num_samples=1, generator=g) for p, g in zip(probs, generators)])
+
+
+def _next_token_probs(
+        logits: torch.Tensor,
+        allowed_mask: torch.Tensor | None,
+        temperature: float | torch.Tensor,
+        top_k: int | None = None,
+        top_p: float | None = None,
+) -> torch.Tensor:
+    """
+    Returns the probability distribution of the next token of each sequence, of shape (batch_size, vocab_size),
+    after applying logit masking, temperature, top-k and nucleus filtering to the given logits. See _sample_next_tokens().
+    """
+    if allowed_mask is not None:
+        logits = logits.masked_fill(~allowed_mask, -torch.inf)
+    logits = logits / temperature
+    if top_k is not None:
+        kth_largest = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_largest, -torch.inf)
+    if top_p is not None and top_p < 1:
+        sorted_logits, sorted_idxs = torch.sort(logits, dim=-1, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        sorted_remove = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p  # Always keep the most likely token
+        logits = logits.masked_fill(sorted_remove.scatter(1, sorted_idxs, sorted_remove), -torch.inf)
+    return torch.softmax(logits, dim=-1)
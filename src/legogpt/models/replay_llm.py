@@ -0,0 +1,217 @@
+import json
+from pathlib import Path
+from typing import Callable, Literal
+
+import torch
+from transformers import AutoTokenizer
+
+from .llm import LLMBackend, LLMState
+
+recording_filename = 'recording.jsonl'
+
+
+class RecordingLLM:
+    """
+    Wraps an LLM backend, and records the prompts, the generated tokens and the allowed tokens of each generated token
+    to a directory, together with the tokenizer, so that the session can be replayed without a model by ReplayLLM.
+    Each call is written to the recording file, which is closed after every write, as soon as it returns, so that
+    the recording is complete up to the last call even if the session is interrupted. All other attributes are those
+    of the wrapped LLM. Only supports a batch size of 1.
+    """
+
+    def __init__(self, llm: LLMBackend, recording_dir: str | Path):
+        """
+        :param llm: The LLM backend to record.
+        :param recording_dir: The directory to which to write the recording. An existing recording is overwritten.
+        """
+        self.llm = llm
+        recording_dir = Path(recording_dir)
+        recording_dir.mkdir(parents=True, exist_ok=True)
+        llm.tokenizer.save_pretrained(recording_dir)
+        self.recording_path = recording_dir / recording_filename
+        self.recording_path.write_text('')
+        self._record({'vocab_size': llm.vocab_size})
+
+    def __getattr__(self, name: str):
+        return getattr(self.llm, name)
+
+    def prefill(self, prompt: str | torch.Tensor) -> None:
+        self.llm.prefill(prompt)
+        self._record({'call': 'prefill', 'prompt': self._encode(prompt)})
+
+    def generate_constrained(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+    ) -> torch.Tensor:
+        result_ids = self.llm.generate_constrained(allowed_token_mask_fn, max_new_tokens, prompt, temperature)
+        self._record_generation(allowed_token_mask_fn, prompt, result_ids)
+        return result_ids
+
+    def generate_speculative(
+            self,
+            propose_fn: Callable[[torch.Tensor, torch.Tensor, int], tuple[torch.Tensor, torch.Tensor | None]],
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            **kwargs,
+    ) -> torch.Tensor:
+        """
+        Records speculative decoding like generate_constrained(), since both generate the same token stream.
+        """
+        result_ids = self.llm.generate_speculative(propose_fn, allowed_token_mask_fn, max_new_tokens, prompt, **kwargs)
+        self._record_generation(allowed_token_mask_fn, prompt, result_ids)
+        return result_ids
+
+    def expand_batch(self, batch_size: int) -> None:
+        raise NotImplementedError('Recording only supports a batch size of 1')
+
+    def _record_generation(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            prompt: str | torch.Tensor | None,
+            result_ids: torch.Tensor,
+    ) -> None:
+        allowed_tokens = [torch.nonzero(allowed_token_mask_fn(idx, result_ids[:, :idx]).view(-1))[:, 0].tolist()
+                          for idx in range(result_ids.shape[1])]
+        self._record({
+            'call': 'generate',
+            'prompt': None if prompt is None else self._encode(prompt),
+            'tokens': result_ids[0].tolist(),
+            'allowed_tokens': allowed_tokens,
+        })
+
+    def _encode(self, prompt: str | torch.Tensor) -> list[int]:
+        return self.llm._encode_prompt(prompt)[0][0].tolist()
+
+    def _record(self, record: dict) -> None:
+        with open(self.recording_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class ReplayLLM:
+    """
+    An LLM backend that replays a session recorded by RecordingLLM without running any model: each call to
+    generate_constrained() returns the tokens generated by the corresponding call in the recording. The masks of allowed
+    tokens are still computed for every token, so replaying a generation measures everything but the model's forward
+    passes: masking, validation, LegoStructure updates, stability analysis and bookkeeping. Generation must make the same
+    calls as the recorded session, i.e. use the same captions and config, except for the LLM backend and the draft model;
+    if it diverges from the recording, a RuntimeError is raised. There is no model, so batched generation, the static
+    KV cache and KV cache quantization are not supported, and neither is a brick_sample_batch_size above 1.
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            device: str = 'cpu',
+            quantization: Literal['none', 'bf16', 'int8', 'int4'] = 'none',
+            check_masks: bool = False,
+    ):
+        """
+        :param model_name: The path of a directory to which a session was recorded by RecordingLLM.
+        :param device: The device on which to return tensors.
+        :param quantization: Only 'none' is supported, since no model is run.
+        :param check_masks: Whether to check that the masks of allowed tokens match the recorded masks exactly.
+                            Otherwise, only the generated tokens are checked to be allowed.
+        """
+        if quantization != 'none':
+            raise ValueError('The replay backend does not support quantization')
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.check_masks = check_masks
+        with open(Path(model_name) / recording_filename) as f:
+            header, *self.records = (json.loads(line) for line in f)
+        self._vocab_size = header['vocab_size']
+        self.n_replayed = 0  # The number of records replayed so far
+
+        self.input_ids_cache = None
+        self.saved_state = None
+
+    @property
+    def vocab_size(self) -> int:
+        return self._vocab_size
+
+    @property
+    def batch_size(self) -> int:
+        return 1
+
+    def prefill(self, prompt: str | torch.Tensor) -> None:
+        record = self._next_record('prefill')
+        self.input_ids_cache = self._check_prompt(record, prompt)
+
+    def generate_constrained(
+            self,
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+    ) -> torch.Tensor:
+        record = self._next_record('generate')
+        input_ids = self.input_ids_cache if prompt is None else self._check_prompt(record, prompt)
+
+        result_ids = torch.tensor([record['tokens']], device=self.device)
+        for idx, (token_id, allowed_tokens) in enumerate(zip(record['tokens'], record['allowed_tokens'])):
+            allowed_mask = allowed_token_mask_fn(idx, result_ids[:, :idx]).view(-1)
+            if not allowed_mask[token_id] or (
+                    self.check_masks and torch.nonzero(allowed_mask)[:, 0].tolist() != allowed_tokens):
+                raise RuntimeError(f'Replay diverged from the recording: the allowed tokens of token {idx} '
+                                   f'of record {self.n_replayed - 1} differ from the recorded ones')
+
+        self.input_ids_cache = torch.cat([input_ids, result_ids], dim=1)
+        return result_ids
+
+    def generate_speculative(
+            self,
+            propose_fn: Callable[[torch.Tensor, torch.Tensor, int], tuple[torch.Tensor, torch.Tensor | None]],
+            allowed_token_mask_fn: Callable[[int, torch.Tensor], torch.Tensor],
+            max_new_tokens: int,
+            prompt: str | torch.Tensor | None = None,
+            **kwargs,
+    ) -> torch.Tensor:
+        """
+        Replays the recorded tokens like generate_constrained(), without proposing drafts.
+        """
+        return self.generate_constrained(allowed_token_mask_fn, max_new_tokens, prompt)
+
+    def cache_prompt_prefix(self, prefix: str | torch.Tensor) -> None:
+        pass
+
+    def enable_static_cache(self, max_cache_len: int) -> bool:
+        raise NotImplementedError('The replay backend does not support the static KV cache')
+
+    def enable_kv_cache_quantization(self, dtype: Literal['int8', 'fp8']) -> None:
+        raise NotImplementedError('The replay backend does not support KV cache quantization')
+
+    def save_state(self) -> LLMState:
+        self.saved_state = LLMState(
+            kv_cache=None,
+            kv_cache_length=0 if self.input_ids_cache is None else self.input_ids_cache.shape[1] - 1,
+            input_ids=self.input_ids_cache,
+            batch_size=1,
+        )
+        return self.saved_state
+
+    def rollback_to_saved_state(self, state: LLMState | None = None) -> None:
+        if state is None:
+            state = self.saved_state
+        self.input_ids_cache = state.input_ids
+
+    def _next_record(self, call: str) -> dict:
+        if self.n_replayed >= len(self.records):
+            raise RuntimeError('Replay diverged from the recording: the recording has no more calls')
+        record = self.records[self.n_replayed]
+        if record['call'] != call:
+            raise RuntimeError(f'Replay diverged from the recording: expected a call to {record["call"]} '
+                               f'at record {self.n_replayed}, but got a call to {call}')
+        self.n_replayed += 1
+        return record
+
+    def _check_prompt(self, record: dict, prompt: str | torch.Tensor) -> torch.Tensor:
+        input_ids = (self.tokenizer(prompt, return_tensors='pt')['input_ids'] if isinstance(prompt, str)
+                     else prompt).to(self.device)
+        if record['prompt'] != input_ids[0].tolist():
+            raise RuntimeError(f'Replay diverged from the recording: the prompt of record {self.n_replayed - 1} '
+                               f'differs from the recorded one')
+        return input_ids
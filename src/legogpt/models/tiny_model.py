@@ -0,0 +1,86 @@
+import json
+import string
+from pathlib import Path
+
+import torch
+from tokenizers import Regex, Tokenizer, decoders, models, pre_tokenizers
+from transformers import AutoConfig, AutoModelForCausalLM, PreTrainedTokenizerFast
+
+
+def create_tiny_model(
+        output_dir: str | Path,
+        config_dir: str | Path,
+        hidden_size: int = 64,
+        num_hidden_layers: int = 2,
+        seed: int = 0,
+        eos_logit_offset: float = 0.0,
+) -> str:
+    """
+    Creates a tiny, randomly initialized LLaMA model, for running LegoGPT offline in tests and benchmarks.
+    The model config, special tokens and chat template are taken from the fine-tuning config files,
+    with the model scaled down and the vocabulary replaced by a small word-level vocabulary in which
+    every number, separator and printable character in a LEGO brick is a single token.
+    :param output_dir: The directory in which to save the model and tokenizer.
+    :param config_dir: The directory containing config.json, tokenizer_config.json and special_tokens_map.json,
+                       e.g. finetuning_config_files in the LegoGPT repository, which is not installed with the package.
+    :param hidden_size: The hidden size of the model.
+    :param num_hidden_layers: The number of layers of the model.
+    :param seed: The random seed with which to initialize the model weights.
+    :param eos_logit_offset: An offset added to the logit of the EOS token, relative to the other tokens.
+                             A large negative offset keeps the model generating bricks until max_bricks is reached.
+    :return: The path of the saved model, which can be used as model_name_or_path.
+    """
+    output_dir = Path(output_dir)
+    config_dir = Path(config_dir)
+    with open(config_dir / 'tokenizer_config.json') as f:
+        tokenizer_config = json.load(f)
+    with open(config_dir / 'special_tokens_map.json') as f:
+        special_tokens_map = json.load(f)
+
+    # Build tokenizer
+    special_tokens = {name: token['content'] for name, token in special_tokens_map.items()}
+    header_tokens = ['<|start_header_id|>', '<|end_header_id|>']
+    vocab = {}
+    for token in ['<unk>', *(str(i) for i in range(100)), 'x', ' (', ',', ')\n', *string.printable]:
+        vocab.setdefault(token, len(vocab))
+    tokenizer_object = Tokenizer(models.WordLevel(vocab, unk_token='<unk>'))
+    tokenizer_object.pre_tokenizer = pre_tokenizers.Split(Regex(r'\d+|x| \(|\)\n|[\s\S]'), behavior='isolated')
+    tokenizer_object.decoder = decoders.Fuse()
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer_object,
+        unk_token='<unk>',
+        additional_special_tokens=header_tokens,
+        chat_template=tokenizer_config['chat_template'],
+        **special_tokens,
+    )
+    tokenizer.save_pretrained(output_dir)
+
+    # Build model
+    config = AutoConfig.from_pretrained(config_dir)
+    config.update({
+        'vocab_size': len(tokenizer),
+        'hidden_size': hidden_size,
+        'intermediate_size': hidden_size * 4,
+        'num_hidden_layers': num_hidden_layers,
+        'num_attention_heads': 4,
+        'num_key_value_heads': 2,
+        'head_dim': hidden_size // 4,
+        'bos_token_id': tokenizer.bos_token_id,
+        'eos_token_id': tokenizer.eos_token_id,
+        'pad_token_id': tokenizer.pad_token_id,
+        'torch_dtype': 'float32',
+    })
+    torch.manual_seed(seed)
+    model = AutoModelForCausalLM.from_config(config)
+
+    # Shift the logit of EOS. Every token embedding gets a constant first component, which dominates the normalized
+    # final hidden state, so the first component of each output embedding acts as a bias on its logit.
+    if eos_logit_offset:
+        with torch.no_grad():
+            model.get_input_embeddings().weight[:, 0] = 1
+            model.get_output_embeddings().weight[:, 0] = 1
+            model.get_output_embeddings().weight[tokenizer.eos_token_id, 0] += eos_logit_offset / hidden_size ** 0.5
+
+    model.save_pretrained(output_dir)
+
+    return str(output_dir)
@@ -0,0 +1,196 @@
+import contextlib
+import dataclasses
+import hashlib
+import json
+import sqlite3
+import time
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from legogpt.data import LegoStructure
+from legogpt.models import LegoGPTConfig
+
+_eviction_batch_size = 64  # The number of least recently used outputs looked up at a time when evicting
+
+# Config fields that do not change the generated structures, and so are left out of cache keys
+_output_independent_fields = {'use_prompt_prefix_cache', 'return_trace', 'record_path'}
+
+
+@dataclass
+class ResultCacheConfig:
+    cache_path: str | None = field(
+        default=None,
+        metadata={'help': 'The path of an SQLite database in which to cache the outputs of seeded generation requests, '
+                          'shared by all processes that use the same path. Captions are normalized before generation '
+                          'if the cache is enabled. If None, no cache is used.'},
+    )
+    cache_max_size_mb: float = field(
+        default=1024,
+        metadata={'help': 'The maximum total size of the cached outputs, in MiB. '
+                          'The least recently used outputs are evicted first.'},
+    )
+
+
+class ResultCache:
+    """
+    A cache of the outputs of LegoGPT on disk, keyed by the hash of everything that determines the output of a seeded
+    generation: the normalized caption, the seed, the config fields that affect generation, and the model revision.
+    The cache is an SQLite database, which can be shared safely by several processes. Once its total size exceeds
+    the maximum size, the least recently used outputs are evicted.
+    """
+
+    def __init__(self, path: str | Path, cfg: LegoGPTConfig, max_size_mb: float = 1024, namespace: str = ''):
+        """
+        :param path: The path of the database file, which is created if it does not exist.
+        :param cfg: The config of the LegoGPT model whose outputs are cached.
+        :param max_size_mb: The maximum total size of the cached outputs, in MiB.
+        :param namespace: A name for the way outputs are generated, e.g. by LegoGPT.__call__ or by LegoGPTBatch,
+                          which can give different outputs for the same seed.
+        """
+        self.path = Path(path)
+        self.max_size = int(max_size_mb * 2 ** 20)
+        self.stats = Counter()  # Hits and misses in this process
+
+        config_fields = {name: value for name, value in dataclasses.asdict(cfg).items()
+                         if name not in _output_independent_fields}
+        self._config_key = json.dumps({
+            'namespace': namespace,
+            'config': config_fields,
+            'model_revision': model_revision(cfg.model_name_or_path),
+        }, sort_keys=True)
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('CREATE TABLE IF NOT EXISTS outputs ('
+                               'key TEXT PRIMARY KEY, output TEXT NOT NULL, metadata TEXT NOT NULL, '
+                               'size INTEGER NOT NULL, last_access REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS outputs_last_access ON outputs (last_access)')
+            # The total size of the outputs, kept up to date by put() so that it does not scan the outputs
+            connection.execute('CREATE TABLE IF NOT EXISTS total_size (size INTEGER NOT NULL)')
+            connection.execute('INSERT INTO total_size SELECT COALESCE(SUM(size), 0) FROM outputs '
+                               'WHERE NOT EXISTS (SELECT * FROM total_size)')
+
+    def key(self, caption: str, seed: int) -> str:
+        """
+        Returns the cache key of a generation request.
+        """
+        request = json.dumps({'caption': normalize_caption(caption), 'seed': seed})
+        return hashlib.sha256((self._config_key + request).encode()).hexdigest()
+
+    def get(self, caption: str, seed: int) -> dict | None:
+        """
+        Returns the cached output for the given caption and seed, in the same format as LegoGPT.__call__,
+        or None if it is not cached.
+        """
+        key = self.key(caption, seed)
+        with self._connect() as connection:
+            row = connection.execute('SELECT output FROM outputs WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                connection.execute('UPDATE outputs SET last_access = ? WHERE key = ?', (time.time(), key))
+        self.stats['hits' if row is not None else 'misses'] += 1
+        return None if row is None else _deserialize_output(row[0])
+
+    def put(self, caption: str, seed: int, output: dict) -> None:
+        """
+        Caches the output of LegoGPT for the given caption and seed, evicting the least recently used outputs
+        if the cache is full.
+        """
+        key = self.key(caption, seed)
+        serialized_output = _serialize_output(output)
+        metadata = json.dumps({'caption': normalize_caption(caption), 'seed': seed, 'created': time.time()})
+        size = len(serialized_output) + len(metadata)
+        with self._connect() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            replaced_row = connection.execute('SELECT size FROM outputs WHERE key = ?', (key,)).fetchone()
+            connection.execute('INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                               (key, serialized_output, metadata, size, time.time()))
+            total_size = self._add_to_total_size(connection, size - (replaced_row[0] if replaced_row else 0))
+
+            # Evict the least recently used outputs, a batch at a time, until the cache is no longer full
+            while total_size > self.max_size:
+                rows = connection.execute('SELECT key, size FROM outputs ORDER BY last_access LIMIT ?',
+                                          (_eviction_batch_size,)).fetchall()
+                if not rows:
+                    break
+                evicted_size = 0
+                for evicted_key, evicted_size_ in rows:
+                    if total_size - evicted_size <= self.max_size:
+                        break
+                    connection.execute('DELETE FROM outputs WHERE key = ?', (evicted_key,))
+                    evicted_size += evicted_size_
+                total_size = self._add_to_total_size(connection, -evicted_size)
+
+    @staticmethod
+    def _add_to_total_size(connection: sqlite3.Connection, size: int) -> int:
+        """
+        Adds to the total size of the cached outputs within the current transaction.
+        :return: The new total size.
+        """
+        connection.execute('UPDATE total_size SET size = size + ?', (size,))
+        return connection.execute('SELECT size FROM total_size').fetchone()[0]
+
+    def __len__(self) -> int:
+        with self._connect() as connection:
+            return connection.execute('SELECT COUNT(*) FROM outputs').fetchone()[0]
+
+    @contextlib.contextmanager
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Opens a connection to the database for one transaction, which is committed on success. A new connection
+        is opened every time, so that the cache can be used from any thread.
+        """
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            yield connection
+            if connection.in_transaction:
+                connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+
+def normalize_caption(caption: str) -> str:
+    """
+    Normalizes the Unicode representation and whitespace of a caption, so that trivially different captions
+    share a cache entry.
+    """
+    return ' '.join(unicodedata.normalize('NFC', caption).split())
+
+
+def model_revision(model_name_or_path: str) -> str | None:
+    """
+    Returns an identifier of the version of a model: for a local directory, a hash of the names, sizes and modification
+    times of its files, and for a model on the HuggingFace Hub, the commit hash of the locally cached snapshot.
+    Returns None if the model is not available locally.
+    """
+    path = Path(model_name_or_path)
+    if path.is_dir():
+        files = sorted(file for file in path.rglob('*') if file.is_file())
+        file_stats = [(str(file.relative_to(path)), file.stat().st_size, file.stat().st_mtime_ns) for file in files]
+        return hashlib.sha256(json.dumps(file_stats).encode()).hexdigest()
+
+    from huggingface_hub import snapshot_download
+    try:
+        return Path(snapshot_download(model_name_or_path, local_files_only=True)).name
+    except Exception:
+        return None
+
+
+def _serialize_output(output: dict) -> str:
+    serialized_output = {'lego': output['lego'].to_txt(), 'counters': {}, 'values': {}}
+    for name, value in output.items():
+        if isinstance(value, Counter):
+            serialized_output['counters'][name] = dict(value)
+        elif isinstance(value, (int, float, str)):
+            serialized_output['values'][name] = value
+    return json.dumps(serialized_output)
+
+
+def _deserialize_output(serialized_output: str) -> dict:
+    serialized_output = json.loads(serialized_output)
+    return ({'lego': LegoStructure.from_txt(serialized_output['lego'])}
+            | {name: Counter(value) for name, value in serialized_output['counters'].items()}
+            | serialized_output['values'])
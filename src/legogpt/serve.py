@@ -0,0 +1,306 @@
+import asyncio
+import gc
+import json
+import os
+import signal
+import socket
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http import HTTPStatus
+
+import torch
+from transformers import HfArgumentParser
+
+from legogpt.models import LegoGPT, LegoGPTBatch, LegoGPTConfig
+from legogpt.result_cache import ResultCache, ResultCacheConfig, normalize_caption
+
+
+@dataclass
+class ServerConfig:
+    host: str = field(
+        default='127.0.0.1',
+        metadata={'help': 'The host on which to listen for requests.'},
+    )
+    port: int = field(
+        default=8000,
+        metadata={'help': 'The port on which to listen for requests.'},
+    )
+    max_batch_size: int = field(
+        default=16,
+        metadata={'help': 'The maximum number of requests to generate together in one batch. '
+                          'Further requests wait in a queue until a place in the batch is free.'},
+    )
+    n_workers: int = field(
+        default=1,
+        metadata={'help': 'The number of worker processes with which to serve requests. The model is loaded once, '
+                          'and the workers are forked from the loading process, so that they share the model weights '
+                          'copy-on-write instead of each loading its own copy. Each worker generates its own batch, '
+                          'and the CPU cores are divided evenly between the intra-op thread pools of the workers. '
+                          'Only supported on the CPU, on platforms that support fork.'},
+    )
+
+
+class LegoGPTServer:
+    """
+    Serves LegoGPT generation requests over HTTP, using continuous batching: active requests are generated together
+    in one LegoGPTBatch, with new requests joining and finished requests leaving the batch between bricks.
+
+    Endpoints:
+    - POST /generate with a JSON body {"caption": str, "seed": int (optional)}. Responds with the JSON object
+      {"lego": str, "rejection_reasons": dict, "n_regenerations": int, "stability_checkpoints": dict}
+      once generation is finished.
+    - GET /health. Responds with the JSON object {"status": "ok", "n_active": int, "n_queued": int}.
+    """
+
+    def __init__(self, legogpt: LegoGPT, max_batch_size: int = 16, cache: ResultCache | None = None):
+        """
+        :param legogpt: The model with which to generate.
+        :param max_batch_size: The maximum number of requests to generate together in one batch.
+        :param cache: If given, the outputs of requests with a seed are cached in it, and requests whose output
+                      is cached are answered without generating.
+        """
+        self.legogpt = legogpt
+        self.max_batch_size = max_batch_size
+        self.cache = cache
+
+        self.batch = LegoGPTBatch(legogpt)
+        self._queue = asyncio.Queue()  # Requests waiting for a place in the batch
+        self._futures = {}  # Maps the id of each structure in the batch to the future awaiting its output
+        self._executor = ThreadPoolExecutor(max_workers=1)  # Runs the model without blocking the event loop
+        self._scheduler_task = None
+
+    async def generate(self, caption: str, seed: int | None = None) -> dict:
+        """
+        Generates a LEGO structure for the given caption, once a place in the batch is free.
+        :return: The output, in the same format as LegoGPT.__call__.
+        """
+        use_cache = self.cache is not None and seed is not None
+        if use_cache:
+            caption = normalize_caption(caption)
+            output = await asyncio.to_thread(self.cache.get, caption, seed)
+            if output is not None:
+                return output
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((caption, seed, future))
+        output = await future
+        if use_cache and output['degradation_level'] == 'none':  # Degraded outputs depend on timing, so are not cached
+            await asyncio.to_thread(self.cache.put, caption, seed, output)
+        return output
+
+    async def start(self, host: str | None, port: int | None, sock: socket.socket | None = None) -> asyncio.Server:
+        """
+        Starts the scheduler and the HTTP server. The server keeps running until it is closed.
+        :param sock: A listening socket on which to accept connections, instead of a new one bound to host and port.
+        """
+        self._scheduler_task = asyncio.create_task(self._run_scheduler())
+        if sock is not None:
+            return await asyncio.start_server(self._handle_connection, sock=sock)
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def _run_scheduler(self) -> None:
+        """
+        Repeatedly admits queued requests into the batch and generates one brick for every request in the batch.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            # Admit queued requests, waiting for one if the batch is empty
+            requests = []
+            if len(self.batch) == 0:
+                requests.append(await self._queue.get())
+            while len(self.batch) + len(requests) < self.max_batch_size and not self._queue.empty():
+                requests.append(self._queue.get_nowait())
+            requests = [request for request in requests if not request[2].done()]  # Skip cancelled requests
+            if requests:
+                captions, seeds, futures = zip(*requests)
+                try:
+                    ids = await loop.run_in_executor(self._executor, self.batch.add, list(captions), list(seeds))
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                self._futures.update(zip(ids, futures))
+
+            # Remove requests that have been cancelled while in the batch
+            cancelled_ids = [id_ for id_, future in self._futures.items() if future.done()]
+            if cancelled_ids:
+                await loop.run_in_executor(self._executor, self.batch.remove, cancelled_ids)
+                for id_ in cancelled_ids:
+                    del self._futures[id_]
+            if len(self.batch) == 0:
+                continue
+
+            try:
+                outputs = await loop.run_in_executor(self._executor, self.batch.step)
+            except Exception as e:  # Fail all active requests, and start again with an empty batch
+                for future in self._futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+                self._futures.clear()
+                self.batch = LegoGPTBatch(self.legogpt)
+                continue
+
+            for id_, output in outputs.items():
+                future = self._futures.pop(id_)
+                if not future.done():
+                    future.set_result(output)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            status, response = await self._handle_request(reader)
+        except (ValueError, KeyError, TypeError) as e:
+            status, response = HTTPStatus.BAD_REQUEST, {'error': str(e)}
+        except Exception as e:
+            status, response = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)}
+
+        body = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                     'Content-Type: application/json\r\n'
+                     f'Content-Length: {len(body)}\r\n'
+                     'Connection: close\r\n\r\n'.encode() + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader) -> (HTTPStatus, dict):
+        """
+        Reads an HTTP request and returns the status and JSON body of the response.
+        """
+        request_line = (await reader.readline()).decode()
+        method, path, _ = request_line.split(' ', 2)
+        headers = {}
+        while (line := (await reader.readline()).decode().strip()) != '':
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        match method, path:
+            case 'GET', '/health':
+                return HTTPStatus.OK, {'status': 'ok', 'n_active': len(self.batch), 'n_queued': self._queue.qsize()}
+            case 'POST', '/generate':
+                request = json.loads(body)
+                caption = request['caption']
+                seed = request.get('seed')
+                if not isinstance(caption, str) or not (seed is None or isinstance(seed, int)):
+                    raise TypeError('"caption" must be a string and "seed" must be an integer')
+                output = await self.generate(caption, seed)
+                return HTTPStatus.OK, {
+                    'lego': output['lego'].to_txt(),
+                    'rejection_reasons': dict(output['rejection_reasons']),
+                    'n_regenerations': output['n_regenerations'],
+                    'stability_checkpoints': dict(output['stability_checkpoints']),
+                }
+            case _, '/health' | '/generate':
+                return HTTPStatus.METHOD_NOT_ALLOWED, {'error': f'Method {method} not allowed'}
+            case _:
+                return HTTPStatus.NOT_FOUND, {'error': f'Path {path} not found'}
+
+
+async def serve(
+        legogpt: LegoGPT,
+        cfg: ServerConfig,
+        cache: ResultCache | None = None,
+        sock: socket.socket | None = None,
+) -> None:
+    server = LegoGPTServer(legogpt, max_batch_size=cfg.max_batch_size, cache=cache)
+    http_server = await server.start(cfg.host, cfg.port, sock)
+    if sock is None:
+        print(f'Serving LegoGPT on http://{cfg.host}:{cfg.port}')
+    async with http_server:
+        await http_server.serve_forever()
+
+
+def serve_prefork(legogpt: LegoGPT, cfg: ServerConfig, cache: ResultCache | None = None) -> None:
+    """
+    Serves with cfg.n_workers worker processes, which are forked from this process after the model has been loaded
+    and accept connections from one shared listening socket. The workers share the pages of the model weights
+    copy-on-write, so memory use grows with the KV caches of the workers rather than with the size of the model.
+    Returns once all workers have exited; on SIGTERM or SIGINT, the workers are terminated first.
+    Forking after torch has started its intra-op thread pool can deadlock the workers, so this process must have run
+    all of its torch computations, including loading the model, with torch.set_num_threads(1). Each worker then sets
+    its own number of threads after it is forked.
+    """
+    if legogpt.device != 'cpu':
+        raise ValueError('Serving with several worker processes is only supported on the CPU')
+    if torch.get_num_threads() != 1:
+        raise ValueError('The model must be loaded with torch.set_num_threads(1) before forking worker processes')
+
+    sock = socket.create_server((cfg.host, cfg.port))
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()  # Not on macOS
+    n_threads = max(1, n_cpus // cfg.n_workers)
+    gc.freeze()  # Keep garbage collection in the workers from writing to, and thus copying, the pages of shared objects
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    # Handle SIGTERM before forking, so that workers that are already serving are never left behind
+    signal.signal(signal.SIGTERM, terminate)
+    pids = []
+    try:
+        for _ in range(cfg.n_workers):
+            pid = os.fork()
+            if pid == 0:
+                _run_worker(legogpt, cfg, cache, sock, n_threads)
+            pids.append(pid)
+        sock.close()
+        print(f'Serving LegoGPT on http://{cfg.host}:{cfg.port} with {cfg.n_workers} workers '
+              f'of {n_threads} threads each')
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def _run_worker(
+        legogpt: LegoGPT,
+        cfg: ServerConfig,
+        cache: ResultCache | None,
+        sock: socket.socket,
+        n_threads: int,
+) -> None:
+    """
+    Runs a forked worker process of serve_prefork() until it is terminated, then exits the process.
+    """
+    exit_code = 0
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        torch.set_num_threads(n_threads)
+        asyncio.run(serve(legogpt, cfg, cache, sock))
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def main():
+    parser = HfArgumentParser((LegoGPTConfig, ServerConfig, ResultCacheConfig))
+    cfg, server_cfg, cache_cfg = parser.parse_args_into_dataclasses()
+
+    if server_cfg.n_workers > 1:
+        torch.set_num_threads(1)  # Never start a thread pool before forking the workers; see serve_prefork()
+    legogpt = LegoGPT(cfg)
+    cache = None
+    if cache_cfg.cache_path is not None:
+        cache = ResultCache(cache_cfg.cache_path, cfg, cache_cfg.cache_max_size_mb, namespace='batch')
+    if server_cfg.n_workers > 1:
+        serve_prefork(legogpt, server_cfg, cache)
+    else:
+        asyncio.run(serve(legogpt, server_cfg, cache))
+
+
+if __name__ == '__main__':
+    main()
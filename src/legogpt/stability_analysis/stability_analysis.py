@@ -18,6 +18,7 @@ class StabilityConfig:
     world_dimension: tuple[int, int, int] = (20, 20, 20)
     alpha: float = 0.001
     beta: float = 0.000001
+    time_limit: float | None = None  # The maximum time in seconds to spend solving, or None for no limit
 
 
 def stability_score(lego_structure, lego_library, cfg=StabilityConfig()):
@@ -41,6 +42,8 @@ def stability_score(lego_structure, lego_library, cfg=StabilityConfig()):
     model.setParam("OutputFlag", print_log)
     model.Params.IterationLimit = 1000000
     model.setParam("MIPFocus", 1)
+    if cfg.time_limit is not None:
+        model.Params.TimeLimit = cfg.time_limit
     big_num = 100 * n_bricks
 
     # Define variables
@@ -469,6 +472,8 @@ def stability_score(lego_structure, lego_library, cfg=StabilityConfig()):
     solve_t = t_end - t_solve_start
     total_t = t_end - t_start
 
+    if model.Status == gp.GRB.Status.TIME_LIMIT:
+        raise TimeoutError(f'Stability analysis did not finish within the time limit of {cfg.time_limit}s')
     if model.Status != gp.GRB.Status.OPTIMAL:
         print('Model did not solve successfully. Check status code:', model.Status)
         return np.ones(world_dim), model.NumVars, model.NumConstrs, total_t, solve_t
@@ -0,0 +1,11 @@
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def finetuning_config_dir() -> Path:
+    """
+    The fine-tuning config files of the repository, from which tiny models are built for tests.
+    """
+    return Path(__file__).parents[1] / 'finetuning_config_files'
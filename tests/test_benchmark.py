@@ -0,0 +1,74 @@
+from pathlib import Path
+
+import pytest
+
+from legogpt.benchmark import BenchmarkConfig, compare_to_baseline, run_benchmark
+from legogpt.models import LegoGPT, LegoGPTConfig, create_tiny_model
+
+
+def test_benchmark(tmp_path, finetuning_config_dir: Path):
+    """
+    Tests running the benchmark on a tiny randomly initialized model, which generates bricks until max_bricks.
+    """
+    model_path = create_tiny_model(tmp_path, finetuning_config_dir, eos_logit_offset=-20)
+    legogpt = LegoGPT(LegoGPTConfig(model_path, max_bricks=2, max_regenerations=0, use_geometric_masking=True))
+    results = run_benchmark(legogpt, BenchmarkConfig(n_captions=2, n_warmup=1))
+
+    assert len(results['results']) == 2
+    assert all(result['n_bricks'] == 2 for result in results['results'])
+    summary = results['summary']
+    assert summary['bricks_per_second'] > 0 and summary['tokens_per_second'] > 0
+    assert 0 <= summary['stability_solve_share'] <= 1
+    assert summary['peak_rss_mb'] > 0
+    assert summary['peak_kv_cache_mb'] > 0
+    assert 0 <= summary['brick_validity_rate'] <= 1 and 0 <= summary['stability_rate'] <= 1
+
+    assert not compare_to_baseline(summary, summary, tolerance=0.0)
+    worse_summary = summary | {'stability_rate': summary['stability_rate'] - 0.1}
+    assert len(compare_to_baseline(worse_summary, summary, tolerance=0.05)) == 1
+
+
+def test_record_replay(tmp_path, finetuning_config_dir: Path):
+    """
+    Tests recording the benchmark on a tiny model and replaying it without a model, which should generate
+    the same LEGO structures.
+    """
+    model_path = create_tiny_model(tmp_path / 'model', finetuning_config_dir, eos_logit_offset=-20)
+    recording_path = tmp_path / 'recording'
+    benchmark_cfg = BenchmarkConfig(n_captions=2, n_warmup=1)
+
+    legogpt = LegoGPT(LegoGPTConfig(model_path, max_bricks=2, max_regenerations=0, use_geometric_masking=True,
+                                    use_geometric_draft=True, record_path=str(recording_path)))
+    results = run_benchmark(legogpt, benchmark_cfg)
+    replay_legogpt = LegoGPT(LegoGPTConfig(str(recording_path), max_bricks=2, max_regenerations=0,
+                                           use_geometric_masking=True, use_geometric_draft=True, backend='replay'))
+    replay_results = run_benchmark(replay_legogpt, benchmark_cfg)
+
+    assert ([result['n_bricks'] for result in replay_results['results']]
+            == [result['n_bricks'] for result in results['results']])
+    assert replay_legogpt.llm.n_replayed == len(replay_legogpt.llm.records)
+
+    # Generating something else than the recorded session is detected
+    with pytest.raises(RuntimeError, match='diverged'):
+        replay_legogpt('A different caption.')
+
+    # Options that need a model are rejected up front
+    for options in ({'use_static_cache': True}, {'kv_cache_quantization': 'int8'}, {'brick_sample_batch_size': 2},
+                    {'best_of_n': 2}, {'use_logit_masking': False}):
+        with pytest.raises(ValueError, match='replay backend'):
+            LegoGPT(LegoGPTConfig(str(recording_path), backend='replay', **options))
+
+
+def test_record_unsupported_config(tmp_path, finetuning_config_dir: Path):
+    """
+    Tests that generation that cannot be recorded is rejected up front, instead of failing or recording nothing.
+    """
+    model_path = create_tiny_model(tmp_path / 'model', finetuning_config_dir)
+    recording_path = str(tmp_path / 'recording')
+    for kwargs in ({'use_logit_masking': False}, {'brick_sample_batch_size': 2}, {'best_of_n': 2}):
+        with pytest.raises(ValueError, match='Recording requires'):
+            LegoGPT(LegoGPTConfig(model_path, record_path=recording_path, **kwargs))
+
+    legogpt = LegoGPT(LegoGPTConfig(model_path, max_bricks=2, max_regenerations=0, record_path=recording_path))
+    with pytest.raises(ValueError, match='cannot be recorded'):
+        legogpt.generate_batch(['A basic chair.'])
@@ -63,3 +63,4 @@ def test_finish_partial_structure():
     print(lego)
     print('# of bricks:', len(lego))
     print('Brick rejection reasons:', rejections)
+
@@ -62,6 +62,13 @@ def test_stability_check(brick_txt: str, is_stable: bool):
     assert lego.is_stable() == is_stable
 
 
+def test_stability_time_limit():
+    lego = LegoStructure.from_txt('1x2 (0,0,0)\n1x2 (0,0,1)\n')
+    with pytest.raises(TimeoutError):
+        lego.is_stable(time_limit=0)
+    assert lego.is_stable(time_limit=60)
+
+
 @pytest.mark.parametrize(
     'brick_txt,is_in_bounds', [
         ('2x6 (0,0,0)\n', True),
@@ -72,3 +79,18 @@ def test_in_bounds(brick_txt: str, is_in_bounds: bool):
     lego = LegoStructure([], world_dim=20)
     brick = LegoBrick.from_txt(brick_txt)
     assert lego.brick_in_bounds(brick) == is_in_bounds
+
+
+@pytest.mark.parametrize(
+    'brick_txt', [
+        '2x6 (0,0,0)\n',  # On the ground
+        '2x6 (0,1,1)\n',  # Supported from below
+        '2x6 (0,0,1)\n',  # Collision
+        '2x6 (3,0,1)\n',  # Floating
+        '2x6 (19,0,0)\n',  # Out of bounds
+    ])
+def test_valid_brick_positions(brick_txt: str):
+    lego = LegoStructure.from_txt('2x6 (0,0,0)\n2x6 (2,0,0)\n')
+    brick = LegoBrick.from_txt(brick_txt)
+    is_valid = lego.brick_in_bounds(brick) and not lego.brick_collides(brick) and not lego.brick_floats(brick)
+    assert lego.valid_brick_positions(brick.h, brick.w)[brick.x, brick.y, brick.z] == is_valid
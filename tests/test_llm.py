@@ -0,0 +1,541 @@
+import itertools
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+from legogpt.data import LegoBrick, LegoStructure
+from legogpt.models import LLM, LegoGPT, LegoGPTBatch, LegoGPTConfig, create_tiny_model, export_onnx
+from legogpt.models.legogpt import _RejectedBrickTrie
+from legogpt.models.llm import kv_cache_nbytes
+
+
+@pytest.fixture(scope='module')
+def tiny_model_path(tmp_path_factory, finetuning_config_dir: Path) -> str:
+    return create_tiny_model(tmp_path_factory.mktemp('tiny_model'), finetuning_config_dir)
+
+
+def test_save_and_rollback_state(tiny_model_path: str):
+    """
+    Tests that rolling back to a saved state, which crops the KV cache instead of copying it, continues generation
+    with the same seed exactly as from a fresh prefill of the same prompt, also after expanding the batch.
+    """
+    llm = LLM(tiny_model_path, 'cpu')
+    prompt = 'A basic chair with four legs.'
+    llm.prefill(prompt)
+    state = llm.save_state()
+    torch.manual_seed(0)
+    output_ids = llm(return_as_ids=True, max_new_tokens=10)
+
+    llm.expand_batch(3)
+    llm(return_as_ids=True, max_new_tokens=5)
+    llm.rollback_to_saved_state(state)
+    assert llm.batch_size == 1 and llm.kv_cache.get_seq_length() == state.kv_cache_length
+    torch.manual_seed(0)
+    assert torch.equal(llm(return_as_ids=True, max_new_tokens=10), output_ids)
+
+    llm.prefill(prompt)
+    torch.manual_seed(0)
+    assert torch.equal(llm(return_as_ids=True, max_new_tokens=10), output_ids)
+
+
+def test_generate_constrained(tiny_model_path: str):
+    """
+    Tests that decoding a brick with generate_constrained() samples the same tokens with the same seed
+    as generate() with the same masks of allowed tokens.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5))
+    allowed_token_mask_fn = legogpt._build_allowed_token_mask_fn()
+    prompt = legogpt._build_prompt('A basic chair with four legs.')
+    n_tokens = len(legogpt._brick_template)
+
+    def prefix_allowed_tokens_fn(batch_id: int, input_ids: torch.Tensor) -> list[int]:
+        return torch.nonzero(allowed_token_mask_fn(len(input_ids) - prompt.shape[1], input_ids))[:, 0].tolist()
+
+    for seed in range(3):
+        torch.manual_seed(seed)
+        result_ids = legogpt.llm.generate_constrained(allowed_token_mask_fn, n_tokens, prompt)
+        torch.manual_seed(seed)
+        expected_ids = legogpt.llm(prompt, return_as_ids=True, max_new_tokens=n_tokens, top_k=None, top_p=None,
+                                   prefix_allowed_tokens_fn=prefix_allowed_tokens_fn)
+        assert torch.equal(result_ids[0], expected_ids)
+
+
+@pytest.mark.parametrize('instruction_format', ['legogpt', 'few_shot', 'zero_shot'])
+def test_prompt_prefix_cache(tiny_model_path: str, instruction_format: str):
+    """
+    Tests that generating from the cached KV cache of the prompt prefix gives the same tokens and structures
+    with the same seed as encoding the whole prompt.
+    """
+    outputs = []
+    for use_prompt_prefix_cache in (False, True):
+        legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=3, max_regenerations=0,
+                                        instruction_format=instruction_format,
+                                        use_prompt_prefix_cache=use_prompt_prefix_cache))
+        prompt = legogpt._build_prompt('A basic chair with four legs.')
+        torch.manual_seed(0)
+        result_ids = legogpt.llm.generate_constrained(legogpt._build_allowed_token_mask_fn(), 10, prompt)
+        torch.manual_seed(0)
+        lego = legogpt('A basic chair with four legs.')['lego']
+        batch_legos = [output['lego'] for output in legogpt.generate_batch(['A basic chair.', 'A table.'], [0, 1])]
+        outputs.append((result_ids.tolist(), lego.to_txt(), [lego_.to_txt() for lego_ in batch_legos]))
+    assert legogpt.llm.prompt_prefix_length(prompt) > 0
+    assert outputs[0] == outputs[1]
+
+
+def test_rollback_to_brick(tmp_path, finetuning_config_dir: Path):
+    """
+    Tests that rolling back the LLM to the state saved after a brick gives the same logits and continues
+    generation the same way with the same seed as prefilling the prompt of the structure up to that brick.
+    """
+    model_path = create_tiny_model(tmp_path, finetuning_config_dir, eos_logit_offset=-20)
+    legogpt = LegoGPT(LegoGPTConfig(model_path, max_bricks=4, max_regenerations=0))
+    llm = legogpt.llm
+    caption = 'A basic chair with four legs.'
+    llm_states = []
+    torch.manual_seed(0)
+    lego, _ = legogpt._generate_structure(caption, llm_states=llm_states)
+    assert len(lego) == 4 and len(llm_states) == 5
+    partial_lego = LegoStructure(lego.bricks[:2])
+
+    llm.rollback_to_saved_state(llm_states[2])
+    input_ids = llm.input_ids_cache
+    rollback_logits = llm._forward(input_ids[:, -1:])
+    llm.prefill(legogpt._build_prompt(caption, partial_lego))
+    assert torch.equal(llm.input_ids_cache, input_ids)
+    assert torch.allclose(llm._forward(input_ids[:, -1:]), rollback_logits, atol=1e-5)
+
+    torch.manual_seed(1)
+    rollback_lego, _ = legogpt._generate_structure(caption, partial_lego, llm_states=llm_states[:3])
+    torch.manual_seed(1)
+    prefill_lego, _ = legogpt._generate_structure(caption, partial_lego)
+    assert rollback_lego.to_txt() == prefill_lego.to_txt()
+    assert rollback_lego.bricks[:2] == lego.bricks[:2] and len(rollback_lego) == 6
+
+
+@pytest.mark.parametrize('use_geometric_masking', [False, True])
+def test_batched_rejection_sampling(tiny_model_path: str, monkeypatch, use_geometric_masking: bool):
+    """
+    Tests sampling candidate bricks in parallel batches during rejection sampling, which should only accept valid
+    bricks and leave the LLM with a batch of one sequence.
+    """
+    monkeypatch.setattr(LegoStructure, 'stability_scores', _first_layer_stability_scores)
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_brick_rejections=7, max_regenerations=0,
+                                    brick_sample_batch_size=4, use_geometric_masking=use_geometric_masking))
+    for seed in range(3):
+        torch.manual_seed(seed)
+        output = legogpt('A basic chair with four legs.')
+        lego = output['lego']
+        assert len(lego) <= 5
+        assert not lego.has_out_of_bounds_bricks() and not lego.has_collisions()
+        assert legogpt.llm.batch_size == 1
+
+
+def test_generate_batch(tiny_model_path: str):
+    """
+    Tests generating several captions in one batch, where each structure depends only on its caption and seed,
+    not on the other structures in the batch.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=0))
+    captions = ['A basic chair.', 'A table.', 'A basic chair.']
+    outputs = legogpt.generate_batch(captions, seeds=[0, 1, 0])
+    assert len(outputs) == 3
+    assert outputs[0]['lego'].to_txt() == outputs[2]['lego'].to_txt()
+    assert outputs[0]['lego'].to_txt() == legogpt.generate_batch(captions[:1], seeds=[0])[0]['lego'].to_txt()
+    for output in outputs:
+        assert len(output['lego']) <= 5
+        assert not output['lego'].has_out_of_bounds_bricks() and not output['lego'].has_collisions()
+
+    assert len(legogpt.generate_batch(captions, seeds=[None, 1, None])) == 3
+    with pytest.raises(ValueError):
+        legogpt.generate_batch(captions, seeds=[0])
+
+
+@pytest.mark.parametrize('quantization', ['bf16', 'int8', 'int4'])
+def test_quantization(tiny_model_path: str, quantization: str):
+    """
+    Tests that the next-token distribution of a quantized model is close to that of the full-precision model.
+    """
+    if quantization == 'int4':
+        pytest.importorskip('torchao')
+    llm = LLM(tiny_model_path, 'cpu')
+    quantized_llm = LLM(tiny_model_path, 'cpu', quantization)
+    prompt = 'A basic chair with four legs.'
+
+    llm.prefill(prompt)
+    quantized_llm.prefill(prompt)
+    with torch.no_grad():
+        probs = llm.model(llm.input_ids_cache).logits[0, -1].float().softmax(-1)
+        quantized_probs = quantized_llm.model(quantized_llm.input_ids_cache).logits[0, -1].float().softmax(-1)
+    assert (probs - quantized_probs).abs().sum() / 2 < 0.05  # Total variation distance
+
+    output_ids = quantized_llm(prompt, return_as_ids=True, max_new_tokens=5)
+    assert 1 <= len(output_ids) <= 5
+
+
+def test_static_cache(tiny_model_path: str):
+    """
+    Tests decoding with the static KV cache and the compiled decode step, which should generate the same bricks
+    as the dynamic KV cache, and falling back to a dynamic KV cache once a sequence no longer fits.
+    """
+    outputs = []
+    for use_static_cache in (False, True):
+        legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=0,
+                                        use_static_cache=use_static_cache))
+        torch.manual_seed(0)
+        outputs.append(legogpt('A basic chair with four legs.')['lego'].to_txt())
+    assert outputs[0] == outputs[1]
+    assert legogpt.llm.static_kv_cache is not None and legogpt.llm.kv_cache is legogpt.llm.static_kv_cache
+
+    llm = legogpt.llm
+    prompt = legogpt._build_prompt('A basic chair with four legs.')
+    llm.enable_static_cache(prompt.shape[1] + 5)
+    llm.prefill(prompt)
+    assert llm.kv_cache is llm.static_kv_cache
+    no_eos_mask = torch.ones(llm.model.config.vocab_size, dtype=torch.bool)
+    no_eos_mask[llm.tokenizer.eos_token_id] = False
+    with pytest.warns(UserWarning, match='longer than the static KV cache'):
+        result_ids = llm.generate_constrained(lambda idx, ids: no_eos_mask, max_new_tokens=10)
+    assert result_ids.shape[1] == 10
+    assert llm.kv_cache is not llm.static_kv_cache
+    assert llm.kv_cache.get_seq_length() == llm.input_ids_cache.shape[1] - 1
+
+
+@pytest.mark.parametrize('dtype', ['int8', 'fp8'])
+def test_kv_cache_quantization(tiny_model_path: str, dtype: str):
+    """
+    Tests that the next-token distribution with a quantized KV cache is close to that with a full-precision KV cache,
+    and that the quantized KV cache can be rolled back and used for batched generation.
+    """
+    llm = LLM(tiny_model_path, 'cpu')
+    quantized_llm = LLM(tiny_model_path, 'cpu')
+    quantized_llm.enable_kv_cache_quantization(dtype)
+    prompt = 'A basic chair with four legs. 2x4 (0,0,0)\n1x2 (3,4,0)\n'
+
+    probs = []
+    for llm_ in (llm, quantized_llm):
+        llm_.prefill(prompt)
+        probs.append(llm_._forward(llm_.input_ids_cache[:, -1:])[0, -1].softmax(-1))
+    assert (probs[0] - probs[1]).abs().sum() / 2 < 0.01  # Total variation distance
+    assert kv_cache_nbytes(quantized_llm.kv_cache) < kv_cache_nbytes(llm.kv_cache) / 2
+
+    quantized_llm.prefill(prompt)
+    state = quantized_llm.save_state()
+    quantized_llm.generate_constrained(lambda idx, ids: torch.ones(quantized_llm.vocab_size, dtype=torch.bool), 5)
+    quantized_llm.rollback_to_saved_state(state)
+    assert quantized_llm.kv_cache.get_seq_length() == state.kv_cache_length
+    assert quantized_llm.kv_cache.key_scales[0].shape[2] == state.kv_cache_length
+
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=3, max_regenerations=0, kv_cache_quantization=dtype))
+    outputs = legogpt.generate_batch(['A basic chair.', 'A table.'], seeds=[0, 1])
+    assert len(outputs) == 2 and all(len(output['lego']) > 0 for output in outputs)
+
+
+def test_onnx_backend(tiny_model_path: str, tmp_path):
+    """
+    Tests running LegoGPT with a model exported to ONNX Runtime, which should generate the same bricks
+    as the PyTorch model.
+    """
+    pytest.importorskip('onnxruntime')
+    onnx_model_dir = tmp_path / 'onnx_model'
+    export_onnx(tiny_model_path, onnx_model_dir)
+
+    outputs = []
+    for backend, model_path in (('hf', tiny_model_path), ('onnx', str(onnx_model_dir))):
+        legogpt = LegoGPT(LegoGPTConfig(model_path, backend=backend, max_bricks=5, max_regenerations=0))
+        torch.manual_seed(0)
+        outputs.append(legogpt('A basic chair with four legs.')['lego'].to_txt())
+    assert outputs[0] == outputs[1]
+
+    # Rolling back restores the KV cache of the ONNX backend
+    llm = legogpt.llm
+    llm.prefill(legogpt._build_prompt('A basic chair with four legs.'))
+    state = llm.save_state()
+    llm.generate_constrained(legogpt._build_allowed_token_mask_fn(), max_new_tokens=10)
+    llm.rollback_to_saved_state(state)
+    assert llm.kv_cache.get_seq_length() == state.kv_cache_length == llm.input_ids_cache.shape[1] - 1
+
+    # Unsupported options are rejected up front instead of failing during generation
+    for options in ({'use_logit_masking': False}, {'best_of_n': 2}, {'use_static_cache': True}):
+        with pytest.raises(ValueError):
+            LegoGPT(LegoGPTConfig(str(onnx_model_dir), backend='onnx', **options))
+    with pytest.raises(ValueError):
+        LegoGPTBatch(legogpt)
+
+
+@pytest.mark.parametrize('draft_is_main_model', [True, False])
+def test_speculative_decoding(tiny_model_path: str, tmp_path, finetuning_config_dir: Path, draft_is_main_model: bool):
+    """
+    Tests speculative decoding of bricks with a draft model. A draft model identical to the main model
+    should have all of its draft tokens accepted.
+    """
+    draft_model_path = (tiny_model_path if draft_is_main_model
+                        else create_tiny_model(tmp_path, finetuning_config_dir, hidden_size=32, seed=1))
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, draft_model_name_or_path=draft_model_path, temperature=1.0))
+    mask_fn = legogpt._build_allowed_token_mask_fn()
+    propose_fn = legogpt._build_propose_fn(mask_fn, temperature=1.0)
+    llm = legogpt.llm
+
+    torch.manual_seed(0)
+    llm.prefill(legogpt._build_prompt('A basic chair with four legs.'))
+    state = llm.save_state()
+    for _ in range(10):
+        llm.rollback_to_saved_state(state)
+        result_ids = llm.generate_speculative(propose_fn, mask_fn, max_new_tokens=10, temperature=1.0,
+                                              stats=legogpt.speculative_stats)
+
+        # Every token must be allowed, and the KV cache must hold all tokens but the last
+        for idx, token_id in enumerate(result_ids[0]):
+            assert mask_fn(idx, result_ids[:, :idx])[token_id]
+        assert result_ids.shape[1] == 10 or result_ids[0, -1] == llm.tokenizer.eos_token_id
+        assert llm.kv_cache.get_seq_length() == llm.input_ids_cache.shape[1] - 1
+
+    stats = legogpt.speculative_stats
+    assert stats['draft_tokens'] > 0
+    if draft_is_main_model:
+        assert stats['accepted_draft_tokens'] == stats['draft_tokens']
+
+
+def test_geometric_draft(tiny_model_path: str):
+    """
+    Tests speculative decoding of bricks with drafts guessed from the geometry of the LEGO structure.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, use_geometric_draft=True, use_geometric_masking=True))
+    lego = LegoStructure.from_txt('2x4 (0,0,0)\n2x4 (2,0,0)\n')
+    mask_fn = legogpt._build_geometric_token_mask_fn(lego)
+    propose_fn = legogpt._build_propose_fn(mask_fn, temperature=1.0, lego=lego)
+    llm = legogpt.llm
+
+    # The next brick is guessed to continue the row, and the draft continues the guess matching the generated tokens
+    guess_ids = legogpt._get_token_ids(('2', 'x', '4', ' (', '4', ',', '0', ',', '0', ')\n'))
+    llm.prefill(legogpt._build_prompt('A basic chair with four legs.', lego))
+    draft_ids, draft_probs = propose_fn(llm.input_ids_cache, llm.input_ids_cache[:, :0], 10)
+    assert draft_ids[0].tolist() == guess_ids and draft_probs is None
+    draft_ids, _ = propose_fn(llm.input_ids_cache, torch.tensor([guess_ids[:3]]), 10)
+    assert draft_ids[0].tolist() == guess_ids[3:]
+
+    torch.manual_seed(0)
+    state = llm.save_state()
+    for _ in range(10):
+        llm.rollback_to_saved_state(state)
+        result_ids = llm.generate_speculative(propose_fn, mask_fn, max_new_tokens=10, temperature=1.0,
+                                              stats=legogpt.speculative_stats)
+        for idx, token_id in enumerate(result_ids[0]):
+            assert mask_fn(idx, result_ids[:, :idx]).view(-1)[token_id]
+        assert llm.kv_cache.get_seq_length() == llm.input_ids_cache.shape[1] - 1
+    assert legogpt.speculative_stats['draft_tokens'] > 0
+
+
+def test_generation_events(tiny_model_path: str):
+    """
+    Tests that generation events are emitted in order, with every stage delimited by a start and an end event,
+    and that the trace accounts for the total generation time.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=0, return_trace=True))
+    events = []
+    legogpt.add_hook(events.append)
+    torch.manual_seed(0)
+    output = legogpt('A basic chair with four legs.')
+    legogpt.remove_hook(events.append)
+
+    assert events[0].name == 'prefill_start'
+    assert all(event_1.time <= event_2.time for event_1, event_2 in zip(events, events[1:]))
+    open_stages = []
+    for event in events:
+        if event.name.endswith('_start'):
+            open_stages.append(event.name.removesuffix('_start'))
+        elif event.name.endswith('_end'):
+            assert open_stages.pop() == event.name.removesuffix('_end')
+    assert not open_stages
+    assert sum(event.name == 'brick_accepted' for event in events) == len(output['lego'])
+    # Rejections during the attempt that ends the structure are not counted in rejection_reasons
+    assert sum(event.name == 'brick_rejected' for event in events) >= output['rejection_reasons'].total()
+
+    trace = output['trace']
+    assert set(trace) == {'prefill', 'decode', 'validation', 'stability_solve', 'rollback', 'other', 'total'}
+    assert all(duration >= 0 for duration in trace.values())
+    assert trace['total'] == pytest.approx(sum(trace.values()) - trace['total'])
+
+    # A stage is closed even if it raises
+    events.clear()
+    legogpt.add_hook(events.append)
+    with pytest.raises(TimeoutError):
+        with legogpt._stage('stability_solve', n_bricks=0):
+            raise TimeoutError
+    assert [event.name for event in events] == ['stability_solve_start', 'stability_solve_end']
+
+
+def test_time_budget(tiny_model_path: str, monkeypatch):
+    """
+    Tests that generation steps down the degradation ladder as its time budget runs out,
+    and that it returns a stable prefix of the structure once it is out of time.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=2))
+    events = []
+    legogpt.add_hook(events.append)
+    output = legogpt('A basic chair with four legs.', time_budget=0)
+    assert output['degradation_level'] == 'stable_prefix' and len(output['lego']) == 0
+    assert [event.data['level'] for event in events if event.name == 'degradation'] == ['stable_prefix']
+    assert legogpt('A basic chair with four legs.')['degradation_level'] == 'none'
+
+    # Use a clock that advances by one second whenever it is read
+    clock = itertools.count()
+    monkeypatch.setattr(time, 'perf_counter', lambda: float(next(clock)))
+    events.clear()
+    torch.manual_seed(0)
+    output = legogpt('A basic chair with four legs.', time_budget=100)
+    levels = [event.data['level'] for event in events if event.name == 'degradation']
+    assert levels == [level for level in ['fewer_rejections', 'fewer_regenerations', 'stable_prefix'] if level in levels]
+    assert output['degradation_level'] == (levels[-1] if levels else 'none')
+    assert len(output['lego']) == 0 or output['lego'].is_stable()
+
+
+def test_batch_time_budget(tiny_model_path: str, monkeypatch):
+    """
+    Tests that batched and best-of-n generation honour the time budget like sequential generation.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=2))
+    outputs = legogpt.generate_batch(['A basic chair.', 'A table.'], seeds=[0, 1], time_budget=0)
+    assert all(output['degradation_level'] == 'stable_prefix' and len(output['lego']) == 0 for output in outputs)
+    outputs = legogpt.generate_best_of_n('A basic chair.', n=2, seeds=[0, 1], time_budget=0)
+    assert all(output['degradation_level'] == 'stable_prefix' and len(output['lego']) == 0 for output in outputs)
+    assert all(output['degradation_level'] == 'none' for output in legogpt.generate_batch(['A table.'], seeds=[0]))
+
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=2, best_of_n=2))
+    output = legogpt('A basic chair.', time_budget=0)
+    assert output['degradation_level'] == 'stable_prefix' and len(output['lego']) == 0
+
+    # Use a clock that advances by one second whenever it is read
+    clock = itertools.count()
+    monkeypatch.setattr(time, 'perf_counter', lambda: float(next(clock)))
+    outputs = legogpt.generate_batch(['A basic chair.', 'A table.'], seeds=[0, 1], time_budget=20)
+    for output in outputs:
+        assert output['degradation_level'] != 'none'
+        assert len(output['lego']) == 0 or output['lego'].is_stable()
+
+
+def test_rejected_brick_trie(tiny_model_path: str, monkeypatch):
+    """
+    Tests that rejected bricks are masked out, with prefixes pruned once all of their continuations are banned,
+    and that rejection sampling never generates a rejected brick again.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_brick_rejections=50, max_regenerations=0))
+    banned_bricks = _RejectedBrickTrie(legogpt._build_allowed_token_mask_fn())
+    brick_ids = torch.tensor([legogpt._brick_token_ids(LegoBrick.from_txt('1x2 (0,0,0)'))])
+    banned_bricks.ban(brick_ids[0].tolist())
+    assert not banned_bricks(8, brick_ids[:, :8])[0, brick_ids[0, 8]]
+    assert banned_bricks(8, brick_ids[:, :8]).sum() == legogpt._build_allowed_token_mask_fn()(8, None).sum() - 1
+
+    for z in range(1, legogpt.world_dim):
+        banned_bricks.ban(legogpt._brick_token_ids(LegoBrick.from_txt(f'1x2 (0,0,{z})')))
+    assert not banned_bricks(6, brick_ids[:, :6])[0, brick_ids[0, 6]]
+    assert banned_bricks(6, brick_ids[:, :6]).sum() == legogpt._build_allowed_token_mask_fn()(6, None).sum() - 1
+
+    # Reject every new brick, sampling at a low temperature at which the same brick would be generated again
+    monkeypatch.setattr(LegoGPT, '_try_adding_brick', staticmethod(
+        lambda brick, lego, rejected_bricks: 'already_rejected' if brick in rejected_bricks else 'collision'))
+    legogpt.temperature = 0.01
+    legogpt.llm.prefill(legogpt._build_prompt('A basic chair with four legs.'))
+    _, rejection_reasons = legogpt.generate_brick_with_rejection_sampling(lego=LegoStructure([]))
+    assert rejection_reasons == {'collision': 50}
+
+
+def test_brick_token_tables(tiny_model_path: str, monkeypatch):
+    """
+    Tests converting bricks to and from token ids with the token tables, which should match the tokenizer,
+    and building the prompt of a partial structure without tokenizing the structure.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5))
+    tokenizer = legogpt.llm.tokenizer
+    lego = LegoStructure.from_txt('2x4 (0,0,0)\n1x2 (13,4,0)\n4x4 (10,19,1)\n')
+    assert legogpt._use_brick_token_tables
+    assert torch.equal(legogpt._build_prompt('A basic chair.', lego),
+                       legogpt._tokenize_prompt('A basic chair.', lego.to_txt()))
+
+    result_ids = torch.from_numpy(legogpt._bricks_token_ids(lego.bricks).reshape(len(lego), -1))
+    bricks = [tokenizer.decode(brick_ids) for brick_ids in result_ids]
+    assert bricks == [brick.to_txt() for brick in lego.bricks]
+    eos_ids = torch.full((1, result_ids.shape[1]), tokenizer.eos_token_id)
+    ill_formatted_ids = result_ids[:1].roll(1, dims=1)
+    monkeypatch.setattr(tokenizer, 'decode', lambda *args, **kwargs: pytest.fail('Bricks should not be decoded'))
+    assert legogpt._decode_bricks(result_ids) == bricks
+    assert [legogpt._parse_brick(brick) for brick in bricks] == lego.bricks
+    monkeypatch.undo()
+    assert legogpt._decode_bricks(torch.cat([eos_ids, ill_formatted_ids])) == [
+        '', tokenizer.decode(ill_formatted_ids[0], skip_special_tokens=True)]
+
+
+def _first_layer_stability_scores(lego: LegoStructure, time_limit: float | None = None) -> np.ndarray:
+    """
+    Stability scores for tests without a stability solver, in which bricks above the first layer are unstable.
+    """
+    scores = np.zeros((lego.world_dim,) * 3)
+    for brick in lego.bricks:
+        scores[brick.slice] = brick.z >= 1
+    return scores
+
+
+def test_stability_checkpoints(tiny_model_path: str, monkeypatch):
+    """
+    Tests that stability checkpoints stop generation of an unstable structure early and roll it back,
+    and that the structure is still checked and rolled back when it is finished.
+    """
+    monkeypatch.setattr(LegoStructure, 'stability_scores', _first_layer_stability_scores)
+    outputs = []
+    for checkpoint_kwargs in ({}, {'stability_check_on_layer': True}, {'stability_check_interval': 1}):
+        legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=3,
+                                        use_geometric_masking=True, **checkpoint_kwargs))
+        torch.manual_seed(2)
+        outputs.append(legogpt('A basic chair with four legs.'))
+
+    assert outputs[0]['stability_checkpoints']['checks'] == 0 and outputs[0]['n_regenerations'] > 0
+    for output in outputs[1:]:
+        stability_checkpoints = output['stability_checkpoints']
+        assert stability_checkpoints['checks'] > 0 and stability_checkpoints['early_rollbacks'] > 0
+        assert stability_checkpoints['discarded_bricks'] > 0
+    for output in outputs:
+        assert all(brick.z == 0 for brick in output['lego'].bricks)
+
+
+def test_stream(tiny_model_path: str, monkeypatch):
+    """
+    Tests that the updates streamed during generation, including rollbacks, add up to the generated structure,
+    and that generation can be cancelled by closing the stream.
+    """
+    monkeypatch.setattr(LegoStructure, 'stability_scores', _first_layer_stability_scores)
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=5, max_regenerations=3, use_geometric_masking=True))
+    torch.manual_seed(2)
+    updates = list(legogpt.stream('A basic chair with four legs.'))
+
+    bricks = []
+    for update in updates[:-1]:
+        if update.kind == 'add':
+            bricks.extend(update.bricks)
+        else:
+            assert update.kind == 'retract' and tuple(bricks[update.n_bricks:]) == update.bricks
+            del bricks[update.n_bricks:]
+        assert len(bricks) == update.n_bricks
+    assert updates[-1].kind == 'finished' and bricks == updates[-1].output['lego'].bricks
+    assert any(update.kind == 'retract' for update in updates)
+
+    stream = legogpt.stream('A basic chair with four legs.')
+    next(stream)
+    stream.close()
+    assert legogpt('A basic chair with four legs.')['degradation_level'] == 'none'
+
+
+def test_best_of_n(tiny_model_path: str):
+    """
+    Tests generating several LEGO structures for one caption in parallel, returning the stable ones first.
+    """
+    legogpt = LegoGPT(LegoGPTConfig(tiny_model_path, max_bricks=2, max_regenerations=0))
+    outputs = legogpt.generate_best_of_n('A basic chair with four legs.', n=4, seeds=[0, 1, 2, 3], n_stable=4)
+
+    assert len(outputs) == 4
+    is_stable = [output['lego'].is_stable() for output in outputs]
+    assert is_stable == sorted(is_stable, reverse=True)
+
+    outputs = legogpt.generate_best_of_n('A basic chair with four legs.', n=4, seeds=[0, 1, 2, 3], n_stable=1)
+    assert 1 <= len(outputs) <= 4
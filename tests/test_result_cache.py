@@ -0,0 +1,84 @@
+import multiprocessing
+from collections import Counter
+
+from legogpt.data import LegoStructure
+from legogpt.models import LegoGPTConfig
+from legogpt.result_cache import ResultCache
+
+
+def _output(lego_txt: str) -> dict:
+    return {
+        'lego': LegoStructure.from_txt(lego_txt),
+        'rejection_reasons': Counter({'collision': 2}),
+        'n_regenerations': 1,
+        'stability_checkpoints': Counter(),
+    }
+
+
+def test_result_cache(tmp_path):
+    """
+    Tests that cached outputs are returned for the same normalized caption, seed and config, and only for them.
+    """
+    cfg = LegoGPTConfig(str(tmp_path / 'model'))
+    cache = ResultCache(tmp_path / 'cache.db', cfg)
+    cache.put('A basic chair.', 0, _output('2x4 (0,0,0)\n'))
+
+    output = cache.get('  A basic\tchair. ', 0)
+    assert output['lego'].to_txt() == '2x4 (0,0,0)\n'
+    assert output['rejection_reasons'] == Counter({'collision': 2}) and output['n_regenerations'] == 1
+    assert cache.get('A basic chair.', 1) is None
+    assert cache.get('A table.', 0) is None
+    assert ResultCache(tmp_path / 'cache.db', LegoGPTConfig(str(tmp_path / 'model'), temperature=1.0)).get(
+        'A basic chair.', 0) is None
+    assert ResultCache(tmp_path / 'cache.db', LegoGPTConfig(str(tmp_path / 'model'), return_trace=True)).get(
+        'A basic chair.', 0) is not None
+    assert cache.stats == Counter({'hits': 1, 'misses': 2})
+
+
+def test_result_cache_eviction(tmp_path):
+    """
+    Tests that the least recently used outputs are evicted once the cache is full.
+    """
+    cache = ResultCache(tmp_path / 'cache.db', LegoGPTConfig(str(tmp_path / 'model')), max_size_mb=1000 / 2 ** 20)
+    for seed in range(3):
+        cache.put('A basic chair.', seed, _output('2x4 (0,0,0)\n'))
+    cache.get('A basic chair.', 0)
+    for seed in range(3, 6):
+        cache.put('A basic chair.', seed, _output('2x4 (0,0,0)\n'))
+
+    assert 0 < len(cache) < 6
+    assert cache.get('A basic chair.', 0) is not None
+    assert cache.get('A basic chair.', 1) is None
+
+    # The running total size matches the outputs, also when an output is replaced
+    cache.put('A basic chair.', 0, _output('2x4 (0,0,0)\n2x4 (0,0,1)\n'))
+    with cache._connect() as connection:
+        total_size = connection.execute('SELECT size FROM total_size').fetchone()[0]
+        assert total_size == connection.execute('SELECT SUM(size) FROM outputs').fetchone()[0]
+    assert total_size <= cache.max_size
+
+
+def _fill_cache(cache_path: str, model_path: str, seeds: range) -> None:
+    cache = ResultCache(cache_path, LegoGPTConfig(model_path))
+    for seed in seeds:
+        cache.put('A basic chair.', seed, _output(f'2x4 ({seed},0,0)\n'))
+        cache.get('A basic chair.', seed)
+
+
+def test_result_cache_concurrent(tmp_path):
+    """
+    Tests writing to the same cache from several processes at once.
+    """
+    cache_path, model_path = str(tmp_path / 'cache.db'), str(tmp_path / 'model')
+    ResultCache(cache_path, LegoGPTConfig(model_path))
+    processes = [multiprocessing.get_context('spawn').Process(
+        target=_fill_cache, args=(cache_path, model_path, range(i * 20, (i + 1) * 20))) for i in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert all(process.exitcode == 0 for process in processes)
+    cache = ResultCache(cache_path, LegoGPTConfig(model_path))
+    assert len(cache) == 60
+    assert cache.get('A basic chair.', 42)['lego'].to_txt() == '2x4 (42,0,0)\n'
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from legogpt.models import LegoGPT, LegoGPTConfig, create_tiny_model
+from legogpt.result_cache import ResultCache
+from legogpt.serve import LegoGPTServer
+
+
+@pytest.fixture(scope='module')
+def tiny_legogpt(tmp_path_factory, finetuning_config_dir: Path) -> LegoGPT:
+    model_path = create_tiny_model(tmp_path_factory.mktemp('tiny_model'), finetuning_config_dir)
+    return LegoGPT(LegoGPTConfig(model_path, max_bricks=5, max_brick_rejections=5, max_regenerations=0))
+
+
+def _request(port: int, method: str, path: str, body: dict | None = None) -> (int, dict):
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(f'http://127.0.0.1:{port}{path}', data=data, method=method)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def test_serve(tiny_legogpt: LegoGPT):
+    """
+    Tests serving several concurrent generation requests with a tiny randomly initialized model.
+    """
+
+    async def run():
+        server = LegoGPTServer(tiny_legogpt, max_batch_size=2)
+        http_server = await server.start('127.0.0.1', 0)
+        port = http_server.sockets[0].getsockname()[1]
+
+        bodies = [{'caption': 'A basic chair with four legs.', 'seed': seed} for seed in range(3)] + [
+            {'caption': 'A basic chair with four legs.', 'seed': 0}]
+        responses = await asyncio.gather(*(asyncio.to_thread(_request, port, 'POST', '/generate', body)
+                                           for body in bodies))
+        health = await asyncio.to_thread(_request, port, 'GET', '/health')
+        bad_request = await asyncio.to_thread(_request, port, 'POST', '/generate', {'prompt': 'A chair.'})
+        not_found = await asyncio.to_thread(_request, port, 'GET', '/')
+
+        http_server.close()
+        await http_server.wait_closed()
+        return responses, health, bad_request, not_found
+
+    responses, health, bad_request, not_found = asyncio.run(run())
+    for status, response in responses:
+        assert status == 200
+        assert set(response.keys()) == {'lego', 'rejection_reasons', 'n_regenerations', 'stability_checkpoints'}
+    assert responses[0] == responses[3]  # Same seed, same output
+    assert health == (200, {'status': 'ok', 'n_active': 0, 'n_queued': 0})
+    assert bad_request[0] == 400
+    assert not_found[0] == 404
+
+
+def test_serve_cache(tiny_legogpt: LegoGPT, tmp_path, monkeypatch):
+    """
+    Tests that repeated requests with a seed are answered from the result cache, unless their output was degraded.
+    """
+    cache = ResultCache(tmp_path / 'cache.db', LegoGPTConfig(tiny_legogpt.llm.tokenizer.name_or_path), namespace='batch')
+
+    async def run(seed: int):
+        server = LegoGPTServer(tiny_legogpt, max_batch_size=2, cache=cache)
+        server._scheduler_task = asyncio.create_task(server._run_scheduler())
+        outputs = [await server.generate(caption, seed=seed) for caption in ('A basic chair.', ' A basic  chair.')]
+        server._scheduler_task.cancel()
+        return outputs
+
+    outputs = asyncio.run(run(seed=0))
+    assert outputs[0]['lego'].to_txt() == outputs[1]['lego'].to_txt()
+    assert cache.stats == {'hits': 1, 'misses': 1}
+
+    monkeypatch.setattr(tiny_legogpt, 'time_budget', 0)
+    outputs = asyncio.run(run(seed=1))
+    assert all(output['degradation_level'] == 'stable_prefix' for output in outputs)
+    assert cache.stats == {'hits': 1, 'misses': 3}
+
+
+def test_serve_prefork(tmp_path, finetuning_config_dir: Path):
+    """
+    Tests serving with several worker processes forked after loading the model.
+    """
+    model_path = create_tiny_model(tmp_path / 'tiny_model', finetuning_config_dir)
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([
+        sys.executable, '-m', 'legogpt.serve', '--model_name_or_path', model_path, '--max_bricks', '5',
+        '--max_brick_rejections', '5', '--max_regenerations', '0', '--n_workers', '2', '--port', str(port),
+    ])
+    worker_pids = []
+    try:
+        for _ in range(600):
+            try:
+                _request(port, 'GET', '/health')
+            except urllib.error.URLError:
+                time.sleep(0.1)
+                continue
+            # The first worker may serve before the second one is forked
+            worker_pids = Path(f'/proc/{process.pid}/task/{process.pid}/children').read_text().split()
+            if len(worker_pids) == 2:
+                break
+            time.sleep(0.1)
+        assert len(worker_pids) == 2
+
+        bodies = [{'caption': 'A basic chair with four legs.', 'seed': 0}] * 4
+        with ThreadPoolExecutor(4) as executor:
+            responses = list(executor.map(lambda body: _request(port, 'POST', '/generate', body), bodies))
+        assert all(response == responses[0] for response in responses)
+        assert responses[0][0] == 200
+    finally:
+        process.terminate()
+        assert process.wait(timeout=30) == 0
+    assert not any(os.path.exists(f'/proc/{pid}') for pid in worker_pids)